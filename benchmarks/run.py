@@ -0,0 +1,501 @@
+"""
+benchmarks for the hot paths, run against a local stand-in of the camera bucket and the NASA page
+
+    python -m benchmarks.run
+    python -m benchmarks.run --latency 0.05 --miss-rate 0.1 --capture-jitter 0.2 --json results.json
+
+every benchmark runs in a fresh process and reports latency percentiles, requests per image, throughput
+and the peak RSS of that process, so the numbers of two runs (e.g. before and after a change) can be compared
+"""
+
+import argparse
+import contextlib
+import datetime as dt
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+import requests
+from rich.console import Console
+from rich.markup import escape
+from rich.table import Table
+
+from benchmarks.stand_in import BUCKET, StandInConfig, StandInServer, serve
+from src.core.background import BackgroundImageFetcher
+from src.core.session import PooledSession
+from src.nasa.nasa_image_of_the_day import HTTP_CACHE_FILE, update
+from src.snowbasin.probe_cache import ProbeCache
+from src.snowbasin.snowbasin_image import SnowbasinImage
+from src.snowbasin.wakeup import MIN_RETRY_SECONDS
+
+# the day every benchmark runs on, it starts at night so both camera schedules are covered
+START = dt.datetime(2024, 1, 15, 6, 0)
+BENCHMARKS = ("import_time", "snowbasin_process", "non_round_image_times", "one_day", "late_upload", "nasa_process")
+COLUMNS = (
+    "benchmark",
+    "calls",
+    "images",
+    "requests",
+    "req/image",
+    "images/s",
+    "p50 ms",
+    "p90 ms",
+    "p99 ms",
+    "budget ms",
+    "peak RSS MB",
+)
+# how long (median of -X importtime, in ms) importing each command line entry point may take
+# a cron run that finds nothing new should spend its time on I/O, not on importing
+IMPORT_BUDGETS_MS = {"src.snowbasin.main": 75, "src.nasa.nasa_image_of_the_day": 50}
+# these are only imported once they are needed, a command line entry point must not import them on start up
+LAZY_MODULES = ("requests", "rich", "bs4", "PIL", "multiprocessing")
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class FakeClock:
+    def __init__(self, now: dt.datetime) -> None:
+        """
+        a clock the benchmarks move forward themselves, passed to SnowbasinImage as `clock`
+        """
+        self.now: dt.datetime = now
+
+    def __call__(self) -> dt.datetime:
+        return self.now
+
+    def advance(self, minutes: float) -> None:
+        self.now += dt.timedelta(minutes=minutes)
+
+
+class Result:
+    def __init__(self, name: str) -> None:
+        """
+        what one benchmark measured
+        """
+        self.name: str = name
+        self.latencies: list[float] = []
+        self.images: int = 0
+        self.requests: int = 0
+        self.seconds: float = 0.0
+        self.peak_rss_mb: float = 0.0
+        # the p50 has to stay under the budget, if there is one
+        self.budget_ms: float | None = None
+        self.problems: list[str] = []
+
+    def percentile(self, p: float) -> float | None:
+        """
+        helper function
+        nearest-rank percentile of the latencies in milliseconds
+        """
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))] * 1000
+
+    def as_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "calls": len(self.latencies),
+            "images": self.images,
+            "requests": self.requests,
+            "requests_per_image": self.requests / self.images if self.images else None,
+            "seconds": self.seconds,
+            "images_per_second": self.images / self.seconds if self.images and self.seconds else None,
+            "p50_ms": self.percentile(50),
+            "p90_ms": self.percentile(90),
+            "p99_ms": self.percentile(99),
+            "budget_ms": self.budget_ms,
+            "problems": self.problems,
+            "peak_rss_mb": self.peak_rss_mb,
+        }
+
+    def check(self) -> list[str]:
+        """
+        the problems found and a blown budget, empty if the benchmark passed
+        """
+        if self.budget_ms is not None and self.percentile(50) > self.budget_ms:
+            return [
+                *self.problems,
+                f"{self.name}: p50 {self.percentile(50):.1f}ms is over the {self.budget_ms}ms budget",
+            ]
+        return self.problems
+
+
+def peak_rss_mb() -> float:
+    """
+    helper function
+    peak resident memory of this process so far (run_isolated calls it in a process of its own)
+    ru_maxrss is in KB on Linux and in bytes on macOS
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if platform.system() == "Darwin" else peak / 1024
+
+
+def run_isolated(context, function, args: tuple, verbose: bool) -> Result:
+    """
+    helper function
+    run one benchmark in a fresh process, so its peak RSS is its own and not the high-water mark of the ones before it
+    """
+    results = context.Queue()
+    process = context.Process(target=run_benchmark, args=(function, args, verbose, results))
+    process.start()
+    result = results.get()
+    process.join()
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def run_benchmark(function, args: tuple, verbose: bool, results) -> None:
+    """
+    helper function
+    the child process of run_isolated, sends back the result with the peak RSS of the child (or what went wrong)
+    """
+    if not verbose:
+        logging.getLogger().setLevel(logging.CRITICAL)
+    try:
+        result = function(*args)
+        result.peak_rss_mb = peak_rss_mb()
+    except Exception:
+        result = RuntimeError(f"{function.__name__}{args} failed:\n{traceback.format_exc()}")
+    results.put(result)
+
+
+def count_requests(url: str) -> int:
+    """
+    helper function
+    every request the stand-in answered since the last call, the counts are reset every time
+    the 304s are also counted as page or image requests, so they aren't added again
+    """
+    counts = requests.get(f"{url}/_counts?reset=1", timeout=10).json()
+    return sum(counts.values()) - counts["not_modified"]
+
+
+def bench_import_time(module: str, budget_ms: float, runs: int = 7) -> Result:
+    """
+    import a command line entry point in a fresh interpreter with -X importtime, the way cron starts it
+    the cumulative import time of the module is checked against its budget,
+    and none of the LAZY_MODULES may be imported on the way
+    """
+    result = Result(f"import_time[{module}]")
+    result.budget_ms = budget_ms
+    environment = {**os.environ, "BACKGROUNDS_LOG_FORMAT": "plain"}
+    started_at = time.perf_counter()
+    for _ in range(runs):
+        stderr = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=REPO_ROOT,
+            env=environment,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stderr
+        # import time: self [us] | cumulative | imported package
+        imported = {}
+        for line in stderr.splitlines():
+            if line.startswith("import time:") and "|" in line:
+                _, cumulative, name = line.split("|")
+                if cumulative.strip().isdigit():
+                    imported[name.strip()] = int(cumulative)
+        result.latencies.append(imported[module] / 1_000_000)
+        eager = sorted({name.split(".")[0] for name in imported} & set(LAZY_MODULES))
+        if eager and not result.problems:
+            result.problems.append(f"{module} imports {', '.join(eager)} on start up")
+    result.seconds = time.perf_counter() - started_at
+    return result
+
+
+def make_snowbasin(
+    url: str, directory: str, clock: FakeClock, discovery: str, probe_cache: ProbeCache | None = None
+) -> SnowbasinImage:
+    """
+    helper function
+    a SnowbasinImage pointed at the stand-in
+    """
+    return SnowbasinImage(
+        os.path.join(directory, ""),
+        session=PooledSession(),
+        discovery=discovery,
+        listing_api_url=f"{url}/storage/v1",
+        camera_id=BUCKET,
+        storage_url=url,
+        clock=clock,
+        probe_cache=probe_cache,
+    )
+
+
+def bench_snowbasin_process(url: str, iterations: int, discovery: str) -> Result:
+    """
+    run SnowbasinImage.process once per slot, the way constant mode does, with the clock moving 5 minutes per cycle
+    """
+    result = Result(f"snowbasin_process[{discovery}]")
+    with tempfile.TemporaryDirectory() as directory:
+        clock = FakeClock(START)
+        snowbasin = make_snowbasin(url, directory, clock, discovery)
+        count_requests(url)
+        started_at = time.perf_counter()
+        for _ in range(iterations):
+            clock.advance(5)
+            call_started_at = time.perf_counter()
+            snowbasin.process()
+            result.latencies.append(time.perf_counter() - call_started_at)
+        result.seconds = time.perf_counter() - started_at
+        result.images = snowbasin.images_found
+        result.requests = count_requests(url)
+        snowbasin.session.close()
+    return result
+
+
+def bench_non_round_image_times(url: str, iterations: int, discovery: str) -> Result:
+    """
+    search every slot of the day with check_for_non_round_image_times, the image we have is never in the window
+    """
+    result = Result(f"non_round_image_times[{discovery}]")
+    with tempfile.TemporaryDirectory() as directory:
+        clock = FakeClock(START)
+        snowbasin = make_snowbasin(url, directory, clock, discovery)
+        count_requests(url)
+        slot = snowbasin.find_next_image_time(START - dt.timedelta(days=1))
+        started_at = time.perf_counter()
+        for _ in range(iterations):
+            call_started_at = time.perf_counter()
+            resp, _ = snowbasin.check_for_non_round_image_times(slot)
+            result.latencies.append(time.perf_counter() - call_started_at)
+            if resp is not None:
+                resp.close()
+            # the next slot, the same way constant mode gets to it
+            clock.now = slot + dt.timedelta(minutes=snowbasin.cadence.slot_period(slot.hour) + 0.5)
+            slot = snowbasin.find_next_image_time(slot)
+        result.seconds = time.perf_counter() - started_at
+        result.images = snowbasin.images_found
+        result.requests = count_requests(url)
+        snowbasin.session.close()
+    return result
+
+
+def bench_one_day(url: str, workers: int, discovery: str) -> Result:
+    """
+    backfill a whole day with pull_one_day_to_old_backgrounds
+    """
+    result = Result(f"one_day[{discovery}, {workers} workers]")
+    with tempfile.TemporaryDirectory() as directory:
+        snowbasin = make_snowbasin(url, directory, FakeClock(START), discovery)
+        count_requests(url)
+        started_at = time.perf_counter()
+        result.images = snowbasin.pull_one_day_to_old_backgrounds(START, 0, workers)
+        result.seconds = time.perf_counter() - started_at
+        result.latencies.append(result.seconds)
+        result.requests = count_requests(url)
+        snowbasin.session.close()
+    return result
+
+
+def bench_late_upload(config: StandInConfig, iterations: int) -> Result:
+    """
+    run SnowbasinImage.process once per slot with the probe cache, against a bucket where every image is uploaded
+    late: the first check of a slot only gets 404s, and the retry constant mode makes MIN_RETRY_SECONDS later
+    has to find the image, the cache must not answer it with the 404s it just got
+    it has its own stand-in, the late uploads would throw off the other benchmarks
+    """
+    result = Result("late_upload[probe cache]")
+    server = StandInServer(StandInConfig(**{**vars(config), "late_uploads": 0})).start()
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            clock = FakeClock(START)
+            probe_cache = ProbeCache(os.path.join(directory, "probes.sqlite3"))
+            snowbasin = make_snowbasin(server.url, directory, clock, "probe", probe_cache)
+            # the image we start from is already there
+            snowbasin.process()
+            server.config.late_uploads = 1
+            count_requests(server.url)
+            started_at = time.perf_counter()
+            for i in range(iterations):
+                # on the schedule, the retries don't push the next check back
+                clock.now = START + dt.timedelta(minutes=5 * (i + 1))
+                found = snowbasin.images_found
+                call_started_at = time.perf_counter()
+                if not snowbasin.process() or snowbasin.images_found == found:
+                    clock.now += dt.timedelta(seconds=MIN_RETRY_SECONDS)
+                    snowbasin.process()
+                result.latencies.append(time.perf_counter() - call_started_at)
+            result.seconds = time.perf_counter() - started_at
+            result.requests = count_requests(server.url)
+            snowbasin.session.close()
+        # every image we asked for before it was published has to be found by a retry
+        result.images = snowbasin.images_found - 1
+        late = len(server.early_requests)
+        if result.images < late:
+            result.problems.append(f"{result.name}: {late - result.images} of {late} late images were never found")
+    finally:
+        server.stop()
+    return result
+
+
+def bench_nasa_process(url: str, iterations: int, changed: bool) -> Result:
+    """
+    run the NASA update the way the hourly cron job does on a new day, the image we have is from the day before
+    changed: the page has a new image every time (the http cache is cleared before every call),
+     otherwise the page and image are unchanged since our last download and every call should be a single 304
+    """
+    result = Result(f"nasa_process[{'new image' if changed else 'unchanged'}]")
+    page_url = f"{url}/image-of-the-day/"
+    with tempfile.TemporaryDirectory() as directory:
+        nasa = BackgroundImageFetcher(os.path.join(directory, ""), session=PooledSession(), source_name="nasa")
+        if not changed:
+            update(nasa, page_url)
+            # it is the next day, the image we downloaded yesterday is the current one
+            current_file = nasa.get_current_files_in_directory()
+            yesterday = nasa.make_file_path_string(START - dt.timedelta(days=1))
+            os.replace(current_file, yesterday)
+            nasa.http_cache.get(nasa.http_cache.get(page_url)["image_url"])["file"] = yesterday
+        count_requests(url)
+        started_at = time.perf_counter()
+        for i in range(iterations):
+            if changed:
+                # make the current image look like it is from an earlier day so every call fetches a new one
+                current_file = nasa.get_current_files_in_directory()
+                if current_file:
+                    os.replace(current_file, nasa.make_file_path_string(START - dt.timedelta(days=i)))
+                nasa.http_cache = None
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(os.path.join(directory, HTTP_CACHE_FILE))
+            call_started_at = time.perf_counter()
+            result.images += bool(update(nasa, page_url))
+            result.latencies.append(time.perf_counter() - call_started_at)
+        result.seconds = time.perf_counter() - started_at
+        result.requests = count_requests(url)
+        nasa.session.close()
+    return result
+
+
+def print_results(results: list[Result]) -> None:
+    """
+    helper function
+    print the results as a table
+    """
+
+    def fmt(value: float | None, digits: int = 1) -> str:
+        return "-" if value is None else f"{value:.{digits}f}"
+
+    table = Table(title="Benchmarks")
+    for column in COLUMNS:
+        table.add_column(column, justify="left" if column == "benchmark" else "right", no_wrap=column == "benchmark")
+    for result in results:
+        row = result.as_dict()
+        table.add_row(
+            escape(row["name"]),
+            str(row["calls"]),
+            str(row["images"]),
+            str(row["requests"]),
+            fmt(row["requests_per_image"], 2),
+            fmt(row["images_per_second"]),
+            fmt(row["p50_ms"]),
+            fmt(row["p90_ms"]),
+            fmt(row["p99_ms"]),
+            fmt(row["budget_ms"], 0),
+            fmt(row["peak_rss_mb"]),
+        )
+    # wide enough for the benchmark names when the output is piped to a file
+    console = Console()
+    console.width = max(console.width, 150)
+    console.print(table)
+
+
+def main() -> None:
+    """
+    Main function to parse arguments and run the benchmarks
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the fetchers against a local stand-in bucket.")
+    parser.add_argument("--only", choices=BENCHMARKS, action="append", help="run only these benchmarks")
+    parser.add_argument("-n", "--iterations", type=int, default=100, help="calls per benchmark")
+    parser.add_argument("-w", "--workers", type=int, default=8, help="workers for the concurrent backfill")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds the stand-in waits per request")
+    parser.add_argument("--latency-jitter", type=float, default=0.0, help="up to this many extra seconds")
+    parser.add_argument("--miss-rate", type=float, default=0.0, help="share of slots without an image")
+    parser.add_argument(
+        "--capture-offsets",
+        type=str,
+        default="2",
+        help="comma separated minutes before the slot the camera captures at",
+    )
+    parser.add_argument("--capture-jitter", type=float, default=0.0, help="share of captures on a random minute")
+    parser.add_argument(
+        "--truncate-rate", type=float, default=0.0, help="share of image downloads cut off halfway (and resumed)"
+    )
+    parser.add_argument("--image-kb", type=int, default=200, help="size of every image")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the capture pattern")
+    parser.add_argument("--json", type=str, default=None, help="also write the results to this file")
+    parser.add_argument("-v", "--verbose", action="store_true", help="keep the fetchers' logs")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        # the fetchers and urllib3 all log through the root logger
+        logging.getLogger().setLevel(logging.CRITICAL)
+    config = StandInConfig(
+        latency=args.latency,
+        latency_jitter=args.latency_jitter,
+        miss_rate=args.miss_rate,
+        capture_offsets=tuple(int(o) for o in args.capture_offsets.split(",")),
+        capture_jitter=args.capture_jitter,
+        image_bytes=args.image_kb * 1024,
+        seed=args.seed,
+        truncate_rate=args.truncate_rate,
+    )
+    context = multiprocessing.get_context("spawn")
+    urls = context.Queue()
+    server = context.Process(target=serve, args=(config, urls), daemon=True)
+    server.start()
+    url = urls.get(timeout=30)
+    selected = args.only or BENCHMARKS
+    results = []
+    try:
+        for name in selected:
+            if name == "snowbasin_process":
+                runs = [(bench_snowbasin_process, (url, args.iterations, d)) for d in ("probe", "listing")]
+            elif name == "non_round_image_times":
+                runs = [(bench_non_round_image_times, (url, args.iterations, d)) for d in ("probe", "listing")]
+            elif name == "late_upload":
+                runs = [(bench_late_upload, (config, args.iterations))]
+            elif name == "import_time":
+                runs = [(bench_import_time, (m, b)) for m, b in IMPORT_BUDGETS_MS.items()]
+            elif name == "one_day":
+                runs = [
+                    (bench_one_day, (url, 1, "probe")),
+                    (bench_one_day, (url, args.workers, "probe")),
+                    (bench_one_day, (url, args.workers, "listing")),
+                ]
+            else:
+                runs = [(bench_nasa_process, (url, args.iterations, c)) for c in (True, False)]
+            for function, run_args in runs:
+                results.append(run_isolated(context, function, run_args, args.verbose))
+    finally:
+        server.terminate()
+
+    print_results(results)
+    if args.json:
+        with open(os.path.expanduser(args.json), "w") as handler:
+            json.dump(
+                {
+                    "created_at": dt.datetime.now().isoformat(timespec="seconds"),
+                    "config": vars(args),
+                    "results": [result.as_dict() for result in results],
+                },
+                handler,
+                indent=2,
+            )
+    problems = [problem for result in results for problem in result.check()]
+    for problem in problems:
+        Console(stderr=True).print(f"[red]{escape(problem)}")
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
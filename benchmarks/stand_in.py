@@ -0,0 +1,270 @@
+import datetime as dt
+import json
+import multiprocessing
+import random
+import re
+import sys
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BUCKET = "prism-cam-00054"
+IMAGE_PATH = re.compile(r"^/(?P<bucket>[^/]+)/(?P<date>\d{4}/\d{2}/\d{2})/(?P<time>\d{2}-\d{2})/(?P<size>\w+)\.jpg$")
+NASA_PAGE = """<html><head><title>Image of the Day</title></head><body>
+<nav>{padding}</nav>
+<div class="hds-gallery-items"><a href="#"><img src="{image_url}" alt="today"></a></div>
+<footer>{padding}</footer>
+</body></html>"""
+
+
+def slot_for(capture_time: dt.datetime) -> dt.datetime:
+    """
+    the slot a minute belongs to, every 5 minutes from 8am to 6pm and at :05/:20/:35/:50 otherwise
+    """
+    if 8 <= capture_time.hour <= 18:
+        return capture_time + dt.timedelta(minutes=-capture_time.minute % 5)
+    return capture_time + dt.timedelta(minutes=(5 - capture_time.minute) % 15)
+
+
+class StandInConfig:
+    def __init__(
+        self,
+        latency: float = 0.0,
+        latency_jitter: float = 0.0,
+        miss_rate: float = 0.0,
+        capture_offsets: tuple[int, ...] = (2,),
+        capture_jitter: float = 0.0,
+        image_bytes: int = 200 * 1024,
+        page_size: int = 1000,
+        seed: int = 0,
+        truncate_rate: float = 0.0,
+        late_uploads: int = 0,
+    ) -> None:
+        """
+        how the stand-in behaves
+        latency, latency_jitter: seconds every request waits, plus up to latency_jitter more
+        miss_rate: share of slots the camera skipped entirely (404 for every minute)
+        capture_offsets: minutes before the slot the camera usually captures at
+        capture_jitter: share of captures that land on a random minute of the slot instead
+        image_bytes: size of every image
+        page_size: objects per page of the bucket listing
+        truncate_rate: share of image downloads whose connection drops halfway through the body
+        late_uploads: requests every image answers with a 404 before it is published (an image uploaded late)
+        """
+        self.latency: float = latency
+        self.latency_jitter: float = latency_jitter
+        self.miss_rate: float = miss_rate
+        self.capture_offsets: tuple[int, ...] = capture_offsets
+        self.capture_jitter: float = capture_jitter
+        self.image_bytes: int = image_bytes
+        self.page_size: int = page_size
+        self.seed: int = seed
+        self.truncate_rate: float = truncate_rate
+        self.late_uploads: int = late_uploads
+
+
+class QuietServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address) -> None:
+        # the fetchers close the connections of probes that lost the race, that isn't an error
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class StandInServer:
+    def __init__(self, config: StandInConfig | None = None, port: int = 0) -> None:
+        """
+        a local http server that looks like the prism-cam bucket (images and the JSON listing)
+        and the NASA image of the day page
+        bucket images answer Range requests (with If-Range) so cut off downloads can be resumed
+        every request is counted so the benchmarks can report requests per image
+        """
+        self.config: StandInConfig = config or StandInConfig()
+        # starts and ends with the JPEG markers (SOI, EOI), the bytes in between don't matter to the fetchers
+        self.image: bytes = b"\xff\xd8" + b"\x00" * max(self.config.image_bytes - 4, 0) + b"\xff\xd9"
+        self.requests: dict[str, int] = {
+            "image_hit": 0,
+            "image_miss": 0,
+            "image_resume": 0,
+            "listing": 0,
+            "page": 0,
+            "not_modified": 0,
+        }
+        self.lock = threading.Lock()
+        # capture time of every slot we have been asked about
+        self.slots: dict[dt.datetime, dt.datetime | None] = {}
+        # how often every image was requested before it was published, see StandInConfig.late_uploads
+        self.early_requests: dict[dt.datetime, int] = {}
+        self.server = QuietServer(("127.0.0.1", port), self.make_handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self) -> "StandInServer":
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset_counts(self) -> None:
+        with self.lock:
+            self.requests = dict.fromkeys(self.requests, 0)
+
+    def count(self, kind: str) -> None:
+        with self.lock:
+            self.requests[kind] += 1
+
+    def capture_for_slot(self, slot: dt.datetime) -> dt.datetime | None:
+        """
+        the minute the camera captured the slot at, None if it skipped the slot
+        the same slot always gives the same answer
+        """
+        if slot not in self.slots:
+            rng = random.Random(f"{self.config.seed}-{slot.isoformat()}")
+            if rng.random() < self.config.miss_rate:
+                capture = None
+            elif rng.random() < self.config.capture_jitter:
+                capture = slot - dt.timedelta(minutes=rng.randint(0, 4))
+            else:
+                capture = slot - dt.timedelta(minutes=rng.choice(self.config.capture_offsets))
+            self.slots[slot] = capture
+        return self.slots[slot]
+
+    def exists(self, capture_time: dt.datetime) -> bool:
+        return self.capture_for_slot(slot_for(capture_time)) == capture_time
+
+    def published(self, capture_time: dt.datetime) -> bool:
+        """
+        False for the first `late_uploads` requests of an image, counting this one
+        """
+        with self.lock:
+            early = self.early_requests.get(capture_time, 0)
+            if early >= self.config.late_uploads:
+                return True
+            self.early_requests[capture_time] = early + 1
+            return False
+
+    def captures(self, prefix: str) -> list[str]:
+        """
+        the object names of every capture under a YYYY/MM/DD/[HH-] prefix
+        """
+        day = dt.datetime.strptime(prefix[:10], "%Y/%m/%d")
+        names = []
+        for minute in range(24 * 60):
+            capture_time = day + dt.timedelta(minutes=minute)
+            name = f"{capture_time:%Y/%m/%d/%H-%M}/1080.jpg"
+            if name.startswith(prefix) and self.exists(capture_time):
+                names.append(name)
+        return names
+
+    def make_handler(self) -> type[BaseHTTPRequestHandler]:
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # headers and body are written separately, with Nagle's algorithm small replies would wait for an ACK
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args) -> None:
+                pass
+
+            def reply(
+                self,
+                status: int,
+                body: bytes = b"",
+                content_type: str = "image/jpeg",
+                head: bool = False,
+                etag: str | None = None,
+                content_range: str | None = None,
+                truncate: bool = False,
+            ):
+                # the NASA page and image have an ETag, a matching If-None-Match gets an empty 304
+                if etag and self.headers.get("If-None-Match") == etag:
+                    stand_in.count("not_modified")
+                    status, body = 304, b""
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                if etag:
+                    self.send_header("ETag", etag)
+                if content_range:
+                    self.send_header("Content-Range", content_range)
+                self.end_headers()
+                if head:
+                    return
+                if truncate:
+                    # the connection drops after half of the body, Content-Length still promises all of it
+                    self.wfile.write(body[: len(body) // 2])
+                    self.close_connection = True
+                    return
+                self.wfile.write(body)
+
+            def reply_image(self, etag: str, head: bool) -> None:
+                """
+                a bucket image, or the rest of it for a Range request whose If-Range still matches
+                """
+                image = stand_in.image
+                match = re.match(r"^bytes=(\d+)-$", self.headers.get("Range", ""))
+                if match and self.headers.get("If-Range", etag) == etag and int(match[1]) < len(image):
+                    stand_in.count("image_resume")
+                    start = int(match[1])
+                    content_range = f"bytes {start}-{len(image) - 1}/{len(image)}"
+                    return self.reply(206, image[start:], head=head, etag=etag, content_range=content_range)
+                stand_in.count("image_hit")
+                truncate = random.random() < stand_in.config.truncate_rate
+                return self.reply(200, image, head=head, etag=etag, truncate=truncate)
+
+            def do_HEAD(self) -> None:
+                self.do_GET(head=True)
+
+            def do_GET(self, head: bool = False) -> None:
+                config = stand_in.config
+                url = urllib.parse.urlparse(self.path)
+                # the harness reads (and resets) the counts here, these requests aren't counted or delayed
+                if url.path == "/_counts":
+                    counts = json.dumps(stand_in.requests).encode()
+                    if "reset" in url.query:
+                        stand_in.reset_counts()
+                    return self.reply(200, counts, "application/json", head)
+                time.sleep(config.latency + random.random() * config.latency_jitter)
+                if url.path.startswith("/storage/v1/b/"):
+                    stand_in.count("listing")
+                    query = urllib.parse.parse_qs(url.query)
+                    names = stand_in.captures(query.get("prefix", [""])[0])
+                    start = int(query.get("pageToken", ["0"])[0])
+                    listing = {"items": [{"name": n} for n in names[start : start + config.page_size]]}
+                    if start + config.page_size < len(names):
+                        listing["nextPageToken"] = str(start + config.page_size)
+                    return self.reply(200, json.dumps(listing).encode(), "application/json", head)
+                if url.path == "/image-of-the-day/":
+                    stand_in.count("page")
+                    page = NASA_PAGE.format(image_url=f"{stand_in.url}/nasa/image.jpg", padding="x" * 100_000)
+                    return self.reply(200, page.encode(), "text/html", head, etag='"page-1"')
+                if url.path == "/nasa/image.jpg":
+                    stand_in.count("image_hit")
+                    return self.reply(200, stand_in.image, head=head, etag='"image-1"')
+                match = IMAGE_PATH.match(url.path)
+                if match:
+                    capture_time = dt.datetime.strptime(f"{match['date']} {match['time']}", "%Y/%m/%d %H-%M")
+                    if stand_in.exists(capture_time) and stand_in.published(capture_time):
+                        return self.reply_image(f'"{capture_time:%Y%m%d%H%M}"', head)
+                    stand_in.count("image_miss")
+                return self.reply(404, b"", "text/plain", head)
+
+        return Handler
+
+
+def serve(config: StandInConfig, urls: multiprocessing.Queue) -> None:
+    """
+    run the stand-in until the process is terminated, its url is put on `urls`
+    the benchmarks run it in its own process so it doesn't compete with the fetchers for the GIL or show up in their RSS
+    """
+    server = StandInServer(config)
+    urls.put(server.url)
+    server.server.serve_forever()
@@ -0,0 +1,402 @@
+import contextlib
+import datetime as dt
+import glob
+import hashlib
+import os
+import sqlite3
+import threading
+from collections.abc import Iterator
+
+from src.core.dedup import ContentStore
+from src.core.logger import logger
+from src.core.pack import PackedArchive, PackReader, append_to_pack, index_path, pack_path
+
+INDEX_FILE_NAME = "index.sqlite3"
+# the bookkeeping of RetentionPolicy in the state table: when it last ran, the newest row it has seen and the
+# running total of the archive size up to that row (delete keeps the total right for every row it removes)
+RETENTION_LAST_RUN_KEY = "retention_last_run"
+RETENTION_LAST_ID_KEY = "retention_last_id"
+RETENTION_TOTAL_BYTES_KEY = "retention_total_bytes"
+# running count and size of every image in the index, add and delete keep them right so totals is a lookup
+ARCHIVE_IMAGES_KEY = "archive_images"
+ARCHIVE_BYTES_KEY = "archive_bytes"
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    captured_at TEXT NOT NULL,
+    source TEXT NOT NULL,
+    path TEXT NOT NULL UNIQUE,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS images_captured_at ON images (captured_at);
+CREATE INDEX IF NOT EXISTS images_source_captured_at ON images (source, captured_at);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+class ImageArchive:
+    def __init__(self, root: str, content_store: ContentStore | None = None) -> None:
+        """
+        the `old_backgrounds` archive
+        images are sharded by date into root/YYYY/MM/DD/ and every image is recorded in a sqlite index
+        (root/index.sqlite3) with its capture time, source, size and hash
+        so finding what we have for a date is an indexed lookup instead of a directory scan
+        content_store: if given, archive entries are hardlinks into the store so identical images are kept once
+        """
+        self.root: str = os.path.join(os.path.expanduser(root), "")
+        self.content_store: ContentStore | None = content_store
+        os.makedirs(self.root, exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(os.path.join(self.root, INDEX_FILE_NAME), check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(SCHEMA)
+        self.migrate_ids()
+        self.count_totals()
+
+    def migrate_ids(self) -> None:
+        """
+        helper function
+        indexes made before the ids were AUTOINCREMENT hand out the id of a deleted row again,
+        and the retention policy takes every id up to its watermark for a row it has already seen
+        the table is rebuilt once with AUTOINCREMENT, new ids start after the newest row and after the watermark
+        """
+        query = "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'images'"
+        sql = self.connection.execute(query).fetchone()[0]
+        if "AUTOINCREMENT" in sql.upper():
+            return
+        with self.lock, self.connection:
+            self.connection.execute("BEGIN")
+            self.connection.execute(
+                "CREATE TABLE images_new "
+                + sql[sql.index("(") :].replace("INTEGER PRIMARY KEY", "INTEGER PRIMARY KEY AUTOINCREMENT", 1)
+            )
+            self.connection.execute("INSERT INTO images_new SELECT * FROM images")
+            self.connection.execute("DROP TABLE images")
+            self.connection.execute("ALTER TABLE images_new RENAME TO images")
+            self.connection.execute("DELETE FROM sqlite_sequence WHERE name = 'images'")
+            self.connection.execute(
+                "INSERT INTO sqlite_sequence (name, seq) VALUES ('images', MAX("
+                "(SELECT COALESCE(MAX(id), 0) FROM images), "
+                "COALESCE((SELECT CAST(value AS INTEGER) FROM state WHERE key = ?), 0)))",
+                (RETENTION_LAST_ID_KEY,),
+            )
+        # the indexes went with the old table
+        self.connection.executescript(SCHEMA)
+        logger.info(f"[blue]Rebuilt the archive index with ids that are never reused: {self.root}")
+
+    def count_totals(self) -> None:
+        """
+        helper function
+        indexes made before the running totals were kept are counted once, after that add and delete keep them
+        """
+        with self.lock, self.connection:
+            self.connection.execute("BEGIN")
+            if self.connection.execute("SELECT 1 FROM state WHERE key = ?", (ARCHIVE_IMAGES_KEY,)).fetchone():
+                return
+            images, size = self.connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM images").fetchone()
+            self.connection.executemany(
+                "INSERT INTO state (key, value) VALUES (?, ?)",
+                [(ARCHIVE_IMAGES_KEY, str(images)), (ARCHIVE_BYTES_KEY, str(size))],
+            )
+
+    def change_totals(self, images: int, size: int) -> None:
+        """
+        helper function
+        add to the running totals in the state table, called inside the transaction that changed the index
+        """
+        self.connection.executemany(
+            "UPDATE state SET value = CAST(value AS INTEGER) + ? WHERE key = ?",
+            [(images, ARCHIVE_IMAGES_KEY), (size, ARCHIVE_BYTES_KEY)],
+        )
+
+    def shard_directory(self, captured_at: dt.datetime) -> str:
+        """
+        helper function
+        the directory an image taken at `captured_at` belongs in
+        """
+        return os.path.join(self.root, f"{captured_at:%Y}", f"{captured_at:%m}", f"{captured_at:%d}")
+
+    def add(self, file_path: str, captured_at: dt.datetime, source: str, sha256: str | None = None) -> str:
+        """
+        move the file into its shard and record it in the index
+        returns the new path of the file
+        """
+        shard = self.shard_directory(captured_at)
+        os.makedirs(shard, exist_ok=True)
+        new_file_path = os.path.join(shard, os.path.basename(file_path))
+        sha256 = sha256 or self.hash_file(file_path)
+        if self.content_store:
+            self.content_store.link(file_path, new_file_path, sha256)
+        else:
+            os.replace(file_path, new_file_path)
+        relative_path, size = os.path.relpath(new_file_path, self.root), os.path.getsize(new_file_path)
+        with self.lock, self.connection:
+            # a file added again replaces its row, only the difference goes on the totals
+            replaced = self.connection.execute("SELECT size FROM images WHERE path = ?", (relative_path,)).fetchone()
+            self.connection.execute(
+                "INSERT OR REPLACE INTO images (captured_at, source, path, size, sha256) VALUES (?, ?, ?, ?, ?)",
+                (captured_at.isoformat(sep=" "), source, relative_path, size, sha256),
+            )
+            self.change_totals(0 if replaced else 1, size - (replaced["size"] if replaced else 0))
+        return new_file_path
+
+    def images_between(self, start: dt.datetime, end: dt.datetime, source: str | None = None) -> list[sqlite3.Row]:
+        """
+        every image captured in [start, end), oldest first
+        """
+        query = "SELECT * FROM images WHERE captured_at >= ? AND captured_at < ?"
+        params = [start.isoformat(sep=" "), end.isoformat(sep=" ")]
+        if source:
+            query += " AND source = ?"
+            params.append(source)
+        with self.lock:
+            return self.connection.execute(query + " ORDER BY captured_at", params).fetchall()
+
+    def capture_times_between(self, start: dt.datetime, end: dt.datetime, source: str) -> set[dt.datetime]:
+        """
+        the capture times (to the minute) of every image of a source captured in [start, end),
+        the loose ones in the index and the ones compact moved into the packs
+        """
+        capture_times = {
+            dt.datetime.fromisoformat(row["captured_at"]).replace(second=0, microsecond=0)
+            for row in self.images_between(start, end, source)
+        }
+        with PackedArchive(self.root) as packs:
+            capture_times.update(captured_at for captured_at, _ in packs.locations_between(start, end, source))
+        return capture_times
+
+    def iter_images_between(
+        self, start: dt.datetime, end: dt.datetime, source: str | None = None, page_size: int = 1000
+    ) -> Iterator[sqlite3.Row]:
+        """
+        same as images_between, but rows are read a page at a time so a long range never sits in memory
+        """
+        last_captured_at, last_id = start.isoformat(sep=" "), -1
+        while True:
+            query = "SELECT * FROM images WHERE (captured_at > ? OR (captured_at = ? AND id > ?)) AND captured_at < ?"
+            params = [last_captured_at, last_captured_at, last_id, end.isoformat(sep=" ")]
+            if source:
+                query += " AND source = ?"
+                params.append(source)
+            with self.lock:
+                rows = self.connection.execute(
+                    query + " ORDER BY captured_at, id LIMIT ?", [*params, page_size]
+                ).fetchall()
+            yield from rows
+            if len(rows) < page_size:
+                return
+            last_captured_at, last_id = rows[-1]["captured_at"], rows[-1]["id"]
+
+    def images_for_date(self, date: dt.date, source: str | None = None) -> list[sqlite3.Row]:
+        """
+        every image captured on the date, oldest first
+        """
+        start = dt.datetime.combine(date, dt.time())
+        return self.images_between(start, start + dt.timedelta(days=1), source)
+
+    def latest_capture_times(self, limit: int, source: str | None = None) -> list[dt.datetime]:
+        """
+        the capture times of the newest `limit` images, oldest first
+        """
+        query = "SELECT captured_at FROM images"
+        params = []
+        if source:
+            query += " WHERE source = ?"
+            params.append(source)
+        with self.lock:
+            rows = self.connection.execute(query + " ORDER BY captured_at DESC LIMIT ?", [*params, limit]).fetchall()
+        return [dt.datetime.fromisoformat(row["captured_at"]) for row in reversed(rows)]
+
+    def images_added_after(self, after_id: int, up_to_id: int, before: dt.datetime) -> list[sqlite3.Row]:
+        """
+        images indexed after `after_id` (up to and including `up_to_id`) that were captured before `before`
+        """
+        with self.lock:
+            return self.connection.execute(
+                "SELECT * FROM images WHERE id > ? AND id <= ? AND captured_at < ? ORDER BY captured_at",
+                (after_id, up_to_id, before.isoformat(sep=" ")),
+            ).fetchall()
+
+    def oldest(self, limit: int) -> list[sqlite3.Row]:
+        """
+        the oldest `limit` images
+        """
+        with self.lock:
+            return self.connection.execute("SELECT * FROM images ORDER BY captured_at LIMIT ?", (limit,)).fetchall()
+
+    def max_id(self) -> int:
+        """
+        the id of the newest row in the index, 0 if it is empty
+        """
+        with self.lock:
+            return self.connection.execute("SELECT COALESCE(MAX(id), 0) FROM images").fetchone()[0]
+
+    def total_bytes(self, after_id: int = 0, up_to_id: int | None = None) -> int:
+        """
+        bytes used by the images with an id in (after_id, up_to_id]
+        """
+        query = "SELECT COALESCE(SUM(size), 0) FROM images WHERE id > ?"
+        params = [after_id]
+        if up_to_id is not None:
+            query += " AND id <= ?"
+            params.append(up_to_id)
+        with self.lock:
+            return self.connection.execute(query, params).fetchone()[0]
+
+    def totals(self) -> tuple[int, int]:
+        """
+        the number of images in the archive and the bytes they use, read from the running totals
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT key, value FROM state WHERE key IN (?, ?)", (ARCHIVE_IMAGES_KEY, ARCHIVE_BYTES_KEY)
+            ).fetchall()
+        values = {row["key"]: int(row["value"]) for row in rows}
+        return values[ARCHIVE_IMAGES_KEY], values[ARCHIVE_BYTES_KEY]
+
+    def delete(self, rows: list[sqlite3.Row], batch_size: int = 500) -> int:
+        """
+        delete the files and their index rows, the index is updated a batch at a time
+        empty shard directories are removed and the bytes are taken off the retention total if it counted them
+        returns the bytes reclaimed
+        """
+        reclaimed = 0
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start : start + batch_size]
+            for row in batch:
+                file_path = self.full_path(row)
+                reclaimed += row["size"]
+                try:
+                    os.remove(file_path)
+                except FileNotFoundError:
+                    logger.warning(f"[red]Indexed image was already gone: {file_path}")
+            with self.lock, self.connection:
+                counted = self.connection.execute(
+                    "SELECT value FROM state WHERE key = ?", (RETENTION_LAST_ID_KEY,)
+                ).fetchone()
+                counted_up_to = int(counted["value"]) if counted else 0
+                # rows another process already removed aren't on the totals any more
+                ids = [row["id"] for row in batch]
+                images, size = self.connection.execute(
+                    f"SELECT COUNT(*), COALESCE(SUM(size), 0) FROM images WHERE id IN ({', '.join('?' * len(ids))})",
+                    ids,
+                ).fetchone()
+                self.connection.executemany("DELETE FROM images WHERE id = ?", [(row_id,) for row_id in ids])
+                self.change_totals(-images, -size)
+                self.connection.execute(
+                    "UPDATE state SET value = CAST(value AS INTEGER) - ? WHERE key = ?",
+                    (sum(row["size"] for row in batch if row["id"] <= counted_up_to), RETENTION_TOTAL_BYTES_KEY),
+                )
+            if self.content_store:
+                for sha256 in {row["sha256"] for row in batch}:
+                    self.content_store.release(sha256)
+        for directory in {os.path.dirname(self.full_path(row)) for row in rows}:
+            # removes the day, month and year directories as long as they are empty
+            with contextlib.suppress(OSError):
+                os.removedirs(directory)
+        return reclaimed
+
+    def compact(self, before: dt.date, source: str | None = None) -> tuple[int, int]:
+        """
+        move every image captured before `before` into the append-only packs (packs/SOURCE/YYYY-MM.pack),
+        one day at a time, and read them back with PackedArchive
+        a day's loose files and index rows are removed once its images are synced to the pack
+        (if that was interrupted, images already in the pack aren't added again)
+        packed images are done, the retention policy no longer thins them
+        returns the number of images packed and the bytes appended to the packs
+        """
+        query = "SELECT DISTINCT source, substr(captured_at, 1, 10) AS day FROM images WHERE captured_at < ?"
+        params = [dt.datetime.combine(before, dt.time()).isoformat(sep=" ")]
+        if source:
+            query += " AND source = ?"
+            params.append(source)
+        with self.lock:
+            days = self.connection.execute(query + " ORDER BY day, source", params).fetchall()
+        images = appended = 0
+        for row_source, day in days:
+            rows = self.images_for_date(dt.date.fromisoformat(day), row_source)
+            file_path = pack_path(self.root, row_source, dt.datetime.fromisoformat(day))
+            already_packed = set()
+            if os.path.exists(index_path(file_path)):
+                with PackReader(file_path) as reader:
+                    already_packed = {
+                        row["id"] for row in rows if dt.datetime.fromisoformat(row["captured_at"]) in reader
+                    }
+            to_pack = []
+            for row in rows:
+                if row["id"] in already_packed:
+                    continue
+                if not os.path.exists(self.full_path(row)):
+                    logger.warning(f"[red]Indexed image is gone, it isn't packed: {self.full_path(row)}")
+                    continue
+                to_pack.append((dt.datetime.fromisoformat(row["captured_at"]), self.full_path(row), row["sha256"]))
+            appended += append_to_pack(file_path, to_pack)
+            images += len(to_pack)
+            self.delete(rows)
+            logger.info(f"[blue]Packed {len(to_pack)} {row_source} images from {day} into {file_path}")
+        logger.info(f"[green]Packed {images} images ({appended / 1024**2:.1f} MB) from {len(days)} days")
+        return images, appended
+
+    def dedup_ratio(self) -> float:
+        """
+        archive entries per unique image, 1.0 means there are no duplicates
+        """
+        with self.lock:
+            entries, unique = self.connection.execute("SELECT COUNT(*), COUNT(DISTINCT sha256) FROM images").fetchone()
+        return entries / unique if unique else 1.0
+
+    def get_state(self, key: str) -> str | None:
+        """
+        read a value from the state table, used to keep bookkeeping between runs
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return row["value"] if row else None
+
+    def set_state(self, key: str, value: str) -> None:
+        """
+        write a value to the state table
+        """
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, value))
+
+    def full_path(self, row: sqlite3.Row) -> str:
+        """
+        helper function
+        absolute path of an indexed image
+        """
+        return os.path.join(self.root, row["path"])
+
+    def migrate_flat(self, source: str) -> int:
+        """
+        one time migration of a flat archive (every image directly in root) into the sharded layout
+        files that aren't named YYYY-MM-DD-HH-MM.jpg are left where they are
+        returns the number of images moved
+        """
+        moved = 0
+        for file_path in sorted(glob.glob(os.path.join(self.root, "*.jpg"))):
+            try:
+                captured_at = dt.datetime.strptime(os.path.basename(file_path), "%Y-%m-%d-%H-%M.jpg")
+            except ValueError:
+                logger.warning(f"[red]Skipping file that isn't named by date: {file_path}")
+                continue
+            self.add(file_path, captured_at, source)
+            moved += 1
+        logger.info(f"[blue]Migrated {moved} images into the sharded archive: {self.root}")
+        return moved
+
+    @staticmethod
+    def hash_file(file_path: str) -> str:
+        """
+        helper function
+        sha256 of a file, read in chunks
+        """
+        checksum = hashlib.sha256()
+        with open(file_path, "rb") as handler:
+            for chunk in iter(lambda: handler.read(64 * 1024), b""):
+                checksum.update(chunk)
+        return checksum.hexdigest()
@@ -0,0 +1,38 @@
+import contextlib
+import os
+import tempfile
+from collections.abc import Iterator
+from contextlib import contextmanager
+from typing import IO
+
+
+@contextmanager
+def atomic_path(file_path: str) -> Iterator[str]:
+    """
+    a temp file next to `file_path` to write however you like, it is renamed into place when the block is done
+    the rename is atomic, readers see the old file or the new one but never half of one
+    if the block raises, the temp file is removed and `file_path` is left alone
+    the temp file is hidden and ends in .part, so it is never picked up as an image
+    """
+    file_path = os.path.expanduser(file_path)
+    directory = os.path.dirname(file_path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".part")
+    os.close(fd)
+    try:
+        yield temp_path
+        os.replace(temp_path, file_path)
+    except BaseException:
+        # the block may have removed or replaced it already
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temp_path)
+        raise
+
+
+@contextmanager
+def atomic_write(file_path: str, mode: str = "w") -> Iterator[IO]:
+    """
+    same as atomic_path, with the temp file opened in `mode`
+    """
+    with atomic_path(file_path) as temp_path, open(temp_path, mode) as handler:
+        yield handler
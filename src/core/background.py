@@ -1,13 +1,29 @@
 import datetime as dt
-import glob
+import hashlib
 import os
+import time
+from typing import TYPE_CHECKING, BinaryIO
 
-import requests
-from rich.traceback import install
-
+from src.core.archive import ImageArchive
+from src.core.atomic import atomic_path
+from src.core.dedup import ContentStore, is_similar
+from src.core.http_cache import HttpCache
+from src.core.integrity import RESUME_ATTEMPTS, expected_size, jpeg_problem
 from src.core.logger import logger
+from src.core.metrics import Metrics
+from src.core.rate_limit import RateLimiter
+from src.core.retention import RetentionPolicy
+from src.core.state import BackgroundState
+
+# requests is only imported once the first request is made, see BackgroundImageFetcher.session
+if TYPE_CHECKING:
+    import requests
 
-install(show_locals=False)
+    from src.core.session import PooledSession
+    from src.core.variants import VariantPipeline
+
+# bytes read from the response at a time when writing an image to disk
+CHUNK_SIZE = 64 * 1024
 
 
 class PostInitCaller(type):
@@ -24,6 +40,16 @@ class BackgroundImageFetcher(metaclass=PostInitCaller):
         self,
         background_directory: str = None,
         store_previous_images: bool = True,
+        session: "PooledSession | None" = None,
+        source_name: str = "web",
+        retention_policy: RetentionPolicy | None = None,
+        dedup: bool = False,
+        similarity_threshold: int | None = None,
+        variant_pipeline: "VariantPipeline | None" = None,
+        metrics: Metrics | None = None,
+        http_cache: HttpCache | None = None,
+        rate_limiter: RateLimiter | None = None,
+        metrics_label: str | None = None,
     ) -> None:
         """
         initialize the class
@@ -31,10 +57,65 @@ class BackgroundImageFetcher(metaclass=PostInitCaller):
         store_previous_images: if True, the previous image will be moved to a folder called `old_backgrounds`
          - This is an absolute path.
         Example for Mac: ~/Desktop/backgrounds/
+        session: connection pool used for every request, pass one in to share it between fetchers
+        source_name: recorded in the archive index for every image we archive
+        retention_policy: thins and caps the archive after every image is archived, None keeps everything
+        dedup: if True, the archive keeps identical images once (see ContentStore)
+         and a new image that is byte-identical to the current background isn't kept
+        similarity_threshold: if set, a new image whose perceptual hash is within this many bits
+         of the current background isn't kept either (needs Pillow)
+        variant_pipeline: renders every new image into resized copies for other displays
+        metrics: stage timings and request counters, pass one in to share it between fetchers
+        http_cache: if set, images are requested conditionally (ETag / Last-Modified)
+         and a 304 means the image we have is still the newest
+        rate_limiter: if set, every request waits for it (requests and bytes per second, shared between processes)
+         set `background_requests` on a fetcher that only does background work (backfills, scrub),
+         its requests then leave the live reserve of the limiter alone
+        metrics_label: the `source` label of our metrics, defaults to source_name
+         (the daemon passes the name of each source, so two feeds of the same kind don't share their series)
         """
-        self.background_file_path: str = background_directory or os.path.expanduser("~/Desktop/backgrounds/")
+        # expanded once, so every path we build compares equal to the ones read back from the state file
+        self.background_file_path: str = os.path.expanduser(background_directory or "~/Desktop/backgrounds/")
         self.store_previous_images: bool = store_previous_images
         self.current_image_date: dt.date | None = None
+        # the capture time of the newest image we checked, later than current_image_date after a skipped duplicate
+        self.seen_image_date: dt.date | None = None
+        self._session: PooledSession | None = session
+        self.source_name: str = source_name
+        self.metrics_label: str = metrics_label or source_name
+        self.archive: ImageArchive | None = None
+        self.retention_policy: RetentionPolicy | None = retention_policy
+        self.dedup: bool = dedup
+        self.similarity_threshold: int | None = similarity_threshold
+        self.duplicates_skipped: int = 0
+        self.variant_pipeline: VariantPipeline | None = variant_pipeline
+        self.metrics: Metrics = metrics or Metrics()
+        self.http_cache: HttpCache | None = http_cache
+        self.rate_limiter: RateLimiter | None = rate_limiter
+        self.background_requests: bool = False
+        self.state: BackgroundState = BackgroundState(self.background_file_path)
+        if session:
+            self.metrics.track_session(session)
+
+    @property
+    def session(self) -> "PooledSession":
+        """
+        the connection pool used for every request
+        it is created on first use, so a run that has nothing to download never imports requests
+        """
+        if self._session is None:
+            from src.core.session import PooledSession
+
+            self._session = PooledSession()
+            self.metrics.track_session(self._session)
+        return self._session
+
+    def log_pool_stats(self) -> None:
+        """
+        log the connection pool stats, if we made a request at all
+        """
+        if self._session is not None:
+            self._session.log_pool_stats()
 
     def __post_init__(self) -> None:
         """
@@ -57,54 +138,125 @@ class BackgroundImageFetcher(metaclass=PostInitCaller):
     def check_directory_structure(self) -> None:
         """
         checks the directory structure or `old_backgrounds` and creates a few files if needed
+        `old_backgrounds` is sharded by date (YYYY/MM/DD/) and indexed, see ImageArchive
         """
         logger.info("[yellow]Checking the directory structure. Will add `old_backgrounds` if needed...")
         if self.store_previous_images:
-            os.makedirs(os.path.expanduser(f"{self.background_file_path}old_backgrounds/"), exist_ok=True)
+            self.archive = self.make_archive()
+
+    def make_archive(self) -> ImageArchive:
+        """
+        helper function
+        the archive in `old_backgrounds`, with a content store in `old_backgrounds/objects` when dedup is on
+        """
+        archive_path = f"{self.background_file_path}old_backgrounds/"
+        return ImageArchive(archive_path, ContentStore(f"{archive_path}objects/") if self.dedup else None)
 
-    def process(self, url_to_get: str) -> None:
+    def is_duplicate_of_current(self, new_file_path: str, current_file: str, new_sha256: str | None = None) -> bool:
+        """
+        True if the new image shouldn't replace the current background because it is
+        byte-identical to it (dedup) or looks the same (similarity_threshold)
+        """
+        if not current_file or not os.path.exists(current_file):
+            return False
+        if self.dedup and (new_sha256 or ImageArchive.hash_file(new_file_path)) == ImageArchive.hash_file(current_file):
+            logger.info("[yellow]New image is identical to the current background")
+            return True
+        if self.similarity_threshold is not None and is_similar(
+            os.path.expanduser(new_file_path), current_file, self.similarity_threshold
+        ):
+            logger.info("[yellow]New image looks the same as the current background")
+            return True
+        return False
+
+    def skip_duplicate(self, new_file_path: str, captured_at: dt.datetime | None = None) -> None:
+        """
+        helper function
+        remove a new image we decided not to keep and report how many we have skipped
+        captured_at: its capture time, recorded as seen so the next run looks past it instead of fetching it again
+        """
+        self.delete_file(os.path.expanduser(new_file_path))
+        if captured_at:
+            self.state.mark_seen(captured_at)
+            self.seen_image_date = captured_at
+        self.duplicates_skipped += 1
+        logger.info(f"[yellow]Skipped {new_file_path} ({self.duplicates_skipped} duplicates skipped so far)")
+
+    def process(self, url_to_get: str) -> bool:
         """
         main process function
+        the folder is locked while we update it, if another run is already updating it we skip this cycle
+        """
+        with self.state.lock() as acquired:
+            if not acquired:
+                logger.info(f"[yellow]Another run is updating {self.background_file_path}, skipping this cycle")
+                return False
+            return self.update_background(url_to_get)
+
+    def update_background(self, url_to_get: str) -> bool:
+        """
+        helper function
+        the steps of `process`, called with the folder locked
         """
         # Step 1
-        current_file = self.get_current_files_in_directory()
+        with self.metrics.stage("scan", source=self.metrics_label):
+            current_file = self.get_current_files_in_directory()
         if not current_file:
             logger.info("[yellow]No image found in the directory")
         elif current_file == self.make_file_path_string(dt.date.today()):
             logger.info(f"[yellow]Image already exists: {current_file}")
             return False
         # Step 2
-        new_image = self.pull_image_from_web(url_to_get)
+        with self.metrics.stage("fetch", source=self.metrics_label):
+            new_image = self.pull_image_from_web(url_to_get)
+        if new_image.status_code == 304:
+            new_image.close()
+            logger.info(f"[yellow]Image hasn't changed since we downloaded it: {url_to_get}")
+            return False
         logger.info(f"[blue]Pulled image from the web: {url_to_get}")
         # Step 3
-        self.write_image_to_file(new_image, self.make_file_path_string(dt.date.today()))
+        try:
+            new_sha256 = self.save_image(new_image, self.make_file_path_string(dt.date.today()))
+        except ValueError as e:
+            logger.error(f"[red]{e}")
+            return False
         logger.info(f"[blue]Wrote image to file: {self.make_file_path_string(dt.date.today())}")
+        duplicate = self.is_duplicate_of_current(self.make_file_path_string(dt.date.today()), current_file, new_sha256)
+        if self.http_cache:
+            # a skipped duplicate is deleted, the validator then belongs to the current file that stands in for it
+            file_path = current_file if duplicate else self.make_file_path_string(dt.date.today())
+            self.http_cache.remember(url_to_get, new_image, file=os.path.expanduser(file_path))
+        if duplicate:
+            self.skip_duplicate(self.make_file_path_string(dt.date.today()))
+            return False
+        if self.variant_pipeline:
+            self.variant_pipeline.submit(self.make_file_path_string(dt.date.today()))
         if current_file:
-            if self.store_previous_images:
-                self.move_last_image(current_file)
-                logger.info(f"[blue]Moved last image to old_backgrounds: {current_file}")
-            else:
-                self.delete_file(current_file)
-                logger.info(f"[blue]Deleted last image: {current_file}")
-
+            with self.metrics.stage("archive", source=self.metrics_label):
+                if self.store_previous_images:
+                    self.move_last_image(current_file)
+                    logger.info(f"[blue]Moved last image to old_backgrounds: {current_file}")
+                else:
+                    self.delete_file(current_file)
+                    logger.info(f"[blue]Deleted last image: {current_file}")
+        self.state.save(self.make_file_path_string(dt.date.today()), dt.datetime.combine(dt.date.today(), dt.time()))
         return True
 
     def get_current_files_in_directory(self) -> str:
         """
         Step 1
-        returns the current file in the backgrounds folder
-        if there is more than 1 file, it will raise an error
-        """
-        # Use glob to get a list of files in the directory matching the pattern
-        files = glob.glob(os.path.join(os.path.expanduser(self.background_file_path), "*.jpg"))
-        if len(files) > 1:
-            logger.error(f"[red]More than one file in the directory: {files}")
-            raise OSError("More than one file in the directory")
-        if files:
-            self.current_image_date = self.make_date_from_file_string(files[0].split("/")[-1])
-            return files[0]
-        else:
+        returns the current file in the backgrounds folder, read from the state file
+        the folder is only scanned (and the state written) when there is no state yet, see BackgroundState
+        """
+        current = self.state.load()
+        if current is None:
+            current = self.state.scan()
+            if current:
+                self.state.save(*current)
+        if not current:
             return ""
+        current_file, self.current_image_date, self.seen_image_date = current
+        return current_file
 
     @staticmethod
     def make_date_from_file_string(file_name: str) -> dt.datetime:
@@ -113,24 +265,28 @@ class BackgroundImageFetcher(metaclass=PostInitCaller):
         """
         return dt.datetime.strptime(file_name, "%Y-%m-%d-%H-%M.jpg")
 
-    def move_last_image(self, old_file_path: str) -> None:
+    def move_last_image(self, old_file_path: str) -> str | None:
         """
         Step 4-a
-        move the older image file to the archive folder
-        """
-        old_file_name = os.path.basename(old_file_path)
-        new_backgrounds_path = os.path.expanduser(f"{self.background_file_path}old_backgrounds/")
-        # check if the directory exists
-        if not os.path.exists(new_backgrounds_path):
-            logger.info(f"[blue]File not found: {new_backgrounds_path}. Creating directories and file.")
-            os.makedirs(new_backgrounds_path, exist_ok=True)
+        move the older image file to the archive folder (old_backgrounds/YYYY/MM/DD/) and index it
+        then run the retention policy, if there is one
+        returns the path of the image in the archive, None if there was nothing to archive
+        """
         if not os.path.exists(old_file_path):
-            logger.info(f"[blue]File not found: {old_file_path}. Creating directories and file.")
-            os.makedirs(old_file_path, exist_ok=True)
-        # set the new file path
-        new_file_path = os.path.join(new_backgrounds_path, old_file_name)
-        # move the file
-        os.rename(old_file_path, new_file_path)
+            logger.info(f"[blue]File not found: {old_file_path}. Nothing to archive.")
+            return None
+        if self.archive is None:
+            self.archive = self.make_archive()
+        captured_at = self.make_date_from_file_string(os.path.basename(old_file_path))
+        archived_path = self.archive.add(old_file_path, captured_at, self.source_name)
+        if self.dedup:
+            logger.info(f"[blue]Archive dedup ratio: {self.archive.dedup_ratio():.2f}")
+        if self.retention_policy:
+            self.retention_policy.apply(self.archive)
+        images, size = self.archive.totals()
+        self.metrics.set("archive_images", images, source=self.metrics_label)
+        self.metrics.set("archive_bytes", size, source=self.metrics_label)
+        return archived_path
 
     @staticmethod
     def delete_file(old_file_path: str) -> None:
@@ -162,22 +318,148 @@ class BackgroundImageFetcher(metaclass=PostInitCaller):
             f"{date.strftime('%M')}.jpg"
         )
 
-    @staticmethod
-    def pull_image_from_web(image_url: str) -> requests.Response:
+    def pull_image_from_web(
+        self, image_url: str, stream: bool = True, background: bool | None = None
+    ) -> "requests.Response":
+        """
+        helper function
+        pull an image from the web using the shared connection pool
+        stream: if True only the headers are read, the body is downloaded when it is written to disk
+        with an http cache the request is conditional, a 304 means the image we have is still the newest
+        background: wait for the rate limiter like background work, defaults to `background_requests`
+        """
+        headers = self.http_cache.headers_for(image_url) if self.http_cache else None
+        self.wait_for_rate_limit(background)
+        response = self.session.get(image_url, stream=stream, headers=headers)
+        self.count_response_bytes(response, stream)
+        return response
+
+    def wait_for_rate_limit(self, background: bool | None = None) -> None:
         """
         helper function
-        pull an image from the web
+        wait until the rate limiter allows another request, if there is one
         """
-        return requests.get(image_url, timeout=10)
+        if self.rate_limiter is None:
+            return
+        waited = self.rate_limiter.acquire(self.background_requests if background is None else background)
+        if waited:
+            self.metrics.inc("rate_limit_wait_seconds_total", waited, source=self.metrics_label)
+
+    def count_response_bytes(self, response: "requests.Response", stream: bool = True) -> None:
+        """
+        helper function
+        take the body of a response from the byte bucket of the rate limiter
+        a streamed body is counted by its Content-Length, before it is read
+        """
+        if self.rate_limiter is None:
+            return
+        self.rate_limiter.consume_bytes((expected_size(response) or 0) if stream else len(response.content))
+
+    def save_image(
+        self, image_response_object: "requests.Response", file_path: str, background: bool | None = None
+    ) -> str:
+        """
+        helper function
+        write the image to disk (see write_image_to_file) and count it in the metrics
+        the body is streamed while it is written, so this is where the download time goes
+        background: passed on to write_image_to_file
+        returns the sha256 of the image
+        """
+        with self.metrics.stage("download", source=self.metrics_label):
+            sha256 = self.write_image_to_file(image_response_object, file_path, background)
+        self.metrics.inc("images_total", source=self.metrics_label)
+        self.metrics.inc("image_bytes_total", os.path.getsize(os.path.expanduser(file_path)), source=self.metrics_label)
+        self.metrics.set("last_image_timestamp_seconds", time.time(), source=self.metrics_label)
+        return sha256
+
+    def write_image_to_file(
+        self, image_response_object: "requests.Response", file_path: str, background: bool | None = None
+    ) -> str:
+        """
+        helper function
+        stream the image to a temp file next to `file_path` and rename it into place
+        the rename is atomic, so a crash never leaves a half written .jpg behind
+        a body that is cut short (by its Content-Length or a dropped connection) is resumed with a Range request,
+        then the file is checked (see jpeg_problem) and a bad image raises ValueError instead of being kept
+        background: the resumes wait for the rate limiter like the request that started the download did
+        returns the sha256 of the image
+        """
+        file_path = os.path.expanduser(file_path)
+        checksum = hashlib.sha256()
+        size = expected_size(image_response_object)
+        # the temp file is hidden and doesn't end in .jpg so it is never picked up as the current background
+        try:
+            with atomic_path(file_path) as temp_path:
+                with open(temp_path, "wb") as handler:
+                    written, cut_short = self.stream_to_file(image_response_object, handler, checksum, 0)
+                    for _ in range(RESUME_ATTEMPTS):
+                        if not cut_short and (size is None or written >= size):
+                            break
+                        response = self.resume_download(image_response_object, written, background)
+                        if response is None:
+                            break
+                        written, cut_short = self.stream_to_file(response, handler, checksum, written)
+                    handler.flush()
+                    os.fsync(handler.fileno())
+                problem = jpeg_problem(temp_path, size)
+                if problem:
+                    self.metrics.inc("corrupt_downloads_total", source=self.metrics_label)
+                    raise ValueError(f"Bad image from {image_response_object.url}: {problem}")
+        finally:
+            image_response_object.close()
+        return checksum.hexdigest()
 
     @staticmethod
-    def write_image_to_file(image_response_object: requests.Response, file_path: str) -> None:
+    def stream_to_file(response: "requests.Response", handler: BinaryIO, checksum, written: int) -> tuple[int, bool]:
         """
         helper function
-        write the image to a file
+        append the body of the response to the file and the checksum, the response is closed afterwards
+        returns the bytes written so far and whether the connection dropped before the body was done
         """
-        with open(os.path.expanduser(file_path), "wb") as handler:
-            handler.write(image_response_object.content)
+        import requests
+
+        try:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                handler.write(chunk)
+                checksum.update(chunk)
+                written += len(chunk)
+        except requests.RequestException as e:
+            logger.warning(f"[yellow]Download of {response.url} failed after {written} bytes: {e}")
+            return written, True
+        finally:
+            response.close()
+        return written, False
+
+    def resume_download(
+        self, image_response_object: "requests.Response", start: int, background: bool | None = None
+    ) -> "requests.Response | None":
+        """
+        helper function
+        ask for the rest of an image whose download was cut short, from byte `start` on
+        If-Range makes sure the rest belongs to the same image, if it changed (or the server ignores Range)
+        we don't get a 206 and return None
+        background: wait for the rate limiter like background work, defaults to `background_requests`
+        """
+        import requests
+
+        headers = {"Range": f"bytes={start}-"}
+        validator = image_response_object.headers.get("ETag") or image_response_object.headers.get("Last-Modified")
+        if validator:
+            headers["If-Range"] = validator
+        logger.info(f"[yellow]Resuming {image_response_object.url} from byte {start}")
+        self.metrics.inc("download_resumes_total", source=self.metrics_label)
+        self.wait_for_rate_limit(background)
+        try:
+            response = self.session.get(image_response_object.url, stream=True, headers=headers)
+            self.count_response_bytes(response)
+        except requests.RequestException as e:
+            logger.warning(f"[red]Could not resume {image_response_object.url}: {e}")
+            return None
+        if response.status_code != 206 or not response.headers.get("Content-Range", "").startswith(f"bytes {start}-"):
+            logger.warning(f"[red]Server didn't resume {image_response_object.url} (status {response.status_code})")
+            response.close()
+            return None
+        return response
 
     @staticmethod
     def parse_date_values(date: dt.datetime) -> tuple[str]:
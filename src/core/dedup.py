@@ -0,0 +1,86 @@
+import os
+import shutil
+
+from src.core.logger import logger
+
+
+class ContentStore:
+    def __init__(self, root: str) -> None:
+        """
+        content-addressed storage for archived images
+        every unique image is stored once as root/ab/abcdef....jpg (keyed by its sha256)
+        and archive entries are hardlinks to it, so byte-identical frames only take up space once
+        """
+        self.root: str = os.path.join(os.path.expanduser(root), "")
+        os.makedirs(self.root, exist_ok=True)
+
+    def object_path(self, sha256: str) -> str:
+        """
+        helper function
+        where the image with the given hash is stored
+        """
+        return os.path.join(self.root, sha256[:2], f"{sha256}.jpg")
+
+    def link(self, file_path: str, destination: str, sha256: str) -> bool:
+        """
+        store the file (if we don't have it yet) and hardlink it to `destination`
+        `file_path` is consumed either way
+        returns True if the image was already in the store
+        """
+        object_path = self.object_path(sha256)
+        duplicate = os.path.exists(object_path)
+        if duplicate:
+            os.remove(file_path)
+        else:
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            os.replace(file_path, object_path)
+        try:
+            os.link(object_path, destination)
+        except OSError:
+            # the filesystem doesn't support hardlinks, fall back to a copy
+            shutil.copy2(object_path, destination)
+        return duplicate
+
+    def release(self, sha256: str) -> None:
+        """
+        remove the stored image once no archive entry links to it anymore
+        """
+        object_path = self.object_path(sha256)
+        if os.path.exists(object_path) and os.stat(object_path).st_nlink <= 1:
+            os.remove(object_path)
+
+
+def perceptual_hash(file_path: str, hash_size: int = 8) -> int | None:
+    """
+    difference hash (dHash) of an image, similar images have hashes that differ in only a few bits
+    returns None if Pillow isn't installed
+    """
+    # Pillow is optional, without it only byte-identical frames are deduplicated
+    # it is imported here so runs that never compare images don't pay for it on start up
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    with Image.open(file_path) as image:
+        # draft lets the JPEG decoder scale down while decoding, so we never decode the full image
+        image.draft("L", (hash_size * 8, hash_size * 8))
+        pixels = list(image.convert("L").resize((hash_size + 1, hash_size)).getdata())
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            bits = bits << 1 | (pixels[row * (hash_size + 1) + col] > pixels[row * (hash_size + 1) + col + 1])
+    return bits
+
+
+def is_similar(file_path: str, other_file_path: str, max_distance: int) -> bool:
+    """
+    True if the perceptual hashes of the two images differ in at most `max_distance` bits
+    always False if Pillow isn't installed
+    """
+    first, second = perceptual_hash(file_path), perceptual_hash(other_file_path)
+    if first is None or second is None:
+        logger.warning("[red]Pillow isn't installed, skipping the similar image check")
+        return False
+    distance = bin(first ^ second).count("1")
+    logger.info(f"[blue]Perceptual hash distance to the current background: {distance}")
+    return distance <= max_distance
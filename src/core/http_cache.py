@@ -0,0 +1,66 @@
+import json
+import os
+from typing import TYPE_CHECKING
+
+from src.core.atomic import atomic_write
+from src.core.logger import logger
+
+if TYPE_CHECKING:
+    import requests
+
+
+class HttpCache:
+    def __init__(self, file_path: str) -> None:
+        """
+        the ETag and Last-Modified of the urls we fetched, kept in a small JSON file between runs
+        so the next request for the same url can be conditional (If-None-Match / If-Modified-Since)
+        and an unchanged url costs a 304 instead of a download
+        every url can store a few extra values next to its validators, e.g. the image a page pointed to
+        """
+        self.file_path: str = os.path.expanduser(file_path)
+        self.entries: dict[str, dict] = {}
+        try:
+            with open(self.file_path) as handler:
+                self.entries = json.load(handler)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning(f"[red]Ignoring unreadable http cache {self.file_path}: {e}")
+
+    def get(self, url: str) -> dict:
+        """
+        what we stored for the url, empty if we never fetched it
+        """
+        return self.entries.get(url, {})
+
+    def headers_for(self, url: str) -> dict[str, str]:
+        """
+        the conditional request headers for the url
+        if the entry belongs to a file that is gone we ask for the whole response again
+        """
+        entry = self.get(url)
+        if entry.get("file") and not os.path.exists(entry["file"]):
+            return {}
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def remember(self, url: str, response: "requests.Response", **extra) -> None:
+        """
+        store the validators of a 200 response, with any extra values
+        """
+        self.entries[url] = {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            **extra,
+        }
+
+    def save(self) -> None:
+        """
+        write the cache, the file is replaced atomically
+        """
+        with atomic_write(self.file_path) as handler:
+            json.dump(self.entries, handler, indent=2)
@@ -0,0 +1,49 @@
+import os
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import requests
+
+# every JPEG starts with the start of image marker and ends with the end of image marker
+SOI = b"\xff\xd8"
+EOI = b"\xff\xd9"
+# some encoders pad the file after the end of image marker, we look for it in the last few bytes
+TAIL_BYTES = 32
+# how many times a download that was cut short is resumed before we give up on it
+RESUME_ATTEMPTS = 3
+
+
+def expected_size(response: "requests.Response") -> int | None:
+    """
+    helper function
+    the size of the body from its Content-Length, None if we can't know it
+    (no header, or an encoded body that requests decodes on the fly)
+    """
+    if response.headers.get("Content-Encoding", "identity") != "identity":
+        return None
+    try:
+        return int(response.headers["Content-Length"])
+    except (KeyError, ValueError):
+        return None
+
+
+def jpeg_problem(file_path: str, size: int | None = None) -> str | None:
+    """
+    cheap structural check of a JPEG, the image is never decoded
+    the file has to be `size` bytes (if given), start with SOI and end with EOI (padding after it is allowed)
+    returns what is wrong with the file, None if it looks whole
+    """
+    actual_size = os.path.getsize(file_path)
+    if size is not None and actual_size != size:
+        return f"{actual_size} bytes instead of {size}"
+    if actual_size < len(SOI) + len(EOI):
+        return f"only {actual_size} bytes"
+    with open(file_path, "rb") as handler:
+        head = handler.read(len(SOI))
+        handler.seek(-min(actual_size, TAIL_BYTES), os.SEEK_END)
+        tail = handler.read()
+    if head != SOI:
+        return "no start of image marker"
+    if not tail.rstrip(b"\x00\r\n\t ").endswith(EOI):
+        return "no end of image marker"
+    return None
@@ -1,15 +1,74 @@
+import json
 import logging
+import os
+import re
+import sys
 
-from rich.logging import RichHandler
+# the colors we use in log messages, they are Rich markup and are stripped when Rich isn't used
+MARKUP = re.compile(r"\[(?:/|/?(?:blue|green|yellow|red))\]")
+LOG_FORMATS = ("auto", "rich", "plain", "json")
 
-logging.basicConfig(
-    level="NOTSET",
-    format="%(message)s",
-    handlers=[RichHandler(markup=True)],
-)
+
+class PlainFormatter(logging.Formatter):
+    def __init__(self) -> None:
+        """
+        one line per message with a timestamp and the level, for cron and log files
+        """
+        super().__init__("%(asctime)s %(levelname)s %(message)s")
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        return MARKUP.sub("", super().formatMessage(record))
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        """
+        one JSON object per message, for log shippers
+        """
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": MARKUP.sub("", record.getMessage()),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+def configure_logging(log_format: str | None = None) -> None:
+    """
+    set up logging for the whole process
+    log_format: "rich" for colors and pretty tracebacks, "plain" or "json" for cron,
+     "auto" picks rich when stderr is a terminal and plain otherwise
+     defaults to the BACKGROUNDS_LOG_FORMAT environment variable, then "auto"
+    Rich is only imported when it is used, so a run from cron doesn't pay for it on start up
+    the level is NOTSET with rich (everything, like before) and INFO otherwise, BACKGROUNDS_LOG_LEVEL overrides it
+    """
+    log_format = log_format or os.environ.get("BACKGROUNDS_LOG_FORMAT", "auto")
+    if log_format == "auto":
+        log_format = "rich" if sys.stderr.isatty() else "plain"
+    if log_format not in LOG_FORMATS:
+        raise ValueError(f"Unknown log format: {log_format}")
+    level = os.environ.get("BACKGROUNDS_LOG_LEVEL", "NOTSET" if log_format == "rich" else "INFO")
+    if log_format == "rich":
+        from rich.logging import RichHandler
+        from rich.traceback import install
+
+        handler = RichHandler(markup=True)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        install(show_locals=False)
+    else:
+        handler = logging.StreamHandler()
+        handler.setFormatter(PlainFormatter() if log_format == "plain" else JsonFormatter())
+    logging.basicConfig(level=level, handlers=[handler], force=True)
+
+
+configure_logging()
 logger = logging.getLogger("rich")
 
 """
 We like to use rich for logging and for traceback
 it provides a nicer output
+when we aren't in a terminal (e.g. cron) we log plain lines or JSON instead
 """
@@ -0,0 +1,169 @@
+import json
+import os
+import threading
+import time
+import urllib.parse
+from collections.abc import Iterator
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
+
+from src.core.atomic import atomic_write
+
+if TYPE_CHECKING:
+    import requests
+
+# every metric name starts with this, so they are easy to find next to the node exporter's own
+NAMESPACE = "backgrounds"
+
+Labels = tuple[tuple[str, str], ...]
+
+
+class Metrics:
+    def __init__(self, namespace: str = NAMESPACE) -> None:
+        """
+        counters, gauges and timings of the fetchers, exported as a Prometheus textfile or a JSON snapshot
+        every metric can carry labels (e.g. source="snowbasin", stage="probe")
+        it is safe to share between threads, the daemon uses one for every source
+        """
+        self.namespace: str = namespace
+        # metric name -> "counter", "gauge" or "summary"
+        self.types: dict[str, str] = {}
+        # series name -> labels -> value, a summary is stored as its _sum and _count series
+        self.series: dict[str, dict[Labels, float]] = {}
+        self.lock = threading.Lock()
+        # ids of the sessions we already count requests for
+        self.tracked_sessions: set[int] = set()
+
+    @staticmethod
+    def make_labels(labels: dict[str, object]) -> Labels:
+        """
+        helper function
+        labels as a hashable, sorted tuple
+        """
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def add(self, name: str, metric_type: str, value: float, replace: bool = False, **labels) -> None:
+        """
+        helper function
+        add to (or replace) the value of a series
+        """
+        key = self.make_labels(labels)
+        with self.lock:
+            self.types.setdefault(name, metric_type)
+            series = self.series.setdefault(name, {})
+            series[key] = value if replace else series.get(key, 0) + value
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        """
+        increase a counter
+        """
+        self.add(name, "counter", value, **labels)
+
+    def set(self, name: str, value: float, **labels) -> None:
+        """
+        set a gauge
+        """
+        self.add(name, "gauge", value, replace=True, **labels)
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """
+        record one observation of a summary (its sum and count), the last value is kept as a gauge
+        """
+        key = self.make_labels(labels)
+        with self.lock:
+            self.types.setdefault(name, "summary")
+            self.types.setdefault(f"{name}_last", "gauge")
+            for series_name, series_value in ((f"{name}_sum", value), (f"{name}_count", 1)):
+                series = self.series.setdefault(series_name, {})
+                series[key] = series.get(key, 0) + series_value
+            self.series.setdefault(f"{name}_last", {})[key] = value
+
+    @contextmanager
+    def stage(self, stage: str, **labels) -> Iterator[None]:
+        """
+        time a stage of a fetcher, recorded as stage_seconds{stage=...} even if the stage raises
+        """
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("stage_seconds", time.perf_counter() - started_at, stage=stage, **labels)
+
+    def track_session(self, session: "requests.Session") -> None:
+        """
+        count every response of the session by host and status code, and time it to the headers
+        a session is only tracked once, even if several fetchers share it
+        """
+        with self.lock:
+            if id(session) in self.tracked_sessions:
+                return
+            self.tracked_sessions.add(id(session))
+        session.hooks["response"].append(self.record_response)
+
+    def record_response(self, response: "requests.Response", *args, **kwargs) -> None:
+        """
+        helper function
+        the response hook added by track_session
+        """
+        host = urllib.parse.urlparse(response.url).netloc
+        self.inc("http_requests_total", host=host, status=response.status_code)
+        self.observe("http_request_seconds", response.elapsed.total_seconds(), host=host)
+
+    def snapshot(self) -> dict:
+        """
+        every metric with its type and the value of each series
+        """
+        with self.lock:
+            snapshot = {}
+            for name, metric_type in sorted(self.types.items()):
+                series_names = [f"{name}_sum", f"{name}_count"] if metric_type == "summary" else [name]
+                snapshot[name] = {
+                    "type": metric_type,
+                    "series": {
+                        series_name: [
+                            {"labels": dict(labels), "value": value}
+                            for labels, value in sorted(self.series.get(series_name, {}).items())
+                        ]
+                        for series_name in series_names
+                    },
+                }
+            return snapshot
+
+    def to_prometheus(self) -> str:
+        """
+        the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        for name, metric in self.snapshot().items():
+            lines.append(f"# TYPE {self.namespace}_{name} {metric['type']}")
+            for series_name, samples in metric["series"].items():
+                for sample in samples:
+                    labels = ",".join(f'{key}="{escape_label(value)}"' for key, value in sample["labels"].items())
+                    labels = f"{{{labels}}}" if labels else ""
+                    lines.append(f"{self.namespace}_{series_name}{labels} {sample['value']!r}")
+        return "\n".join(lines) + "\n"
+
+    def to_json(self) -> str:
+        """
+        the metrics as a JSON snapshot
+        """
+        return json.dumps({"namespace": self.namespace, "created_at": time.time(), "metrics": self.snapshot()})
+
+    def write(self, file_path: str) -> None:
+        """
+        write the metrics to `file_path`, as JSON if it ends in .json and as a Prometheus textfile otherwise
+        the file is replaced atomically, so the node exporter never reads half of it
+        (its textfile collector only reads files that end in .prom)
+        """
+        file_path = os.path.expanduser(file_path)
+        content = self.to_json() if file_path.endswith(".json") else self.to_prometheus()
+        with atomic_write(file_path) as handler:
+            handler.write(content)
+
+
+def escape_label(value: str) -> str:
+    """
+    helper function
+    escape a label value for the Prometheus text format
+    """
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
@@ -0,0 +1,269 @@
+import bisect
+import datetime as dt
+import glob
+import mmap
+import os
+import struct
+from collections.abc import Iterator
+
+from src.core.logger import logger
+
+# packs live in old_backgrounds/packs/SOURCE/YYYY-MM.pack, next to their YYYY-MM.idx
+PACK_DIRECTORY = "packs"
+# one index record per image: capture minute (counted from EPOCH), offset and length of the image in the pack
+RECORD = struct.Struct("<qQI")
+EPOCH = dt.datetime(1970, 1, 1)
+# a frame of a pack that can be sent to another process: pack path, offset and length
+PackedFrame = tuple[str, int, int]
+
+
+def to_minute(captured_at: dt.datetime) -> int:
+    """
+    helper function
+    the capture minute as it is stored in an index record, seconds are dropped
+    returns the whole minutes from EPOCH to `captured_at`
+    """
+    return int((captured_at.replace(second=0, microsecond=0) - EPOCH).total_seconds() // 60)
+
+
+def from_minute(minute: int) -> dt.datetime:
+    """
+    helper function
+    the reverse of to_minute, turns the minute of an index record back into a capture time
+    returns EPOCH plus `minute` minutes
+    """
+    return EPOCH + dt.timedelta(minutes=minute)
+
+
+def pack_path(root: str, source: str, captured_at: dt.datetime) -> str:
+    """
+    helper function
+    the pack an image of `source` captured at `captured_at` goes into, nothing is read or created
+    returns root/packs/SOURCE/YYYY-MM.pack
+    """
+    return os.path.join(root, PACK_DIRECTORY, source, f"{captured_at:%Y-%m}.pack")
+
+
+def append_to_pack(file_path: str, images: list[tuple[dt.datetime, str, str]]) -> int:
+    """
+    append images (capture time, file path, sha256) to a pack and its index
+    the pack is only ever appended to: the images are written and synced first, then their index records,
+    so a crash leaves at most some unindexed bytes at the end of the pack (and a cut off record the reader ignores)
+    identical images (same sha256) are stored once and indexed at every capture time
+    returns the bytes appended to the pack
+    """
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    records = []
+    stored: dict[str, tuple[int, int]] = {}
+    with open(file_path, "ab") as handler:
+        offset = handler.seek(0, os.SEEK_END)
+        start = offset
+        for captured_at, image_path, sha256 in images:
+            if sha256 not in stored:
+                with open(image_path, "rb") as image:
+                    data = image.read()
+                handler.write(data)
+                stored[sha256] = (offset, len(data))
+                offset += len(data)
+            records.append(RECORD.pack(to_minute(captured_at), *stored[sha256]))
+        handler.flush()
+        os.fsync(handler.fileno())
+    with open(index_path(file_path), "ab") as handler:
+        # a record cut off by a crash would shift every record after it, so we start on a record boundary
+        handler.truncate(handler.seek(0, os.SEEK_END) // RECORD.size * RECORD.size)
+        handler.write(b"".join(records))
+        handler.flush()
+        os.fsync(handler.fileno())
+    return offset - start
+
+
+def index_path(file_path: str) -> str:
+    """
+    helper function
+    the index that goes with a pack, it holds one RECORD for every image appended to the pack
+    returns the path of the pack with .idx instead of .pack
+    """
+    return f"{os.path.splitext(file_path)[0]}.idx"
+
+
+class PackReader:
+    def __init__(self, file_path: str) -> None:
+        """
+        random access to the images of one pack
+        the pack is memory mapped and every image is returned as a memoryview into the map, nothing is copied
+        the index is small (20 bytes an image) and read into memory, sorted by capture time
+        close it (or use it as a context manager) once the memoryviews it handed out are released
+        """
+        self.file_path: str = file_path
+        self.minutes: list[int] = []
+        self.locations: list[tuple[int, int]] = []
+        with open(index_path(file_path), "rb") as handler:
+            data = handler.read()
+        # a record cut off by a crash is ignored
+        records = sorted(RECORD.iter_unpack(data[: len(data) // RECORD.size * RECORD.size]))
+        for minute, offset, length in records:
+            self.minutes.append(minute)
+            self.locations.append((offset, length))
+        with open(file_path, "rb") as handler:
+            size = os.fstat(handler.fileno()).st_size
+            self.map: mmap.mmap | None = mmap.mmap(handler.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        self.view: memoryview = memoryview(self.map) if self.map else memoryview(b"")
+
+    def __enter__(self) -> "PackReader":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self.minutes)
+
+    def close(self) -> None:
+        self.view.release()
+        if self.map:
+            try:
+                self.map.close()
+            except BufferError:
+                # a frame handed out is still in use, the map is unmapped once the last one is released
+                logger.debug(f"Pack {self.file_path} still has frames in use")
+            self.map = None
+
+    def __contains__(self, captured_at: dt.datetime) -> bool:
+        return self.position(captured_at) is not None
+
+    def position(self, captured_at: dt.datetime) -> int | None:
+        """
+        helper function
+        look up the image captured at `captured_at` (to the minute) in the sorted index, the pack isn't read
+        returns its position in `minutes` and `locations`, None if it isn't there
+        """
+        minute = to_minute(captured_at)
+        i = bisect.bisect_left(self.minutes, minute)
+        if i == len(self.minutes) or self.minutes[i] != minute:
+            return None
+        return i
+
+    def frame(self, captured_at: dt.datetime) -> memoryview | None:
+        """
+        the image captured at `captured_at` (to the minute), None if it isn't in the pack
+        """
+        i = self.position(captured_at)
+        return None if i is None else self.slice(i)
+
+    def frames_between(self, start: dt.datetime, end: dt.datetime) -> Iterator[tuple[dt.datetime, memoryview]]:
+        """
+        (capture time, image) of every image captured in [start, end), oldest first
+        """
+        for i in range(bisect.bisect_left(self.minutes, to_minute(start)), len(self.minutes)):
+            if from_minute(self.minutes[i]) >= end:
+                return
+            yield from_minute(self.minutes[i]), self.slice(i)
+
+    def locations_between(self, start: dt.datetime, end: dt.datetime) -> Iterator[tuple[dt.datetime, PackedFrame]]:
+        """
+        same as frames_between, but with where every image is instead of the image, to hand to another process
+        """
+        for i in range(bisect.bisect_left(self.minutes, to_minute(start)), len(self.minutes)):
+            if from_minute(self.minutes[i]) >= end:
+                return
+            yield from_minute(self.minutes[i]), (self.file_path, *self.locations[i])
+
+    def slice(self, i: int) -> memoryview:
+        """
+        helper function
+        the bytes of the image at position `i` of the index, taken from the memory map without a copy
+        returns a memoryview into the map, it has to be released before the reader can unmap the pack
+        """
+        offset, length = self.locations[i]
+        return self.view[offset : offset + length]
+
+
+class PackedArchive:
+    def __init__(self, root: str) -> None:
+        """
+        every pack of an archive (old_backgrounds/packs/), see ImageArchive.compact
+        readers are opened when they are first needed and kept open until close
+        """
+        self.directory: str = os.path.join(os.path.expanduser(root), PACK_DIRECTORY)
+        self.readers: dict[str, PackReader] = {}
+
+    def __enter__(self) -> "PackedArchive":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        for reader in self.readers.values():
+            reader.close()
+        self.readers.clear()
+
+    def reader(self, file_path: str) -> PackReader | None:
+        """
+        helper function
+        the reader of a pack, opened (its index read and the pack mapped) on first use and cached until close
+        returns None if the pack has no index, i.e. nothing was ever packed into it
+        """
+        if file_path not in self.readers:
+            if not os.path.exists(index_path(file_path)):
+                return None
+            self.readers[file_path] = PackReader(file_path)
+        return self.readers[file_path]
+
+    def sources(self) -> list[str]:
+        return sorted(os.path.basename(d) for d in glob.glob(os.path.join(self.directory, "*")) if os.path.isdir(d))
+
+    def packs_between(self, start: dt.datetime, end: dt.datetime, source: str) -> list[str]:
+        """
+        helper function
+        list the packs of a source (by their YYYY-MM name) whose month overlaps [start, end), no pack is opened
+        returns their paths, oldest first, files that aren't named by month are skipped
+        """
+        packs = []
+        for file_path in sorted(glob.glob(os.path.join(self.directory, source, "*.pack"))):
+            try:
+                month = dt.datetime.strptime(os.path.basename(file_path), "%Y-%m.pack")
+            except ValueError:
+                continue
+            next_month = (month + dt.timedelta(days=32)).replace(day=1)
+            if month < end and next_month > start:
+                packs.append(file_path)
+        return packs
+
+    def frame(self, captured_at: dt.datetime, source: str) -> memoryview | None:
+        """
+        the image of a source captured at `captured_at`, None if it isn't packed
+        """
+        reader = self.reader(os.path.join(self.directory, source, f"{captured_at:%Y-%m}.pack"))
+        return reader.frame(captured_at) if reader else None
+
+    def frames_between(
+        self, start: dt.datetime, end: dt.datetime, source: str
+    ) -> Iterator[tuple[dt.datetime, memoryview]]:
+        """
+        (capture time, image) of every packed image of a source captured in [start, end), oldest first
+        """
+        for file_path in self.packs_between(start, end, source):
+            yield from self.reader(file_path).frames_between(start, end)
+
+    def locations_between(
+        self, start: dt.datetime, end: dt.datetime, source: str
+    ) -> Iterator[tuple[dt.datetime, PackedFrame]]:
+        """
+        same as frames_between, but with where every image is instead of the image, to hand to another process
+        """
+        for file_path in self.packs_between(start, end, source):
+            yield from self.reader(file_path).locations_between(start, end)
+
+
+def read_packed_frame(frame: PackedFrame) -> bytes:
+    """
+    read one image of a pack without a reader, for a worker process that only gets the frame's location
+    """
+    file_path, offset, length = frame
+    with open(file_path, "rb") as handler:
+        handler.seek(offset)
+        data = handler.read(length)
+    if len(data) != length:
+        logger.warning(f"[red]Pack {file_path} is shorter than its index")
+    return data
@@ -0,0 +1,134 @@
+import os
+import struct
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+
+from src.core.logger import logger
+
+# fcntl only exists on unix, elsewhere the buckets are only shared by the threads of one process
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# shared by every run that is given the same file, like the probe cache
+RATE_LIMIT_FILE = "~/.cache/backgrounds/rate_limit"
+# a bucket holds this many seconds of its rate, so a quiet moment can be spent at once
+BURST_SECONDS = 2
+# the share of each bucket that only live updates may spend
+LIVE_RESERVE = 0.2
+# request tokens, byte tokens and when they were counted (time.time())
+BUCKETS = struct.Struct("<ddd")
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        requests_per_second: float | None = None,
+        bytes_per_second: float | None = None,
+        file_path: str = RATE_LIMIT_FILE,
+        live_reserve: float = LIVE_RESERVE,
+    ) -> None:
+        """
+        token buckets for requests per second and bytes per second, None leaves that one unlimited
+        the buckets are kept in a small file and only changed under an exclusive lock of it,
+        so every thread and every local process given the same file shares them
+        a request takes a request token, its bytes are taken once the headers tell us the size and can take the
+        byte bucket below zero, the next request then waits until that is paid back
+        background work (backfills, gap fill, scrub) can't spend the last `live_reserve` of either bucket,
+        so it runs at full speed without ever holding up a live update
+        every process should use the same limits, the buckets refill at the rate of whoever reads them
+        """
+        self.requests_per_second: float | None = requests_per_second
+        self.bytes_per_second: float | None = bytes_per_second
+        self.file_path: str = os.path.expanduser(file_path)
+        self.request_capacity: float = max(requests_per_second * BURST_SECONDS, 1) if requests_per_second else 0
+        self.byte_capacity: float = bytes_per_second * BURST_SECONDS if bytes_per_second else 0
+        # what background work has to leave in the buckets, at least one request always fits above it
+        self.request_reserve: float = min(live_reserve * self.request_capacity, self.request_capacity - 1)
+        self.byte_reserve: float = live_reserve * self.byte_capacity
+        os.makedirs(os.path.dirname(self.file_path) or ".", exist_ok=True)
+        # the file lock is per open file, this one keeps the threads of this process in line without it
+        self.lock = threading.Lock()
+        # seconds spent waiting for tokens
+        self.waited: float = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.requests_per_second or self.bytes_per_second)
+
+    @contextmanager
+    def buckets(self) -> Iterator[list[float]]:
+        """
+        helper function
+        the two buckets refilled up to now, locked, the changes made to them are written back
+        """
+        fd = os.open(self.file_path, os.O_RDWR | os.O_CREAT, 0o644)
+        with self.lock, os.fdopen(fd, "r+b") as handler:
+            if fcntl is not None:
+                fcntl.flock(handler, fcntl.LOCK_EX)
+            data = handler.read(BUCKETS.size)
+            now = time.time()
+            if len(data) == BUCKETS.size:
+                request_tokens, byte_tokens, counted_at = BUCKETS.unpack(data)
+            else:
+                # a new (or cut off) file starts full
+                request_tokens, byte_tokens, counted_at = self.request_capacity, self.byte_capacity, now
+            # a clock that went back doesn't refill anything
+            elapsed = max(now - counted_at, 0)
+            buckets = [
+                min(request_tokens + elapsed * (self.requests_per_second or 0), self.request_capacity),
+                min(byte_tokens + elapsed * (self.bytes_per_second or 0), self.byte_capacity),
+            ]
+            yield buckets
+            handler.seek(0)
+            handler.write(BUCKETS.pack(*buckets, now))
+            handler.truncate()
+
+    def wait_time(self, buckets: list[float], background: bool) -> float:
+        """
+        helper function
+        how long until both buckets allow a request, 0 if they already do
+        """
+        wait = 0
+        if self.requests_per_second:
+            floor = self.request_reserve if background else 0
+            wait = max(wait, (floor + 1 - buckets[0]) / self.requests_per_second)
+        if self.bytes_per_second:
+            floor = self.byte_reserve if background else 0
+            wait = max(wait, (floor - buckets[1]) / self.bytes_per_second)
+        return wait
+
+    def acquire(self, background: bool = False) -> float:
+        """
+        wait until a request is allowed and take its token
+        returns the seconds we waited
+        """
+        if not self.enabled:
+            return 0
+        waited = 0
+        while True:
+            with self.buckets() as buckets:
+                wait = self.wait_time(buckets, background)
+                if wait <= 0:
+                    if self.requests_per_second:
+                        buckets[0] -= 1
+                    break
+            # another thread or process may get there first, so we check again after the wait
+            time.sleep(wait)
+            waited += wait
+        if waited:
+            self.waited += waited
+            logger.debug(f"Waited {waited:.2f}s for the rate limit")
+        return waited
+
+    def consume_bytes(self, size: int) -> None:
+        """
+        take the bytes of a response from the byte bucket, it may go below zero
+        """
+        if not self.bytes_per_second or not size:
+            return
+        with self.buckets() as buckets:
+            buckets[1] -= size
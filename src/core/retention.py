@@ -0,0 +1,159 @@
+import datetime as dt
+import time
+
+from src.core.archive import RETENTION_LAST_ID_KEY, RETENTION_LAST_RUN_KEY, RETENTION_TOTAL_BYTES_KEY, ImageArchive
+from src.core.logger import logger
+
+# buckets (hour, day, ...) are counted from this point in time
+BUCKET_EPOCH = dt.datetime(2000, 1, 1)
+UNITS = {
+    "m": dt.timedelta(minutes=1),
+    "h": dt.timedelta(hours=1),
+    "d": dt.timedelta(days=1),
+    "w": dt.timedelta(weeks=1),
+}
+
+
+def parse_duration(value: str) -> dt.timedelta:
+    """
+    helper function
+    parse a duration like 30m, 12h, 7d or 2w
+    """
+    return int(value[:-1]) * UNITS[value[-1]]
+
+
+class RetentionRule:
+    def __init__(self, older_than: dt.timedelta, keep_every: dt.timedelta | None) -> None:
+        """
+        images older than `older_than` are thinned to one image per `keep_every` (the first one in each bucket)
+        if keep_every is None, images older than `older_than` are deleted
+        """
+        self.older_than: dt.timedelta = older_than
+        self.keep_every: dt.timedelta | None = keep_every
+
+    def __repr__(self) -> str:
+        return f"RetentionRule(older_than={self.older_than}, keep_every={self.keep_every})"
+
+
+class RetentionPolicy:
+    def __init__(
+        self,
+        rules: list[RetentionRule],
+        max_total_bytes: int | None = None,
+        batch_size: int = 500,
+    ) -> None:
+        """
+        declarative retention for the image archive
+        rules: e.g. keep everything for 7 days, then hourly until 90 days, then daily:
+            [RetentionRule(7 days, 1 hour), RetentionRule(90 days, 1 day)]
+        max_total_bytes: hard cap on the size of the archive, the oldest images are deleted first
+        batch_size: how many images are deleted per statement
+
+        each pass only looks at the images that crossed a rule's age since the last pass
+        and the images that were added since the last pass, not the whole archive
+        """
+        self.rules: list[RetentionRule] = sorted(rules, key=lambda r: r.older_than)
+        self.max_total_bytes: int | None = max_total_bytes
+        self.batch_size: int = batch_size
+
+    @classmethod
+    def from_string(cls, rules: str, max_total_bytes: int | None = None) -> "RetentionPolicy":
+        """
+        build a policy from a comma separated list of AGE:EVERY rules, EVERY can be `none` to delete
+        example: "7d:1h,90d:1d" keeps everything for 7 days, hourly until 90 days, then daily
+        """
+        parsed = []
+        for rule in filter(None, rules.split(",")):
+            older_than, keep_every = rule.strip().split(":")
+            parsed.append(
+                RetentionRule(
+                    parse_duration(older_than),
+                    None if keep_every.lower() == "none" else parse_duration(keep_every),
+                )
+            )
+        return cls(parsed, max_total_bytes)
+
+    def apply(self, archive: ImageArchive, now: dt.datetime | None = None) -> tuple[int, float]:
+        """
+        run one incremental pass over the archive
+        returns the bytes reclaimed and the seconds the pass took
+        """
+        started_at = time.monotonic()
+        now = now or dt.datetime.now()
+        last_run = archive.get_state(RETENTION_LAST_RUN_KEY)
+        last_run = dt.datetime.fromisoformat(last_run) if last_run else None
+        last_id = int(archive.get_state(RETENTION_LAST_ID_KEY) or 0)
+        max_id = archive.max_id()
+        total_bytes = self.total_bytes(archive, last_id, max_id)
+
+        to_delete = {}
+        for rule in self.rules:
+            cutoff = now - rule.older_than
+            # images that got older than the rule since the last pass, and new images already older than it
+            rows = archive.images_between(last_run - rule.older_than if last_run else dt.datetime.min, cutoff)
+            rows += archive.images_added_after(last_id, max_id, before=cutoff)
+            if rule.keep_every is None:
+                to_delete.update((row["id"], row) for row in rows)
+                continue
+            for bucket_start in {
+                self.bucket_start(dt.datetime.fromisoformat(row["captured_at"]), rule) for row in rows
+            }:
+                bucket_end = min(bucket_start + rule.keep_every, cutoff)
+                # the first image of the bucket is the one we keep
+                bucket = [row for row in archive.images_between(bucket_start, bucket_end) if row["id"] not in to_delete]
+                to_delete.update((row["id"], row) for row in bucket[1:])
+
+        reclaimed = archive.delete(list(to_delete.values()), self.batch_size)
+        total_bytes -= reclaimed
+        if self.max_total_bytes is not None and total_bytes > self.max_total_bytes:
+            cap_reclaimed = self.enforce_byte_cap(archive, total_bytes)
+            reclaimed += cap_reclaimed
+            total_bytes -= cap_reclaimed
+
+        archive.set_state(RETENTION_LAST_RUN_KEY, now.isoformat(sep=" "))
+        archive.set_state(RETENTION_LAST_ID_KEY, str(max_id))
+        archive.set_state(RETENTION_TOTAL_BYTES_KEY, str(total_bytes))
+        elapsed = time.monotonic() - started_at
+        logger.info(
+            f"[blue]Retention pass deleted {len(to_delete)} images, reclaimed {reclaimed / 1024**2:.1f} MB "
+            f"in {elapsed:.3f}s (archive is {total_bytes / 1024**2:.1f} MB)"
+        )
+        return reclaimed, elapsed
+
+    @staticmethod
+    def bucket_start(captured_at: dt.datetime, rule: RetentionRule) -> dt.datetime:
+        """
+        helper function
+        start of the `keep_every` bucket the capture time falls in
+        """
+        return captured_at - (captured_at - BUCKET_EPOCH) % rule.keep_every
+
+    @staticmethod
+    def total_bytes(archive: ImageArchive, last_id: int, max_id: int) -> int:
+        """
+        helper function
+        size of the archive, kept as a running total so we only sum the images added since the last pass
+        """
+        total = archive.get_state(RETENTION_TOTAL_BYTES_KEY)
+        if total is None:
+            return archive.total_bytes(up_to_id=max_id)
+        return int(total) + archive.total_bytes(after_id=last_id, up_to_id=max_id)
+
+    def enforce_byte_cap(self, archive: ImageArchive, total_bytes: int) -> int:
+        """
+        delete the oldest images, a batch at a time, until the archive fits in max_total_bytes
+        returns the bytes reclaimed
+        """
+        reclaimed = 0
+        while total_bytes - reclaimed > self.max_total_bytes:
+            batch = []
+            over = total_bytes - reclaimed - self.max_total_bytes
+            for row in archive.oldest(self.batch_size):
+                batch.append(row)
+                over -= row["size"]
+                if over <= 0:
+                    break
+            if not batch:
+                break
+            reclaimed += archive.delete(batch, self.batch_size)
+        return reclaimed
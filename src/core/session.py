@@ -0,0 +1,106 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from src.core.logger import logger
+
+
+class PooledSession(requests.Session):
+    def __init__(
+        self,
+        pool_size: int = 10,
+        max_hosts: int = 4,
+        keep_alive: bool = True,
+        max_retries: int = 3,
+        backoff_factor: float = 0.5,
+        block: bool = False,
+        timeout: float = 10,
+    ) -> None:
+        """
+        a requests session with a connection pool that is shared by every fetcher
+        pool_size: how many connections we keep open to a single host (the per-host limit)
+        max_hosts: how many hosts we keep a pool for
+        keep_alive: if False, every request asks the server to close the connection
+        max_retries: how many times a 5xx response or connection error is retried
+        backoff_factor: retries wait backoff_factor * 2 ** (retry - 1) seconds
+        block: if True, requests wait for a free connection instead of going over pool_size
+        timeout: default timeout in seconds for every request
+        """
+        super().__init__()
+        self.pool_size: int = pool_size
+        self.max_hosts: int = max_hosts
+        self.max_retries: int = max_retries
+        self.backoff_factor: float = backoff_factor
+        self.block: bool = block
+        self.timeout: float = timeout
+        if not keep_alive:
+            self.headers["Connection"] = "close"
+        self.mount_adapters()
+
+    def mount_adapters(self) -> None:
+        """
+        (re)build the http and https adapters with the current pool settings
+        """
+        retries = Retry(
+            total=self.max_retries,
+            backoff_factor=self.backoff_factor,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=("GET", "HEAD"),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=self.max_hosts,
+            pool_maxsize=self.pool_size,
+            max_retries=retries,
+            pool_block=self.block,
+        )
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def ensure_pool_size(self, pool_size: int) -> None:
+        """
+        grow the per-host pool so `pool_size` threads can share it without dropping connections
+        existing connections are closed when the pool is rebuilt
+        """
+        if pool_size <= self.pool_size:
+            return
+        logger.info(f"[yellow]Growing connection pool from {self.pool_size} to {pool_size} per host")
+        self.pool_size = pool_size
+        self.mount_adapters()
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        same as requests.Session.request but with a default timeout
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(method, url, **kwargs)
+
+    def pool_stats(self) -> dict[str, dict[str, int]]:
+        """
+        return the number of connections opened and requests made per host
+        every request over the number of connections opened reused a kept-alive connection
+        """
+        stats = {}
+        for adapter in {id(a): a for a in self.adapters.values()}.values():
+            pools = adapter.poolmanager.pools
+            # RecentlyUsedContainer can not be iterated directly
+            for key in pools.keys():  # noqa: SIM118
+                pool = pools[key]
+                host = f"{pool.scheme}://{pool.host}"
+                host_stats = stats.setdefault(host, {"connections": 0, "requests": 0, "reused": 0})
+                host_stats["connections"] += pool.num_connections
+                host_stats["requests"] += pool.num_requests
+                host_stats["reused"] += max(pool.num_requests - pool.num_connections, 0)
+        return stats
+
+    def log_pool_stats(self) -> None:
+        """
+        log the connection pool stats for every host
+        """
+        for host, host_stats in self.pool_stats().items():
+            hit_rate = host_stats["reused"] / host_stats["requests"] if host_stats["requests"] else 0
+            logger.info(
+                f"[blue]Connection pool {host}: {host_stats['requests']} requests, "
+                f"{host_stats['connections']} connections opened, {host_stats['reused']} reused "
+                f"({hit_rate:.0%} reuse)"
+            )
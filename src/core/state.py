@@ -0,0 +1,115 @@
+import datetime as dt
+import glob
+import json
+import os
+from collections.abc import Iterator
+from contextlib import contextmanager
+
+from src.core.atomic import atomic_write
+from src.core.logger import logger
+
+# fcntl only exists on unix, elsewhere runs aren't locked
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# both are kept in the background folder, they are hidden and don't end in .jpg so they are never a background
+STATE_FILE = ".background_state.json"
+LOCK_FILE = ".background.lock"
+
+
+class BackgroundState:
+    def __init__(self, directory: str) -> None:
+        """
+        the current background of a folder and its capture time, kept in a small JSON file
+        along with the capture time of the newest image we checked (seen_at), newer than the background
+        when we skipped a duplicate of it
+        so every cycle reads one file instead of scanning the folder and parsing the file name
+        the folder is only scanned when there is no state yet or the file it points to is gone
+        `lock` keeps two runs (e.g. cron and constant mode) from updating the same folder at the same time
+        """
+        self.directory: str = os.path.expanduser(directory)
+        self.file_path: str = os.path.join(self.directory, STATE_FILE)
+        self.lock_path: str = os.path.join(self.directory, LOCK_FILE)
+
+    def load(self) -> tuple[str, dt.datetime, dt.datetime] | None:
+        """
+        the current background, its capture time and seen_at, None if there is no state or its file is gone
+        """
+        try:
+            with open(self.file_path) as handler:
+                state = json.load(handler)
+            current_file, captured_at = state["current_file"], dt.datetime.fromisoformat(state["captured_at"])
+            # state files from before seen_at was kept
+            seen_at = dt.datetime.fromisoformat(state.get("seen_at") or state["captured_at"])
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning(f"[red]Ignoring unreadable state file {self.file_path}: {e}")
+            return None
+        if not os.path.exists(current_file):
+            logger.info(f"[yellow]The background in the state file is gone: {current_file}")
+            return None
+        return current_file, captured_at, max(seen_at, captured_at)
+
+    def save(self, current_file: str, captured_at: dt.datetime, seen_at: dt.datetime | None = None) -> None:
+        """
+        record the current background, the file is replaced atomically
+        seen_at defaults to the capture time of the background
+        """
+        state = {
+            "current_file": os.path.expanduser(current_file),
+            "captured_at": captured_at.isoformat(),
+            "seen_at": (seen_at or captured_at).isoformat(),
+        }
+        with atomic_write(self.file_path) as handler:
+            json.dump(state, handler)
+
+    def mark_seen(self, seen_at: dt.datetime) -> None:
+        """
+        record the capture time of an image we checked but didn't keep (a duplicate), the background stays the same
+        """
+        current = self.load()
+        if current:
+            self.save(current[0], current[1], seen_at)
+
+    def scan(self) -> tuple[str, dt.datetime, dt.datetime] | None:
+        """
+        find the current background by scanning the folder, used when there is no state
+        if an interrupted or overlapping run left more than one image, the newest one is the background
+        """
+        capture_times = {}
+        for file_path in glob.glob(os.path.join(self.directory, "*.jpg")):
+            try:
+                capture_times[file_path] = dt.datetime.strptime(os.path.basename(file_path), "%Y-%m-%d-%H-%M.jpg")
+            except ValueError:
+                continue
+        if not capture_times:
+            return None
+        current_file = max(capture_times, key=capture_times.get)
+        if len(capture_times) > 1:
+            logger.warning(f"[red]More than one image in {self.directory}, using the newest: {current_file}")
+        return current_file, capture_times[current_file], capture_times[current_file]
+
+    @contextmanager
+    def lock(self) -> Iterator[bool]:
+        """
+        take the advisory lock of the folder without waiting for it
+        yields False if another run holds it, the caller should skip this cycle
+        the lock is released when the process exits, even if it crashes
+        """
+        if fcntl is None:
+            yield True
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.lock_path, "a") as handler:
+            try:
+                fcntl.flock(handler, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(handler, fcntl.LOCK_UN)
@@ -0,0 +1,131 @@
+import contextlib
+import glob
+import importlib.util
+import os
+from concurrent.futures import Future
+
+from src.core.atomic import atomic_write
+from src.core.logger import logger
+
+
+class Variant:
+    def __init__(self, background_directory: str, width: int, height: int, crop: bool = False) -> None:
+        """
+        one display we make a copy of every new image for
+        background_directory: the folder the display shows, it always holds the newest variant only
+        width, height: size of the display
+        crop: if True the image is cropped to fill the display, otherwise it is scaled to fit inside it
+        """
+        self.background_directory: str = os.path.expanduser(background_directory)
+        self.width: int = width
+        self.height: int = height
+        self.crop: bool = crop
+
+    @classmethod
+    def from_string(cls, variant: str) -> "Variant":
+        """
+        parse DIRECTORY:WIDTHxHEIGHT[:crop], e.g. ~/Desktop/backgrounds-4k/:3840x2160:crop
+        """
+        directory, size, *options = variant.split(":")
+        width, height = size.lower().split("x")
+        return cls(directory, int(width), int(height), "crop" in options)
+
+    def __repr__(self) -> str:
+        return f"Variant({self.background_directory}, {self.width}x{self.height}{', crop' if self.crop else ''})"
+
+
+def newer_variants(variant: Variant, file_name: str) -> list[str]:
+    """
+    helper function
+    the images in the variant's directory newer than `file_name`, the names are capture times so they sort by age
+    """
+    file_paths = glob.glob(os.path.join(variant.background_directory, "*.jpg"))
+    return [file_path for file_path in file_paths if os.path.basename(file_path) > file_name]
+
+
+def render_variant(original_path: str, variant: Variant) -> str | None:
+    """
+    resize (or crop) the original into the variant's directory and remove the variants it replaces
+    this runs in a worker process, and the workers can finish out of order:
+    an original older than the variant already there isn't rendered, and an older variant never replaces a newer one
+    returns the path of the new variant, None if a newer one was already there
+    """
+    from PIL import Image, ImageOps
+
+    os.makedirs(variant.background_directory, exist_ok=True)
+    file_name = os.path.basename(original_path)
+    file_path = os.path.join(variant.background_directory, file_name)
+    if newer_variants(variant, file_name):
+        return None
+    with Image.open(original_path) as image:
+        # let the JPEG decoder scale down while decoding when the display is much smaller
+        image.draft("RGB", (variant.width, variant.height))
+        if variant.crop:
+            image = ImageOps.fit(image, (variant.width, variant.height), Image.LANCZOS)
+        else:
+            image = image.copy()
+            image.thumbnail((variant.width, variant.height), Image.LANCZOS)
+        # the display never sees a half written image
+        with atomic_write(file_path, "wb") as handler:
+            image.convert("RGB").save(handler, "JPEG", quality=90)
+    for old_file in glob.glob(os.path.join(variant.background_directory, "*.jpg")):
+        # another worker may be removing it too
+        if os.path.basename(old_file) < file_name:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(old_file)
+    # a newer variant finished while we were rendering
+    if newer_variants(variant, file_name):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(file_path)
+        return None
+    return file_path
+
+
+class VariantPipeline:
+    def __init__(self, variants: list[Variant], workers: int = 2) -> None:
+        """
+        fetch once, derive many
+        every new image is resized into each variant by a pool of worker processes
+        so one download serves every display and the fetch loop never waits on the resizing
+        """
+        # Pillow is optional, it is only needed when display variants are configured
+        if importlib.util.find_spec("PIL") is None:
+            raise ImportError("Display variants need Pillow: pip install pillow")
+        # multiprocessing is only imported when there are variants to render
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        self.variants: list[Variant] = variants
+        # spawned workers don't inherit the fetcher's threads, locks and open connections the way forked ones would
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def submit(self, original_path: str) -> list[Future]:
+        """
+        queue the original to be rendered into every variant, returns right away
+        """
+        original_path = os.path.expanduser(original_path)
+        futures = []
+        for variant in self.variants:
+            future = self.executor.submit(render_variant, original_path, variant)
+            future.add_done_callback(lambda f, v=variant: self.log_result(f, v))
+            futures.append(future)
+        return futures
+
+    @staticmethod
+    def log_result(future: Future, variant: Variant) -> None:
+        """
+        helper function
+        log the finished (or failed) variant
+        """
+        if future.exception():
+            logger.error(f"[red]Could not render {variant}: {future.exception()}")
+        elif future.result() is None:
+            logger.info(f"[yellow]Skipped {variant}, it already shows a newer image")
+        else:
+            logger.info(f"[green]Rendered {variant}: {future.result()}")
+
+    def shutdown(self) -> None:
+        """
+        wait for the queued variants to finish and stop the worker processes
+        """
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,189 @@
+#!/venv/bin/python3
+import argparse
+import asyncio
+import json
+import os
+from collections.abc import Callable
+
+from src.core.background import BackgroundImageFetcher
+from src.core.logger import LOG_FORMATS, configure_logging, logger
+from src.core.metrics import Metrics
+from src.core.rate_limit import RATE_LIMIT_FILE, RateLimiter
+from src.core.retention import RetentionPolicy
+from src.core.session import PooledSession
+from src.core.variants import Variant, VariantPipeline
+from src.nasa.nasa_image_of_the_day import update as update_nasa
+from src.snowbasin.probe_cache import PROBE_CACHE_FILE, ProbeCache
+from src.snowbasin.snowbasin_image import SnowbasinImage
+
+
+class Source:
+    def __init__(self, name: str, process: Callable[[], object], interval_seconds: float) -> None:
+        """
+        one feed the daemon keeps up to date
+        name: used in the logs
+        process: called every interval, it runs in a worker thread so it can block on the network
+        interval_seconds: how long to wait between runs
+        """
+        self.name: str = name
+        self.process: Callable[[], object] = process
+        self.interval_seconds: float = interval_seconds
+
+
+def make_retention_policy(source_config: dict) -> RetentionPolicy | None:
+    """
+    build the retention policy of a source from its `retention` and `max_archive_gb` keys
+    """
+    if not source_config.get("retention") and not source_config.get("max_archive_gb"):
+        return None
+    max_archive_gb = source_config.get("max_archive_gb")
+    return RetentionPolicy.from_string(
+        source_config.get("retention", ""), int(max_archive_gb * 1024**3) if max_archive_gb else None
+    )
+
+
+def make_variant_pipeline(source_config: dict) -> VariantPipeline | None:
+    """
+    build the display variants of a source from its `variants` key, a list of DIRECTORY:WIDTHxHEIGHT[:crop]
+    """
+    if not source_config.get("variants"):
+        return None
+    return VariantPipeline(
+        [Variant.from_string(v) for v in source_config["variants"]], source_config.get("variant_workers", 2)
+    )
+
+
+def make_rate_limiter(config: dict) -> RateLimiter | None:
+    """
+    the rate limit of every source from the `rate_limit` key: requests_per_second, mb_per_second and file
+    """
+    rate_limit = config.get("rate_limit")
+    if not rate_limit:
+        return None
+    mb_per_second = rate_limit.get("mb_per_second")
+    return RateLimiter(
+        rate_limit.get("requests_per_second"),
+        mb_per_second * 1024**2 if mb_per_second else None,
+        rate_limit.get("file", RATE_LIMIT_FILE),
+    )
+
+
+def build_sources(config: dict, session: PooledSession, metrics: Metrics | None = None) -> list[Source]:
+    """
+    create every source in the config, they all share the same connection pool, metrics and rate limit
+    """
+    rate_limiter = make_rate_limiter(config)
+    sources = []
+    for i, source_config in enumerate(config["sources"]):
+        source_type = source_config["type"]
+        name = source_config.get("name", f"{source_type}-{i}")
+        retention_policy = make_retention_policy(source_config)
+        if source_type == "snowbasin":
+            probe_cache_path = source_config.get("probe_cache", PROBE_CACHE_FILE)
+            fetcher = SnowbasinImage(
+                source_config.get("folder_path", "~/Desktop/backgrounds/"),
+                store_previous_images=source_config.get("store_previous_images", True),
+                image_size=source_config.get("image_size", "1080"),
+                session=session,
+                discovery=source_config.get("discovery", "probe"),
+                retention_policy=retention_policy,
+                camera_id=source_config.get("camera_id", "prism-cam-00054"),
+                dedup=source_config.get("dedup", False),
+                similarity_threshold=source_config.get("similarity_threshold"),
+                variant_pipeline=make_variant_pipeline(source_config),
+                metrics=metrics,
+                probe_cache=ProbeCache(probe_cache_path) if probe_cache_path else None,
+                gap_fill=source_config.get("gap_fill", True),
+                rate_limiter=rate_limiter,
+                metrics_label=name,
+            )
+            process = fetcher.process
+            default_interval = 5
+        elif source_type == "nasa":
+            fetcher = BackgroundImageFetcher(
+                source_config.get("folder_path"),
+                store_previous_images=source_config.get("store_previous_images", True),
+                session=session,
+                source_name="nasa",
+                retention_policy=retention_policy,
+                dedup=source_config.get("dedup", False),
+                metrics=metrics,
+                rate_limiter=rate_limiter,
+                metrics_label=name,
+            )
+
+            def process(fetcher: BackgroundImageFetcher = fetcher) -> bool:
+                return update_nasa(fetcher)
+
+            default_interval = 60
+        else:
+            raise ValueError(f"Unknown source type: {source_type}")
+        sources.append(Source(name, process, 60 * source_config.get("interval_minutes", default_interval)))
+    return sources
+
+
+async def run_source(source: Source, metrics: Metrics | None = None, metrics_path: str | None = None) -> None:
+    """
+    run a source every interval until the daemon is stopped
+    an error is logged and the source tries again on its next interval
+    after every run the metrics are written to `metrics_path`, if there is one
+    """
+    while True:
+        try:
+            await asyncio.to_thread(source.process)
+        except Exception:
+            logger.exception(f"[red]{source.name} failed, trying again in {source.interval_seconds}s")
+            if metrics:
+                metrics.inc("source_failures_total", source=source.name)
+        if metrics and metrics_path:
+            metrics.write(metrics_path)
+        await asyncio.sleep(source.interval_seconds)
+
+
+async def run(config: dict) -> None:
+    """
+    run every source in one event loop with one shared connection pool
+    """
+    # a snowbasin source probes up to 5 minutes at once
+    session = PooledSession(pool_size=config.get("pool_size", max(10, 5 * len(config["sources"]))))
+    metrics = Metrics()
+    sources = build_sources(config, session, metrics)
+    logger.info(f"[blue]Running {len(sources)} sources: {', '.join(s.name for s in sources)}")
+    try:
+        await asyncio.gather(*(run_source(source, metrics, config.get("metrics_path")) for source in sources))
+    finally:
+        session.log_pool_stats()
+
+
+def main() -> None:
+    """
+    Main function to parse arguments and run the daemon
+    command line accessible through `backgrounds`
+    """
+    parser = argparse.ArgumentParser(description="Run every background source from one process.")
+    parser.add_argument(
+        "-c",
+        "--config",
+        type=str,
+        default="~/.config/backgrounds.json",
+        help="JSON file with the list of sources to run",
+    )
+    parser.add_argument(
+        "--log-format",
+        choices=LOG_FORMATS,
+        default=None,
+        help="rich in a terminal, plain or json for cron, defaults to $BACKGROUNDS_LOG_FORMAT or auto",
+    )
+    args = parser.parse_args()
+    configure_logging(args.log_format)
+    with open(os.path.expanduser(args.config)) as handler:
+        config = json.load(handler)
+    try:
+        asyncio.run(run(config))
+    except KeyboardInterrupt:
+        logger.info("[red]Daemon killed from keyboard interrupt. Exiting...")
+        exit(0)
+
+
+if __name__ == "__main__":
+    main()
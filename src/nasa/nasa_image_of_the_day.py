@@ -1,27 +1,111 @@
-import requests
-from bs4 import BeautifulSoup
+import codecs
+import datetime as dt
+import os
+from html.parser import HTMLParser
+from typing import TYPE_CHECKING
 
 from src.core.background import BackgroundImageFetcher
+from src.core.http_cache import HttpCache
 from src.core.logger import logger
 
+# requests is imported when it is used, most hourly runs already have today's image
+if TYPE_CHECKING:
+    import requests
 
-def get_main_page():
-    url = "https://www.nasa.gov/image-of-the-day/"
-    return requests.get(url, timeout=10)
+NASA_URL = "https://www.nasa.gov/image-of-the-day/"
+# kept in the background folder, it remembers the ETag / Last-Modified of the page and the image between runs
+HTTP_CACHE_FILE = ".nasa_http_cache.json"
+# bytes of the page read at a time, the gallery is near the top so we rarely read more than a few
+PAGE_CHUNK_SIZE = 16 * 1024
 
 
-def find_most_recent_image(soup: BeautifulSoup):
-    return soup.find("div", {"class": "hds-gallery-items"}).find("img")["src"]
+class GalleryImageParser(HTMLParser):
+    def __init__(self) -> None:
+        """
+        finds the src of the first <img> inside the first <div class="hds-gallery-items">
+        the page is fed a chunk at a time and we stop reading it once `image_url` is set
+        """
+        super().__init__()
+        self.image_url: str | None = None
+        # how many <div>s deep we are inside the gallery, 0 when we are outside of it
+        self.gallery_depth: int = 0
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, str | None]]) -> None:
+        if self.image_url:
+            return
+        if tag == "div":
+            if self.gallery_depth:
+                self.gallery_depth += 1
+            elif "hds-gallery-items" in (dict(attrs).get("class") or "").split():
+                self.gallery_depth = 1
+        elif tag == "img" and self.gallery_depth:
+            self.image_url = dict(attrs).get("src")
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag == "div" and self.gallery_depth:
+            self.gallery_depth -= 1
+
+
+def get_main_page(
+    session: "requests.Session | None" = None, url: str = NASA_URL, headers: dict[str, str] | None = None
+):
+    if session is None:
+        import requests as session
+    # streamed, so find_most_recent_image only reads the page up to the image
+    return session.get(url, timeout=10, stream=True, headers=headers)
+
+
+def find_most_recent_image(response: "requests.Response") -> str:
+    """
+    read the page until the first gallery image and return its url, the rest of the page is never downloaded
+    """
+    parser = GalleryImageParser()
+    decoder = codecs.getincrementaldecoder(response.encoding or "utf-8")(errors="replace")
+    try:
+        for chunk in response.iter_content(chunk_size=PAGE_CHUNK_SIZE):
+            parser.feed(decoder.decode(chunk))
+            if parser.image_url:
+                return parser.image_url
+    finally:
+        response.close()
+    raise ValueError(f"No hds-gallery-items image found on {response.url}")
+
+
+def update(nasa: BackgroundImageFetcher, url: str = NASA_URL) -> bool:
+    # there is one image a day, if we already have today's we don't need the page
+    current_file = nasa.get_current_files_in_directory()
+    if current_file and current_file == nasa.make_file_path_string(dt.date.today()):
+        logger.info(f"[yellow]Image already exists: {current_file}")
+        return False
+    if nasa.http_cache is None:
+        nasa.http_cache = HttpCache(os.path.join(os.path.expanduser(nasa.background_file_path), HTTP_CACHE_FILE))
+    cache = nasa.http_cache
+
+    # scrape nasa to get the most recent image, the page and the image share one connection pool
+    # the page is requested conditionally, a 304 means it still points to the image we have
+    response = get_main_page(nasa.session, url, cache.headers_for(url))
+    if response.status_code == 304:
+        response.close()
+        image_url = cache.get(url)["image_url"]
+        if current_file and cache.get(image_url).get("file") == current_file:
+            logger.info(f"[yellow]Image of the day hasn't changed: {image_url}")
+            return False
+        logger.info(f"[blue]Page hasn't changed, fetching its image again: {image_url}")
+    else:
+        response.raise_for_status()
+        image_url = find_most_recent_image(response)
+        cache.remember(url, response, image_url=image_url)
+    # process the image and save it to the file, the image is requested conditionally too
+    try:
+        return nasa.process(image_url)
+    finally:
+        cache.save()
 
 
 def main():
-    # scrape nasa to get the most recent image
-    response = get_main_page()
-    soup = BeautifulSoup(response.content, "html.parser")
-    image_url = find_most_recent_image(soup)
-    # process the image and save it to the file
-    nasa = BackgroundImageFetcher()
-    nasa.process(image_url)
+    nasa = BackgroundImageFetcher(source_name="nasa")
+    update(nasa)
+    nasa.log_pool_stats()
 
 
 if __name__ == "__main__":
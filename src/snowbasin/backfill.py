@@ -0,0 +1,257 @@
+import datetime as dt
+import glob
+import os
+import threading
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from src.core.logger import logger
+from src.snowbasin.cadence import HISTORY_PER_HOUR, probe_windows
+from src.snowbasin.probe_cache import MISS_TTL
+from src.snowbasin.snowbasin_image import SnowbasinImage
+
+# kept in the root of the backfill, one line per minute we have an answer for
+JOURNAL_FILE = ".backfill_journal"
+# a 404 younger than this may still be published, so it isn't recorded as missing
+MISSING_IS_FINAL_AFTER = dt.timedelta(hours=1)
+PROGRESS_EVERY_SECONDS = 5
+
+
+class BackfillJournal:
+    def __init__(self, file_path: str) -> None:
+        """
+        the minutes of a backfill we already have an answer for, so a rerun resumes where the last one stopped
+        every answer is appended as a line ("YYYY-MM-DDTHH:MM found" or "... missing YYYY-MM-DDTHH:MM:SS" with
+        when we asked) as soon as we know it, a line cut off by a crash is ignored on the next run
+        a minute is only recorded as found once its image is on disk
+        a missing minute is asked again once its 404 is older than MISS_TTL, like in the probe cache
+        """
+        self.file_path: str = os.path.expanduser(file_path)
+        self.found: set[dt.datetime] = set()
+        # minute -> when it returned a 404, None for lines from before that was journaled
+        self.missing: dict[dt.datetime, dt.datetime | None] = {}
+        self.lock = threading.Lock()
+        try:
+            with open(self.file_path) as handler:
+                for line in handler:
+                    self.load_line(line)
+        except FileNotFoundError:
+            pass
+        os.makedirs(os.path.dirname(self.file_path) or ".", exist_ok=True)
+
+    def load_line(self, line: str) -> None:
+        """
+        helper function
+        read one line of the journal
+        """
+        try:
+            minute, answer, *checked_at = line.split()
+            minute = dt.datetime.strptime(minute, "%Y-%m-%dT%H:%M")
+            checked_at = dt.datetime.fromisoformat(checked_at[0]) if checked_at else None
+        except ValueError:
+            return
+        if answer == "found":
+            self.found.add(minute)
+        elif answer == "missing":
+            self.missing[minute] = checked_at
+
+    def record(self, minute: dt.datetime, found: bool, checked_at: dt.datetime | None = None) -> None:
+        """
+        append the answer for a minute, the file is closed right away so an interrupted run keeps it
+        checked_at: when a missing minute returned its 404
+        """
+        with self.lock, open(self.file_path, "a") as handler:
+            if found:
+                self.found.add(minute)
+                handler.write(f"{minute:%Y-%m-%dT%H:%M} found\n")
+            else:
+                self.missing[minute] = checked_at
+                handler.write(f"{minute:%Y-%m-%dT%H:%M} missing {checked_at:%Y-%m-%dT%H:%M:%S}\n")
+
+    def is_missing(self, minute: dt.datetime, now: dt.datetime) -> bool:
+        """
+        True if the minute returned a 404 that hasn't expired yet
+        """
+        checked_at = self.missing.get(minute)
+        return checked_at is not None and now - checked_at < MISS_TTL
+
+
+class RangeBackfill:
+    def __init__(
+        self,
+        fetcher: SnowbasinImage,
+        root_directory: str,
+        workers: int = 1,
+        poll_frequency: float = 0,
+    ) -> None:
+        """
+        pull every image between two dates into root_directory/YYYY-MM-DD/
+        the range is split into 5 minute windows, the camera takes at most one picture in each of them
+        a window is probed one minute at a time (the likely minute first, see CadencePredictor) and stops at the
+        first image, `workers` windows are probed at the same time
+        with a bucket listing only the listed images are requested
+        timestamps already on disk and minutes in the journal are never requested again
+        """
+        self.fetcher: SnowbasinImage = fetcher
+        self.root_directory: str = os.path.expanduser(root_directory)
+        self.workers: int = workers
+        self.poll_frequency: float = poll_frequency
+        self.journal = BackfillJournal(os.path.join(self.root_directory, JOURNAL_FILE))
+        self.lock = threading.Lock()
+        # progress across the whole range
+        self.total: int = 0
+        self.done: int = 0
+        self.images_found: int = 0
+        self.requests: int = 0
+        self.started_at: float = 0
+        self.last_progress_at: float = 0
+
+    def day_directory(self, minute: dt.datetime) -> str:
+        """
+        helper function
+        where the image of a minute is saved, the same layout `snowbasin -d` uses
+        """
+        return os.path.join(self.root_directory, f"{minute:%Y-%m-%d}")
+
+    def file_path(self, minute: dt.datetime) -> str:
+        """
+        helper function
+        """
+        return os.path.join(self.day_directory(minute), self.fetcher.make_file_path_string(minute, full_path=False))
+
+    def on_disk(self, start: dt.date, end: dt.date) -> set[dt.datetime]:
+        """
+        the capture times we already have in the day folders of the range (one extra day for the last window)
+        """
+        capture_times = set()
+        for day in range((end - start).days + 2):
+            directory = self.day_directory(dt.datetime.combine(start, dt.time()) + dt.timedelta(days=day))
+            for file_path in glob.glob(os.path.join(directory, "*.jpg")):
+                try:
+                    capture_times.add(dt.datetime.strptime(os.path.basename(file_path), "%Y-%m-%d-%H-%M.jpg"))
+                except ValueError:
+                    continue
+        return capture_times
+
+    def windows(self, start: dt.date, end: dt.date, known: set[dt.datetime]) -> list[list[dt.datetime]]:
+        """
+        the minutes we still have to probe, grouped by window and newest first inside a window
+        the windows end on the round 5 minutes (see probe_windows), the first one of a day is 00:01 to 00:05
+        a window with a known image is done, minutes known to be missing are left out
+        """
+        now = self.fetcher.clock()
+        windows = []
+        first = dt.datetime.combine(start, dt.time())
+        for minutes in probe_windows(first, dt.datetime.combine(end, dt.time()) + dt.timedelta(days=1)):
+            if not any(minute in known for minute in minutes):
+                minutes = [minute for minute in minutes if not self.journal.is_missing(minute, now)]
+                if minutes:
+                    windows.append(minutes)
+        return windows
+
+    def listed(self, start: dt.date, end: dt.date, known: set[dt.datetime]) -> list[list[dt.datetime]]:
+        """
+        the listed images we don't have yet, one minute per window
+        a day that can't be listed is probed instead (see windows)
+        """
+        windows = []
+        for day in range((end - start).days + 1):
+            date = start + dt.timedelta(days=day)
+            captures = self.fetcher.listing.try_list_captures(dt.datetime.combine(date, dt.time()))
+            if captures is None:
+                windows.extend(self.windows(date, date, known))
+            else:
+                windows.extend([capture] for capture in captures if capture not in known)
+        return windows
+
+    def run(self, start: dt.date, end: dt.date) -> int:
+        """
+        backfill every day from start to end (both included)
+        returns the number of images downloaded
+        """
+        known = self.on_disk(start, end) | self.journal.found
+        self.fetcher.cadence.learn_from_times(sorted(known)[-24 * HISTORY_PER_HOUR :])
+        windows = self.listed(start, end, known) if self.fetcher.listing else self.windows(start, end, known)
+        self.total = len(windows)
+        logger.info(
+            f"[blue]Backfilling {start} to {end}: {len(known)} images already here, "
+            f"{self.total} windows to check with {self.workers} workers"
+        )
+        self.fetcher.session.ensure_pool_size(self.workers)
+        self.started_at = self.last_progress_at = time.monotonic()
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            futures = [executor.submit(self.probe_window, minutes) for minutes in windows]
+            for future in as_completed(futures):
+                file_path = future.result()
+                with self.lock:
+                    self.done += 1
+                    self.images_found += bool(file_path)
+                if file_path:
+                    logger.info(f"[green]Image downloaded and saved to: {file_path}")
+                self.log_progress()
+            executor.shutdown()
+        except KeyboardInterrupt:
+            # the journal already has everything that finished, the next run picks up the rest
+            executor.shutdown(wait=False, cancel_futures=True)
+            logger.info(f"[red]Backfill interrupted after {self.done}/{self.total} windows, rerun to resume")
+            raise
+        self.log_progress(force=True)
+        self.fetcher.log_pool_stats()
+        if self.fetcher.probe_cache:
+            self.fetcher.probe_cache.log_stats()
+        return self.images_found
+
+    def probe_window(self, minutes: list[dt.datetime]) -> str | None:
+        """
+        helper function
+        probe a window with SnowbasinImage.probe_window, the image goes into its day folder and the journal
+        returns the file path of the image, or None if the window has none
+        """
+        return self.fetcher.probe_window(minutes, self.store, self.before_request, self.on_missing)
+
+    def store(self, minute: dt.datetime, write: Callable[[str], str | None]) -> str:
+        """
+        helper function
+        """
+        file_path = self.file_path(minute)
+        os.makedirs(self.day_directory(minute), exist_ok=True)
+        write(file_path)
+        self.journal.record(minute, found=True)
+        return file_path
+
+    def before_request(self) -> None:
+        """
+        helper function
+        """
+        time.sleep(self.poll_frequency)
+        with self.lock:
+            self.requests += 1
+
+    def on_missing(self, minute: dt.datetime) -> None:
+        """
+        helper function
+        a 404 that may still be published (and anything but a 404) is asked again on the next run
+        """
+        now = self.fetcher.clock()
+        if now - minute > MISSING_IS_FINAL_AFTER:
+            self.journal.record(minute, found=False, checked_at=now)
+
+    def log_progress(self, force: bool = False) -> None:
+        """
+        helper function
+        log how far we are in the whole range and when we should be done, at most every few seconds
+        """
+        now = time.monotonic()
+        if not force and now - self.last_progress_at < PROGRESS_EVERY_SECONDS:
+            return
+        self.last_progress_at = now
+        elapsed = now - self.started_at
+        rate = self.done / elapsed if elapsed else 0
+        eta = dt.timedelta(seconds=round((self.total - self.done) / rate)) if rate else "unknown"
+        percent = 100 * self.done / self.total if self.total else 100
+        logger.info(
+            f"[blue]Backfill progress: {self.done}/{self.total} windows ({percent:.1f}%), "
+            f"{self.images_found} images, {self.requests} requests, {rate:.1f} windows/sec, ETA {eta}"
+        )
@@ -0,0 +1,94 @@
+import datetime as dt
+from typing import TYPE_CHECKING
+
+from src.core.logger import logger
+
+if TYPE_CHECKING:
+    import requests
+
+# the JSON API of google cloud storage, a stand-in server can be used by passing a different api_url
+STORAGE_API_URL = "https://storage.googleapis.com/storage/v1"
+
+
+class BucketListing:
+    def __init__(
+        self,
+        base_url: str,
+        image_size: str,
+        session: "requests.Session",
+        api_url: str = STORAGE_API_URL,
+    ) -> None:
+        """
+        find images by listing the bucket instead of guessing urls
+        base_url: the public url of the bucket, e.g. https://storage.googleapis.com/prism-cam-00054
+        image_size: only objects named `{image_size}.jpg` are returned
+        the objects are laid out as YYYY/MM/DD/HH-MM/{image_size}.jpg
+        """
+        self.bucket: str = base_url.rstrip("/").rsplit("/", 1)[-1]
+        self.image_size: str = image_size
+        self.session: requests.Session = session
+        self.api_url: str = api_url.rstrip("/")
+
+    def list_prefix(self, prefix: str) -> list[str]:
+        """
+        return the name of every object that starts with the prefix, following every page
+        """
+        names = []
+        params = {"prefix": prefix, "fields": "items(name),nextPageToken"}
+        while True:
+            resp = self.session.get(f"{self.api_url}/b/{self.bucket}/o", params=params)
+            resp.raise_for_status()
+            listing = resp.json()
+            names.extend(item["name"] for item in listing.get("items", []))
+            if not listing.get("nextPageToken"):
+                return names
+            params["pageToken"] = listing["nextPageToken"]
+
+    def list_captures(self, date: dt.datetime, hour: int | None = None) -> list[dt.datetime]:
+        """
+        return the capture time of every image for the day (or just one hour of it), oldest first
+        """
+        prefix = date.strftime("%Y/%m/%d/")
+        if hour is not None:
+            prefix += f"{hour:02d}-"
+        captures = []
+        for name in self.list_prefix(prefix):
+            # YYYY/MM/DD/HH-MM/size.jpg
+            *day_and_time, file_name = name.split("/")
+            if file_name != f"{self.image_size}.jpg":
+                continue
+            try:
+                captures.append(dt.datetime.strptime("/".join(day_and_time), "%Y/%m/%d/%H-%M"))
+            except ValueError:
+                continue
+        logger.info(f"[blue]Listed {len(captures)} images under {self.bucket}/{prefix}")
+        return sorted(captures)
+
+    def try_list_captures(self, date: dt.datetime) -> list[dt.datetime] | None:
+        """
+        same as list_captures for the whole day, but None if the bucket can't be listed (an http error, a timeout
+        or a malformed page) so the caller can fall back to probing that day
+        """
+        import requests
+
+        try:
+            return self.list_captures(date)
+        except (requests.RequestException, ValueError) as e:
+            logger.warning(f"[red]Could not list {date:%Y-%m-%d} in the bucket, probing it instead: {e}")
+            return None
+
+    def filter_existing(self, candidates: list[dt.datetime]) -> list[dt.datetime]:
+        """
+        keep the candidate minutes that are in the bucket
+        every hour the candidates touch is listed once
+        if the bucket can't be listed, the candidates are returned unchanged so we fall back to probing
+        """
+        import requests
+
+        hours = sorted({c.replace(minute=0, second=0, microsecond=0) for c in candidates})
+        try:
+            existing = {capture for hour in hours for capture in self.list_captures(hour, hour.hour)}
+        except (requests.RequestException, ValueError) as e:
+            logger.warning(f"[red]Could not list the bucket, probing instead: {e}")
+            return candidates
+        return [c for c in candidates if c.replace(second=0, microsecond=0) in existing]
@@ -0,0 +1,136 @@
+import datetime as dt
+import glob
+import os
+import statistics
+from collections import Counter, deque
+
+from src.core.logger import logger
+
+# the newest observations per hour that the model keeps, older ones fall off so drift is followed
+HISTORY_PER_HOUR = 50
+# how many observations an hour needs before we trust its prediction
+MIN_OBSERVATIONS = 3
+# we only probe the round minute and the 4 minutes before it
+MAX_OFFSET = 4
+# the camera takes at most one picture in a window of this many minutes
+WINDOW_MINUTES = MAX_OFFSET + 1
+
+
+def probe_windows(start: dt.datetime, end: dt.datetime) -> list[list[dt.datetime]]:
+    """
+    every minute after `start` up to and including `end`, grouped in the windows the camera takes at most one
+    picture in: WINDOW_MINUTES long and ending on the round 5 minutes (a window is a slot and the minutes before it)
+    oldest window first, newest minute first inside a window, the first and last window may be cut short
+    """
+    start, end = start.replace(second=0, microsecond=0), end.replace(second=0, microsecond=0)
+    first = start + dt.timedelta(minutes=1)
+    window_end = first + dt.timedelta(minutes=-first.minute % WINDOW_MINUTES)
+    windows = []
+    while window_end - dt.timedelta(minutes=WINDOW_MINUTES - 1) <= end:
+        minutes = [window_end - dt.timedelta(minutes=i) for i in range(WINDOW_MINUTES)]
+        windows.append([minute for minute in minutes if start < minute <= end])
+        window_end += dt.timedelta(minutes=WINDOW_MINUTES)
+    return windows
+
+
+class CadencePredictor:
+    def __init__(self, history_per_hour: int = HISTORY_PER_HOUR, min_observations: int = MIN_OBSERVATIONS) -> None:
+        """
+        learns when the camera actually takes its pictures
+        for every hour of the day we keep the offset (in minutes) between the slot we ask for and
+        the minute the image was really captured, e.g. asking for 10:15 and finding 10:13 is an offset of 2
+        """
+        self.min_observations: int = min_observations
+        self.offsets: dict[int, deque[int]] = {hour: deque(maxlen=history_per_hour) for hour in range(24)}
+
+    @staticmethod
+    def slot_period(hour: int) -> int:
+        """
+        minutes between pictures for the given hour
+        matches the schedule in SnowbasinImage.find_next_image_time
+        """
+        return 5 if 8 <= hour <= 18 else 15
+
+    def slot_for(self, capture_time: dt.datetime) -> dt.datetime:
+        """
+        the slot (the time find_next_image_time would ask for) that a capture belongs to
+        """
+        capture_time = capture_time.replace(second=0, microsecond=0)
+        if self.slot_period(capture_time.hour) == 5:
+            return capture_time + dt.timedelta(minutes=-capture_time.minute % 5)
+        # at night the slots are :05, :20, :35 and :50
+        return capture_time + dt.timedelta(minutes=(5 - capture_time.minute) % 15)
+
+    def learn(self, capture_time: dt.datetime) -> None:
+        """
+        record a capture time we know exists
+        """
+        slot = self.slot_for(capture_time)
+        offset = int((slot - capture_time.replace(second=0, microsecond=0)).total_seconds() // 60)
+        # the model is keyed on the hour of the slot, that is what we know when we predict
+        if offset <= MAX_OFFSET:
+            self.offsets[slot.hour].append(offset)
+
+    def learn_from_directory(self, directory: str, limit: int = 24 * HISTORY_PER_HOUR) -> int:
+        """
+        learn from the YYYY-MM-DD-HH-MM.jpg files in a directory
+        only the newest `limit` files are used
+        returns the number of files learned from
+        """
+        capture_times = []
+        for file_path in glob.glob(os.path.join(os.path.expanduser(directory), "*.jpg")):
+            try:
+                capture_times.append(dt.datetime.strptime(os.path.basename(file_path), "%Y-%m-%d-%H-%M.jpg"))
+            except ValueError:
+                continue
+        return self.learn_from_times(sorted(capture_times)[-limit:])
+
+    def learn_from_times(self, capture_times: list[dt.datetime]) -> int:
+        """
+        learn from a list of capture times, oldest first
+        returns the number of capture times learned from
+        """
+        for capture_time in capture_times:
+            self.learn(capture_time)
+        logger.info(f"[blue]Learned the camera cadence from {len(capture_times)} images")
+        return len(capture_times)
+
+    def offset_stats(self, hour: int) -> tuple[float, float] | None:
+        """
+        mean offset and jitter (standard deviation) in minutes for the hour
+        None if we haven't seen enough images for that hour
+        """
+        offsets = self.offsets[hour]
+        if len(offsets) < self.min_observations:
+            return None
+        return statistics.fmean(offsets), statistics.pstdev(offsets)
+
+    def offsets_for(self, hour: int) -> list[int]:
+        """
+        helper function
+        the offsets to predict the hour with: its own once it has min_observations of them,
+        else every hour on the same schedule (day or night), else every hour, empty if even that isn't enough
+        """
+        if len(self.offsets[hour]) >= self.min_observations:
+            return list(self.offsets[hour])
+        period = self.slot_period(hour)
+        same_schedule = [o for h, offsets in self.offsets.items() if self.slot_period(h) == period for o in offsets]
+        if len(same_schedule) >= self.min_observations:
+            return same_schedule
+        every_hour = [o for offsets in self.offsets.values() for o in offsets]
+        return every_hour if len(every_hour) >= self.min_observations else []
+
+    def most_likely(self, candidates: list[dt.datetime], slot: dt.datetime) -> dt.datetime | None:
+        """
+        given the candidate minutes of a slot (newest first, any of them may have been left out already)
+        return the one the camera most likely used, or None if we don't know enough yet
+        or the camera never used any of them
+        ties go to the newest candidate
+        """
+        if not candidates:
+            return None
+        counts = Counter(self.offsets_for(slot.hour))
+        best = max(candidates, key=lambda c: (counts[int((slot - c).total_seconds() // 60)], c))
+        if not counts[int((slot - best).total_seconds() // 60)]:
+            return None
+        return best
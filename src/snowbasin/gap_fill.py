@@ -0,0 +1,188 @@
+import datetime as dt
+import json
+import os
+import queue
+import tempfile
+import threading
+import time
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
+
+from src.core.logger import logger
+from src.snowbasin.cadence import probe_windows
+
+if TYPE_CHECKING:
+    from src.snowbasin.snowbasin_image import SnowbasinImage
+
+# a new image further than this from the one it replaces means the loop missed images (the camera posts at least
+# every 15 minutes, plus a few minutes of jitter), shorter gaps are the normal schedule
+GAP_THRESHOLD = dt.timedelta(minutes=30)
+# seconds between two gap fill requests, so the backlog never competes with the live update for the bucket
+GAP_FILL_PAUSE_SECONDS = 0.5
+# the gaps that aren't filled yet are kept in the archive state table, so a restart picks them up
+PENDING_GAPS_KEY = "gap_fill_pending"
+
+
+class GapFiller:
+    def __init__(self, fetcher: "SnowbasinImage", pause: float = GAP_FILL_PAUSE_SECONDS) -> None:
+        """
+        fills the archive with the images the live loop missed while the machine slept or the loop was down
+        the live update only fetches the newest image, so the wallpaper is current right away,
+        and hands the gap to this filler
+        a single background thread probes the gap one 5 minute window at a time, newest first, and archives what
+        it finds (minutes already archived or known to the probe cache aren't requested)
+        it is low priority: it makes one request at a time, pauses between them and waits while a live update runs
+        (its requests also leave the live reserve of the rate limiter alone)
+        the retention policy thins the gap images with the rest of the archive on the next live update
+        """
+        self.fetcher: SnowbasinImage = fetcher
+        self.pause: float = pause
+        self.gaps: queue.Queue[tuple[dt.datetime, dt.datetime]] = queue.Queue()
+        # set while no live update is running, the filler only sends a request when it is set
+        self.live_idle = threading.Event()
+        self.live_idle.set()
+        self.lock = threading.Lock()
+        self.thread: threading.Thread | None = None
+        self.images_found: int = 0
+        self.requests: int = 0
+
+    @contextmanager
+    def live_update(self) -> Iterator[None]:
+        """
+        hold the filler back while the live update runs
+        """
+        self.live_idle.clear()
+        try:
+            yield
+        finally:
+            self.live_idle.set()
+
+    def pending(self) -> list[tuple[dt.datetime, dt.datetime]]:
+        """
+        helper function
+        the gaps recorded in the archive that aren't filled yet
+        """
+        value = self.fetcher.archive.get_state(f"{PENDING_GAPS_KEY}:{self.fetcher.source_name}")
+        return [(dt.datetime.fromisoformat(a), dt.datetime.fromisoformat(b)) for a, b in json.loads(value or "[]")]
+
+    def set_pending(self, gaps: list[tuple[dt.datetime, dt.datetime]]) -> None:
+        """
+        helper function
+        """
+        value = json.dumps([[after.isoformat(), before.isoformat()] for after, before in gaps])
+        self.fetcher.archive.set_state(f"{PENDING_GAPS_KEY}:{self.fetcher.source_name}", value)
+
+    def resume(self) -> None:
+        """
+        queue the gaps an earlier run didn't get to fill
+        """
+        for after, before in self.pending():
+            logger.info(f"[blue]Resuming the gap fill from {after} to {before}")
+            self.queue_gap(after, before)
+
+    def submit(self, after: dt.datetime, before: dt.datetime) -> None:
+        """
+        fill the images captured after `after` and before `before` (the image we had and the new one)
+        nothing happens if they are closer than GAP_THRESHOLD
+        """
+        if before - after <= GAP_THRESHOLD:
+            return
+        logger.info(f"[yellow]Missed the images from {after} to {before}, filling them in the background")
+        with self.lock:
+            self.set_pending(self.pending() + [(after, before)])
+        self.queue_gap(after, before)
+
+    def queue_gap(self, after: dt.datetime, before: dt.datetime) -> None:
+        """
+        helper function
+        queue a gap and start the thread if it isn't running
+        """
+        with self.lock:
+            self.gaps.put((after, before))
+            if self.thread is None:
+                # a daemon thread never keeps the process alive, an unfinished gap is still pending next time
+                self.thread = threading.Thread(target=self.run, name="gap-fill", daemon=True)
+                self.thread.start()
+
+    def run(self) -> None:
+        """
+        helper function
+        the background thread, fills the queued gaps one after the other (the newest gap first)
+        """
+        while True:
+            with self.lock:
+                if self.gaps.empty():
+                    self.thread = None
+                    return
+                gaps = []
+                while not self.gaps.empty():
+                    gaps.append(self.gaps.get_nowait())
+            for after, before in sorted(gaps, reverse=True):
+                try:
+                    self.fill(after, before)
+                except Exception as e:
+                    # the gap stays pending, the next run tries again
+                    logger.error(f"[red]Gap fill from {after} to {before} failed: {e}")
+                    continue
+                with self.lock:
+                    self.set_pending([gap for gap in self.pending() if gap != (after, before)])
+
+    def windows(self, after: dt.datetime, before: dt.datetime) -> list[list[dt.datetime]]:
+        """
+        the minutes strictly between `after` and `before`, grouped in 5 minute windows ending on the round
+        5 minutes (see probe_windows), newest window first and newest minute first inside a window
+        windows that already have an archived image (loose or packed) are left out
+        """
+        archived = self.fetcher.archive.capture_times_between(after, before, self.fetcher.source_name)
+        windows = probe_windows(after, before.replace(second=0, microsecond=0) - dt.timedelta(minutes=1))
+        return [minutes for minutes in reversed(windows) if not any(minute in archived for minute in minutes)]
+
+    def fill(self, after: dt.datetime, before: dt.datetime) -> int:
+        """
+        probe every window of a gap and archive the images we find
+        returns the number of images archived
+        """
+        started_at = time.monotonic()
+        found = 0
+        windows = self.windows(after, before)
+        for minutes in windows:
+            found += self.probe_window(minutes)
+        logger.info(
+            f"[green]Filled the gap from {after} to {before}: {found} images archived from {len(windows)} windows "
+            f"in {time.monotonic() - started_at:.0f}s"
+        )
+        return found
+
+    def probe_window(self, minutes: list[dt.datetime]) -> bool:
+        """
+        helper function
+        probe a window with SnowbasinImage.probe_window, the image goes into the archive
+        returns True if the window had an image
+        """
+        return self.fetcher.probe_window(minutes, self.store, self.before_request, background=True) is not None
+
+    def store(self, minute: dt.datetime, write: Callable[[str], str | None]) -> str:
+        """
+        helper function
+        write the image next to the archive and move it in
+        """
+        fetcher = self.fetcher
+        with tempfile.TemporaryDirectory(dir=fetcher.archive.root, prefix=".gap-") as directory:
+            file_path = os.path.join(directory, fetcher.make_file_path_string(minute, full_path=False))
+            sha256 = write(file_path)
+            archived_path = fetcher.archive.add(file_path, minute, fetcher.source_name, sha256)
+        fetcher.metrics.inc("gap_fill_images_total", source=fetcher.metrics_label)
+        self.images_found += 1
+        logger.info(f"[green]Gap image archived to: {archived_path}")
+        return archived_path
+
+    def before_request(self) -> None:
+        """
+        helper function
+        the live update goes first
+        """
+        self.live_idle.wait()
+        time.sleep(self.pause)
+        self.requests += 1
+        self.fetcher.metrics.inc("gap_fill_requests_total", source=self.fetcher.metrics_label)
@@ -3,32 +3,112 @@ import argparse
 import datetime as dt
 import time
 
+from src.core.logger import LOG_FORMATS, configure_logging
+from src.core.rate_limit import RATE_LIMIT_FILE, RateLimiter
+from src.core.retention import RetentionPolicy
+from src.core.variants import Variant, VariantPipeline
+from src.snowbasin.backfill import RangeBackfill
+from src.snowbasin.probe_cache import PROBE_CACHE_FILE, ProbeCache
 from src.snowbasin.snowbasin_image import SnowbasinImage, logger
+from src.snowbasin.wakeup import WakeupScheduler
 
+# -d and --from/--to save every day in its own folder in here
+BACKFILL_DIRECTORY = "~/Documents/backgrounds/"
 
-def once(folder_path: str) -> None:
+
+def once(
+    folder_path: str,
+    discovery: str = "probe",
+    retention_policy: RetentionPolicy | None = None,
+    dedup: bool = False,
+    similarity_threshold: int | None = None,
+    variant_pipeline: VariantPipeline | None = None,
+    metrics_path: str | None = None,
+    probe_cache: ProbeCache | None = None,
+    rate_limiter: RateLimiter | None = None,
+) -> None:
     """
     Run the script once and exit
     """
-    s = SnowbasinImage(folder_path)
+    s = SnowbasinImage(
+        folder_path,
+        discovery=discovery,
+        retention_policy=retention_policy,
+        dedup=dedup,
+        similarity_threshold=similarity_threshold,
+        variant_pipeline=variant_pipeline,
+        probe_cache=probe_cache,
+        rate_limiter=rate_limiter,
+    )
     s.process()
+    s.log_pool_stats()
+    if probe_cache:
+        probe_cache.log_stats()
+    if metrics_path:
+        s.metrics.write(metrics_path)
+    if variant_pipeline:
+        variant_pipeline.shutdown()
 
 
-def constant(folder_path: str, minute_interval: int = 5) -> None:
+def constant(
+    folder_path: str,
+    minute_interval: int | None = None,
+    discovery: str = "probe",
+    retention_policy: RetentionPolicy | None = None,
+    dedup: bool = False,
+    similarity_threshold: int | None = None,
+    variant_pipeline: VariantPipeline | None = None,
+    metrics_path: str | None = None,
+    probe_cache: ProbeCache | None = None,
+    gap_fill: bool = True,
+    rate_limiter: RateLimiter | None = None,
+) -> None:
     """
-    Run the script constantly and check for new images every minute_interval minutes
+    Run the script constantly
+    if minute_interval is given we check for new images every minute_interval minutes
+    otherwise we wake up when the camera should have published its next image (see WakeupScheduler)
+    with gap_fill, images missed while the machine slept or the loop was down are archived in the background
     """
     try:
-        s = SnowbasinImage(folder_path)
+        s = SnowbasinImage(
+            folder_path,
+            discovery=discovery,
+            retention_policy=retention_policy,
+            dedup=dedup,
+            similarity_threshold=similarity_threshold,
+            variant_pipeline=variant_pipeline,
+            probe_cache=probe_cache,
+            gap_fill=gap_fill,
+            rate_limiter=rate_limiter,
+        )
+        scheduler = WakeupScheduler(s.cadence)
         while True:
+            last_image_time = s.last_image_time
             s.process()
-            time.sleep(60 * minute_interval)
+            s.log_pool_stats()
+            if probe_cache:
+                probe_cache.log_stats()
+            if metrics_path:
+                s.metrics.write(metrics_path)
+            if minute_interval:
+                time.sleep(60 * minute_interval)
+                continue
+            new_image_time = s.last_image_time if s.last_image_time != last_image_time else None
+            time.sleep(scheduler.record(new_image_time, s.last_image_time or s.seen_image_date, dt.datetime.now()))
     except KeyboardInterrupt:
         logger.info("[red]Script killed from keyboard interrupt. Exiting...")
         exit(0)
 
 
-def one_day(date: str, polling_frequency: int) -> None:
+def one_day(
+    date: str,
+    polling_frequency: int,
+    workers: int = 1,
+    discovery: str = "probe",
+    metrics_path: str | None = None,
+    probe_cache: ProbeCache | None = None,
+    rate_limiter: RateLimiter | None = None,
+) -> None:
     """
     Attempt to pull images for an entire day
 
@@ -39,13 +119,96 @@ def one_day(date: str, polling_frequency: int) -> None:
     polling_frequency: int
         how often to check for new images in seconds
         default is 1 second
+    workers: int
+        how many minutes to probe at the same time
+        default is 1 (serial)
+    discovery: str
+        "probe" to guess every minute, "listing" to list the bucket and only pull what exists
+    metrics_path: str
+        write the request counters and timings here when the day is done (.prom or .json)
+    probe_cache: ProbeCache
+        minutes we already asked about aren't requested again
+    rate_limiter: RateLimiter
+        caps the requests and bytes per second, the day leaves the live reserve to live updates
     """
-    file_path = f"~/Documents/backgrounds/{date}/"
-    s = SnowbasinImage(background_directory=file_path)
+    file_path = f"{BACKFILL_DIRECTORY}{date}/"
+    s = SnowbasinImage(
+        background_directory=file_path, discovery=discovery, probe_cache=probe_cache, rate_limiter=rate_limiter
+    )
+    s.background_requests = True
     # convert string date to datetime
     d = dt.datetime.strptime(date, "%Y-%m-%d")
-    result = s.pull_one_day_to_old_backgrounds(d, polling_frequency)
+    result = s.pull_one_day_to_old_backgrounds(d, polling_frequency, workers)
     logger.info(f"We found {result} images for {date}. Saved to {file_path}")
+    if probe_cache:
+        probe_cache.log_stats()
+    if metrics_path:
+        s.metrics.write(metrics_path)
+
+
+def backfill(
+    start: str,
+    end: str | None,
+    polling_frequency: float,
+    workers: int = 1,
+    discovery: str = "probe",
+    metrics_path: str | None = None,
+    probe_cache: ProbeCache | None = None,
+    rate_limiter: RateLimiter | None = None,
+) -> None:
+    """
+    Pull every image from start to end (YYYY-MM-DD, both included) into the same folders as one_day
+    the backfill keeps a journal, so running it again resumes where it stopped (see RangeBackfill)
+    """
+    s = SnowbasinImage(
+        background_directory=BACKFILL_DIRECTORY,
+        store_previous_images=False,
+        discovery=discovery,
+        probe_cache=probe_cache,
+        rate_limiter=rate_limiter,
+    )
+    s.background_requests = True
+    start_date = dt.datetime.strptime(start, "%Y-%m-%d").date()
+    end_date = dt.datetime.strptime(end, "%Y-%m-%d").date() if end else start_date
+    if end_date < start_date:
+        logger.error("[red]--to has to be on or after --from")
+        exit(1)
+    try:
+        result = RangeBackfill(s, BACKFILL_DIRECTORY, workers, polling_frequency).run(start_date, end_date)
+    except KeyboardInterrupt:
+        exit(1)
+    logger.info(f"We found {result} new images from {start_date} to {end_date}. Saved to {BACKFILL_DIRECTORY}")
+    if metrics_path:
+        s.metrics.write(metrics_path)
+
+
+def migrate_archive(folder_path: str) -> None:
+    """
+    One time migration of a flat `old_backgrounds` folder into the sharded, indexed layout
+    """
+    s = SnowbasinImage(folder_path)
+    s.archive.migrate_flat(s.source_name)
+
+
+def compact_archive(folder_path: str, days_to_keep: int) -> None:
+    """
+    Move every archived day older than `days_to_keep` days into the monthly packs (see ImageArchive.compact)
+    """
+    s = SnowbasinImage(folder_path)
+    s.archive.compact(dt.date.today() - dt.timedelta(days=max(days_to_keep, 1) - 1), s.source_name)
+
+
+def scrub(folder_path: str, probe_cache: ProbeCache | None = None, rate_limiter: RateLimiter | None = None) -> None:
+    """
+    Check every image in `old_backgrounds` for truncated or corrupt files and download the bad ones again
+    """
+    s = SnowbasinImage(folder_path, probe_cache=probe_cache, rate_limiter=rate_limiter)
+    s.background_requests = True
+    checked, bad, fixed = s.scrub_archive()
+    s.log_pool_stats()
+    if bad > fixed:
+        logger.error(f"[red]{bad - fixed} of {checked} archived images are still bad")
+        exit(1)
 
 
 def main() -> None:
@@ -65,8 +228,8 @@ def main() -> None:
         "-m",
         "--minute-interval",
         type=int,
-        default=5,
-        help="how often to check for new images in minutes",
+        default=None,
+        help="check for new images every -m minutes instead of when the camera should have published one",
     )
     parser.add_argument(
         "-f",
@@ -82,24 +245,218 @@ def main() -> None:
         default=None,
         help="pull images for a specific day. format: YYYY-MM-DD",
     )
+    parser.add_argument(
+        "--from",
+        dest="from_date",
+        type=str,
+        default=None,
+        help="pull every image from this day on, resuming an earlier run. format: YYYY-MM-DD",
+    )
+    parser.add_argument(
+        "--to",
+        dest="to_date",
+        type=str,
+        default=None,
+        help="used with --from, the last day to pull (included), defaults to --from. format: YYYY-MM-DD",
+    )
     parser.add_argument(
         "-s",
         "--polling-frequency-seconds",
         type=int,
         default=1,
-        help="used with -d, how often to check for new images in seconds",
+        help="used with -d and --from, how often to check for new images in seconds",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="used with -d and --from, how many requests to make at the same time",
+    )
+    parser.add_argument(
+        "--discovery",
+        choices=["probe", "listing"],
+        default="probe",
+        help="find images by probing urls or by listing the storage bucket",
+    )
+    parser.add_argument(
+        "--migrate-archive",
+        action="store_true",
+        help="move a flat old_backgrounds folder into the old_backgrounds/YYYY/MM/DD/ layout and exit",
+    )
+    parser.add_argument(
+        "--compact-archive",
+        type=int,
+        nargs="?",
+        const=1,
+        default=None,
+        metavar="DAYS",
+        help="pack every archived day except the last DAYS (default 1, today) into monthly pack files and exit",
+    )
+    parser.add_argument(
+        "--scrub",
+        action="store_true",
+        help="check old_backgrounds for truncated or corrupt images, download the bad ones again and exit",
+    )
+    parser.add_argument(
+        "--retention",
+        type=str,
+        default=None,
+        help="thin the archive with AGE:EVERY rules, e.g. 7d:1h,90d:1d (EVERY can be none to delete)",
+    )
+    parser.add_argument(
+        "--max-archive-gb",
+        type=float,
+        default=None,
+        help="delete the oldest archived images once the archive is bigger than this",
+    )
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="store identical archived images once and skip frames identical to the current background",
+    )
+    parser.add_argument(
+        "--similarity-threshold",
+        type=int,
+        default=None,
+        help="skip frames within this many bits (0-64) of the current background's perceptual hash, needs Pillow",
+    )
+    parser.add_argument(
+        "--variant",
+        type=str,
+        action="append",
+        default=[],
+        help="also write every new image resized for another display, DIRECTORY:WIDTHxHEIGHT[:crop] (repeatable)",
+    )
+    parser.add_argument(
+        "--variant-workers",
+        type=int,
+        default=2,
+        help="used with --variant, how many processes resize images",
+    )
+    parser.add_argument(
+        "--metrics",
+        type=str,
+        default=None,
+        help="write stage timings and request counters to this file after every run, .prom (Prometheus) or .json",
+    )
+    parser.add_argument(
+        "--probe-cache",
+        type=str,
+        default=PROBE_CACHE_FILE,
+        help="remember which minutes have an image (and which were 404s) in this file, shared by every run",
+    )
+    parser.add_argument(
+        "--no-probe-cache",
+        action="store_true",
+        help="ask the bucket about every minute, even the ones we already asked about",
+    )
+    parser.add_argument(
+        "--max-requests-per-second",
+        type=float,
+        default=None,
+        help="cap the image requests of every run that shares --rate-limit-file",
+    )
+    parser.add_argument(
+        "--max-mb-per-second",
+        type=float,
+        default=None,
+        help="cap the image downloads (in MB per second) of every run that shares --rate-limit-file",
+    )
+    parser.add_argument(
+        "--rate-limit-file",
+        type=str,
+        default=RATE_LIMIT_FILE,
+        help="where the rate limit is kept, every run (and thread) using the same file shares the limit",
+    )
+    parser.add_argument(
+        "--no-gap-fill",
+        action="store_true",
+        help="with -c, don't archive the images missed while the loop wasn't running",
+    )
+    parser.add_argument(
+        "--log-format",
+        choices=LOG_FORMATS,
+        default=None,
+        help="rich in a terminal, plain or json for cron, defaults to $BACKGROUNDS_LOG_FORMAT or auto",
     )
     args = parser.parse_args()
+    configure_logging(args.log_format)
     logger.info(f"Running with args: {args}")
     if args.constant and args.one_day:
         logger.error("[red]Cannot run constant (-c) and one_day (-d) at the same time")
         exit(1)
-    if args.constant:
-        constant(args.folder_path, args.minute_interval)
+    if args.from_date and (args.constant or args.one_day):
+        logger.error("[red]Cannot run a backfill (--from) with constant (-c) or one_day (-d)")
+        exit(1)
+    if args.to_date and not args.from_date:
+        logger.error("[red]--to needs --from")
+        exit(1)
+    retention_policy = None
+    if args.retention or args.max_archive_gb:
+        max_total_bytes = int(args.max_archive_gb * 1024**3) if args.max_archive_gb else None
+        retention_policy = RetentionPolicy.from_string(args.retention or "", max_total_bytes)
+    probe_cache = None if args.no_probe_cache else ProbeCache(args.probe_cache)
+    rate_limiter = None
+    if args.max_requests_per_second or args.max_mb_per_second:
+        max_bytes_per_second = args.max_mb_per_second * 1024**2 if args.max_mb_per_second else None
+        rate_limiter = RateLimiter(args.max_requests_per_second, max_bytes_per_second, args.rate_limit_file)
+    variant_pipeline = None
+    if args.variant:
+        variant_pipeline = VariantPipeline([Variant.from_string(v) for v in args.variant], args.variant_workers)
+    if args.migrate_archive:
+        migrate_archive(args.folder_path)
+    elif args.compact_archive is not None:
+        compact_archive(args.folder_path, args.compact_archive)
+    elif args.scrub:
+        scrub(args.folder_path, probe_cache, rate_limiter)
+    elif args.constant:
+        constant(
+            args.folder_path,
+            args.minute_interval,
+            args.discovery,
+            retention_policy,
+            args.dedup,
+            args.similarity_threshold,
+            variant_pipeline,
+            args.metrics,
+            probe_cache,
+            not args.no_gap_fill,
+            rate_limiter,
+        )
+    elif args.from_date:
+        backfill(
+            args.from_date,
+            args.to_date,
+            args.polling_frequency_seconds,
+            args.workers,
+            args.discovery,
+            args.metrics,
+            probe_cache,
+            rate_limiter,
+        )
     elif args.one_day:
-        one_day(args.one_day, args.polling_frequency_seconds)
+        one_day(
+            args.one_day,
+            args.polling_frequency_seconds,
+            args.workers,
+            args.discovery,
+            args.metrics,
+            probe_cache,
+            rate_limiter,
+        )
     else:
-        once(args.folder_path)
+        once(
+            args.folder_path,
+            args.discovery,
+            retention_policy,
+            args.dedup,
+            args.similarity_threshold,
+            variant_pipeline,
+            args.metrics,
+            probe_cache,
+            rate_limiter,
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,130 @@
+import datetime as dt
+import os
+import sqlite3
+import threading
+
+from src.core.logger import logger
+
+# shared by every run (live, -d and --from/--to) so none of them asks the bucket something another already knows
+PROBE_CACHE_FILE = "~/.cache/backgrounds/probes.sqlite3"
+# a 404 is asked again after this long, the image may have been uploaded late
+MISS_TTL = dt.timedelta(hours=1)
+# a 404 on a minute younger than this may just not be published yet, so it is only trusted for FRESH_MISS_TTL
+# (less than the shortest retry of constant mode, see wakeup.MIN_RETRY_SECONDS)
+FRESH_MISS_AGE = dt.timedelta(minutes=10)
+FRESH_MISS_TTL = dt.timedelta(seconds=10)
+# minutes are stored as integers, counted from here
+EPOCH = dt.datetime(1970, 1, 1)
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS probes (
+    series TEXT NOT NULL,
+    minute INTEGER NOT NULL,
+    found INTEGER NOT NULL,
+    checked_at INTEGER NOT NULL,
+    path TEXT,
+    PRIMARY KEY (series, minute)
+) WITHOUT ROWID;
+"""
+
+
+class ProbeCache:
+    def __init__(
+        self,
+        file_path: str = PROBE_CACHE_FILE,
+        miss_ttl: dt.timedelta = MISS_TTL,
+        fresh_miss_ttl: dt.timedelta = FRESH_MISS_TTL,
+        permanent_miss_age: dt.timedelta | None = None,
+    ) -> None:
+        """
+        what we learned from every image url we requested, so the same minute is never asked twice
+        a minute is keyed by its series (camera and image size) and stored as an integer in a sqlite table
+        an image that exists is remembered forever, with the file we saved it to (if we still have it)
+        a 404 expires after `miss_ttl` because images are sometimes uploaded late (or the 404 was a hiccup),
+        and after `fresh_miss_ttl` if the minute was younger than FRESH_MISS_AGE (it may not be published yet)
+        permanent_miss_age: if set, a 404 on a minute that was already older than this when we asked never expires
+        it is safe to share between threads, and between processes through sqlite's own locking
+        """
+        self.file_path: str = os.path.expanduser(file_path)
+        self.miss_ttl: int = int(miss_ttl.total_seconds())
+        self.fresh_miss_ttl: int = int(fresh_miss_ttl.total_seconds())
+        self.permanent_miss_age: int | None = (
+            int(permanent_miss_age.total_seconds()) if permanent_miss_age is not None else None
+        )
+        os.makedirs(os.path.dirname(self.file_path) or ".", exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.file_path, timeout=30, check_same_thread=False)
+        # every probe is a write, WAL keeps them cheap and lets other runs read at the same time
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        # lookups the cache answered and lookups that had to go to the network
+        self.hits: int = 0
+        self.misses: int = 0
+
+    @staticmethod
+    def to_seconds(time: dt.datetime) -> int:
+        """
+        helper function
+        the times are naive (local, like the image urls), so they are counted from a naive epoch
+        """
+        return int((time - EPOCH).total_seconds())
+
+    def to_minute(self, minute: dt.datetime) -> int:
+        """
+        helper function
+        """
+        return self.to_seconds(minute.replace(second=0, microsecond=0)) // 60
+
+    def lookup(self, series: str, minute: dt.datetime, now: dt.datetime) -> tuple[bool, str | None] | None:
+        """
+        what we know about a minute: (True, path) if the image exists, the path is None if we don't have a copy,
+        (False, None) for a 404 that hasn't expired, None if we have to ask
+        now: the time of the fetcher's clock
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT found, checked_at, path FROM probes WHERE series = ? AND minute = ?",
+                (series, self.to_minute(minute)),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            found, checked_at, path = row
+            age_when_checked = checked_at - self.to_minute(minute) * 60
+            permanent = self.permanent_miss_age is not None and age_when_checked >= self.permanent_miss_age
+            if not found and not permanent:
+                ttl = self.fresh_miss_ttl if age_when_checked < FRESH_MISS_AGE.total_seconds() else self.miss_ttl
+                if self.to_seconds(now) - checked_at >= ttl:
+                    self.misses += 1
+                    return None
+            self.hits += 1
+        if found and path and not os.path.exists(path):
+            path = None
+        return bool(found), path
+
+    def record(self, series: str, minute: dt.datetime, found: bool, now: dt.datetime, path: str | None = None) -> None:
+        """
+        remember the answer for a minute, a known image keeps the path it had if no new one is given
+        """
+        checked_at = self.to_seconds(now)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO probes (series, minute, found, checked_at, path) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (series, minute) DO UPDATE SET found = MAX(found, excluded.found), "
+                "checked_at = excluded.checked_at, path = COALESCE(excluded.path, path)",
+                (series, self.to_minute(minute), int(found), checked_at, path and os.path.expanduser(path)),
+            )
+
+    def hit_rate(self) -> float:
+        """
+        the share of lookups the cache answered, every answered 404 is a request we didn't make
+        and so is every image we still have a copy of
+        """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0
+
+    def log_stats(self) -> None:
+        logger.info(
+            f"[blue]Probe cache: answered {self.hits} of {self.hits + self.misses} lookups "
+            f"({self.hit_rate():.0%} hit rate)"
+        )
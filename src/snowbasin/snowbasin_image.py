@@ -1,14 +1,33 @@
 import datetime as dt
 import os
+import shutil
+import tempfile
 import time
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from typing import TYPE_CHECKING
 
-import requests
-from rich.traceback import install
-
+from src.core.atomic import atomic_path
 from src.core.background import BackgroundImageFetcher
+from src.core.integrity import jpeg_problem
 from src.core.logger import logger
+from src.core.metrics import Metrics
+from src.core.rate_limit import RateLimiter
+from src.core.retention import RetentionPolicy
+from src.snowbasin.bucket_listing import STORAGE_API_URL, BucketListing
+from src.snowbasin.cadence import HISTORY_PER_HOUR, WINDOW_MINUTES, CadencePredictor, probe_windows
+from src.snowbasin.gap_fill import GapFiller
+from src.snowbasin.probe_cache import ProbeCache
+
+# requests is only imported once the first request is made, see BackgroundImageFetcher.session
+if TYPE_CHECKING:
+    import sqlite3
+
+    import requests
 
-install(show_locals=True)
+    from src.core.session import PooledSession
+    from src.core.variants import VariantPipeline
 
 
 class SnowbasinImage(BackgroundImageFetcher):
@@ -17,49 +36,150 @@ class SnowbasinImage(BackgroundImageFetcher):
         background_directory: str,
         store_previous_images: bool = True,
         image_size: str = "1080",
+        session: "PooledSession | None" = None,
+        discovery: str = "probe",
+        listing_api_url: str = STORAGE_API_URL,
+        retention_policy: RetentionPolicy | None = None,
+        camera_id: str = "prism-cam-00054",
+        dedup: bool = False,
+        similarity_threshold: int | None = None,
+        variant_pipeline: "VariantPipeline | None" = None,
+        storage_url: str = "https://storage.googleapis.com",
+        clock: Callable[[], dt.datetime] = dt.datetime.now,
+        metrics: Metrics | None = None,
+        probe_cache: ProbeCache | None = None,
+        gap_fill: bool = False,
+        rate_limiter: RateLimiter | None = None,
+        metrics_label: str | None = None,
     ) -> None:
         """
         initialize the class
         background_directory: the directory where the images will be saved.
          - This is an absolute path.
         Example for Mac: ~/Desktop/backgrounds/
+        session: connection pool used for every request, pass one in to share it between fetchers
+        discovery: how we find out which images exist
+         - "probe": request the urls we expect and look for 404s
+         - "listing": list the bucket and only request images we know exist
+        listing_api_url: the storage JSON API used by the "listing" discovery
+        retention_policy: thins and caps the archive after every image is archived, None keeps everything
+        camera_id: the storage bucket of the camera, prism-cam-00054 is the Mt Ogden camera
+        dedup: keep identical images once in the archive and skip frames identical to the current background
+        similarity_threshold: skip frames whose perceptual hash is this close to the current background (needs Pillow)
+        variant_pipeline: renders every new image into resized copies for other displays
+        storage_url: where the camera buckets live, a stand-in server can be used instead
+        clock: returns the current time, the benchmarks pass in a clock they control
+        metrics: stage timings, probe and request counters, pass one in to share it between fetchers
+        probe_cache: if set, every minute we already asked about is answered from it instead of the bucket
+        gap_fill: if True, the images missed while the loop wasn't running are archived in the background
+         (see GapFiller), needs store_previous_images
+        rate_limiter: every request waits for it, see BackgroundImageFetcher
+        metrics_label: the `source` label of our metrics, see BackgroundImageFetcher
         """
-        self.background_file_path: str = background_directory
-        self.store_previous_images: bool = store_previous_images
-        self.base_url: str = "https://storage.googleapis.com/prism-cam-00054"
+        super().__init__(
+            background_directory,
+            store_previous_images,
+            session,
+            "snowbasin",
+            retention_policy,
+            dedup,
+            similarity_threshold,
+            variant_pipeline,
+            metrics,
+            rate_limiter=rate_limiter,
+            metrics_label=metrics_label,
+        )
+        self.base_url: str = f"{storage_url}/{camera_id}"
+        self.camera_id: str = camera_id
+        self.probe_cache: ProbeCache | None = probe_cache
+        self.clock: Callable[[], dt.datetime] = clock
         self.image_size: str = image_size
-        self.current_image_date: dt.date | None = None
+        if discovery not in ("probe", "listing"):
+            raise ValueError(f"Unknown discovery mode: {discovery}")
+        self.discovery: str = discovery
+        self.listing_api_url: str = listing_api_url
+        self._listing: BucketListing | None = None
+        self.cadence: CadencePredictor = CadencePredictor()
+        # used to report how many requests it takes to find an image
+        self.probes: int = 0
+        self.images_found: int = 0
+        # capture time and hash of the last image we downloaded
+        self.last_image_time: dt.datetime | None = None
+        self.last_image_sha256: str | None = None
+        self.gap_fill: bool = gap_fill
+        self.gap_filler: GapFiller | None = None
+
+    def __post_init__(self) -> None:
+        """
+        post init function to run after the class is initialized
+        learn the camera cadence from the images we already have
+        """
+        super().__post_init__()
+        self.cadence.learn_from_directory(self.background_file_path)
+        if self.archive:
+            self.cadence.learn_from_times(self.archive.latest_capture_times(24 * HISTORY_PER_HOUR, self.source_name))
+        if self.gap_fill and self.archive:
+            self.gap_filler = GapFiller(self)
+            self.gap_filler.resume()
+
+    @property
+    def listing(self) -> BucketListing | None:
+        """
+        the bucket listing used by the "listing" discovery, None when we probe
+        it is created on first use, like the session it needs
+        """
+        if self.discovery == "listing" and self._listing is None:
+            self._listing = BucketListing(self.base_url, self.image_size, self.session, self.listing_api_url)
+        return self._listing
 
     def set_image_size(self, image_size: str) -> None:
         """
         set the image size
         """
         self.image_size = image_size
+        if self._listing:
+            self._listing.image_size = image_size
 
     def process(self) -> bool:
         """
         main process for finding and saving the most recent image
+        the folder is locked while we update it, if another run is already updating it we skip this cycle
+        the gap filler waits while we update
+        """
+        with self.state.lock() as acquired, self.gap_filler.live_update() if self.gap_filler else nullcontext():
+            if not acquired:
+                logger.info(f"[yellow]Another run is updating {self.background_file_path}, skipping this cycle")
+                return False
+            return self.update_background()
+
+    def update_background(self) -> bool:
+        """
+        helper function
+        the steps of `process`, called with the folder locked
         """
         # step 1
         # pull in the current contents of the directory
-        current_background_file = self.get_current_files_in_directory()
+        with self.metrics.stage("scan", source=self.metrics_label):
+            current_background_file = self.get_current_files_in_directory()
         logger.info(f"[blue]Current background image: {current_background_file}")
-        # if we have a file, we will convert it (a string) to a datetime object
+        # if we have a file, its capture time comes with it from the state file
+        # along with the newest image we checked, which is newer if we skipped a duplicate of the background
         if current_background_file:
-            # convert to a datetime object
-            current_background_image_date = self.make_date_from_file_string(current_background_file.split("/")[-1])
+            current_background_image_date = self.current_image_date
+            seen_image_date = self.seen_image_date
             # step 2-a
             # check the date time
-            next_image_to_pull = self.find_next_image_time(current_background_image_date)
+            with self.metrics.stage("choose", source=self.metrics_label):
+                next_image_to_pull = self.find_next_image_time(seen_image_date)
 
         # if we don't find a file, we need to start the process from scratch
         else:
             logger.info("[yellow]No image found in the directory")
-            current_background_image_date = ""
+            current_background_image_date = seen_image_date = ""
             # step 2-b
             # i chose to go back 1 day to find the next image (this is overkill)
             # as long as we went back further than 5 minutes it would get us an image to pull
-            next_image_to_pull = self.find_next_image_time(dt.datetime.now() - dt.timedelta(days=1))
+            next_image_to_pull = self.find_next_image_time(self.clock() - dt.timedelta(days=1))
 
         # log the current and next image time
         logger.info(f"Current image time: {current_background_image_date}")
@@ -67,9 +187,9 @@ class SnowbasinImage(BackgroundImageFetcher):
 
         # check if the image already exists, we will log and exit the function
         # add a check first to make sure current_background_image_date is not None
-        if current_background_image_date and next_image_to_pull.replace(
+        if seen_image_date and next_image_to_pull.replace(second=0, microsecond=0) == seen_image_date.replace(
             second=0, microsecond=0
-        ) == current_background_image_date.replace(second=0, microsecond=0):
+        ):
             logger.info(f"[yellow]Image already exists: {current_background_file}")
             return True
 
@@ -77,6 +197,16 @@ class SnowbasinImage(BackgroundImageFetcher):
         # get the image and save it
         # if we don't find an image, we will return False and exit the function
         if self.get_image(next_image_to_pull):
+            # a frame that is the same as the current background doesn't replace it
+            if self.is_duplicate_of_current(self.last_image_saved, current_background_file, self.last_image_sha256):
+                self.skip_duplicate(self.last_image_saved, self.last_image_time)
+                # the images between the two went missing, the duplicate itself isn't archived
+                if self.store_previous_images and self.gap_filler and current_background_file:
+                    self.gap_filler.submit(seen_image_date, self.last_image_time)
+                return False
+            # the resizing happens in other processes, we don't wait for it
+            if self.variant_pipeline:
+                self.variant_pipeline.submit(self.last_image_saved)
             # depending on the value of store_previous_images, we will either move or delete the file
             if self.store_previous_images:
                 # if the file doesn't exist, we don't need to move anything
@@ -84,7 +214,13 @@ class SnowbasinImage(BackgroundImageFetcher):
                 if current_background_file:
                     # step 4-a
                     # move the file
-                    self.move_last_image(current_background_file)
+                    with self.metrics.stage("archive", source=self.metrics_label):
+                        archived_path = self.move_last_image(current_background_file)
+                    if archived_path:
+                        self.remember_probe(current_background_image_date, True, archived_path)
+                    # the images between the two went missing while we weren't running
+                    if self.gap_filler:
+                        self.gap_filler.submit(seen_image_date, self.last_image_time)
                     logger.info(f"[yellow]Moved {os.path.basename(current_background_file)} to archive folder.")
                 else:
                     # log if there wasn't a file to move
@@ -94,16 +230,17 @@ class SnowbasinImage(BackgroundImageFetcher):
                 # delete the file
                 self.delete_file(current_background_file)
                 logger.info(f"[yellow]Deleted {os.path.basename(current_background_file)}")
+            self.state.save(self.last_image_saved, self.last_image_time)
+            return True
         else:
             return False
 
-    @staticmethod
-    def find_next_image_time(current_background: dt.datetime) -> dt.datetime:
+    def find_next_image_time(self, current_background: dt.datetime) -> dt.datetime:
         """
         Step 2
         return the next good image time as datetime to look for
         """
-        right_now = dt.datetime.now()
+        right_now = self.clock()
 
         # between 8am and 6pm we will look for images every 5 minutes
         if right_now.hour >= 8 and right_now.hour <= 18:
@@ -147,16 +284,26 @@ class SnowbasinImage(BackgroundImageFetcher):
         scrape Snowbasin image and save to my computer
         return True if successful, False if not
         """
-        resp, image_time = self.check_for_non_round_image_times(image_time_to_pull)
+        with self.metrics.stage("probe", source=self.metrics_label):
+            resp, image_time = self.check_for_non_round_image_times(image_time_to_pull)
         # if we get a good response, we will save the image
         if resp and image_time:
             file_path = self.make_file_path_string(image_time)
             # make the directory if it doesn't exist
             os.makedirs(os.path.expanduser(self.background_file_path), exist_ok=True)
-            # save the image data to the .jpg file
-            self.write_image_to_file(resp, file_path)
+            # save the image data to the .jpg file, a truncated or corrupt image is never kept
+            try:
+                self.last_image_sha256 = self.save_image(resp, file_path)
+            except ValueError as e:
+                logger.error(f"[red]{e}")
+                return False
             logger.info(f"[green]Image downloaded and saved to: {file_path}")
+            self.remember_probe(image_time, True, file_path)
             self.last_image_saved = file_path
+            self.last_image_time = image_time
+            self.metrics.set(
+                "image_age_seconds", (self.clock() - image_time).total_seconds(), source=self.metrics_label
+            )
             return True
         elif self.current_image_date is None:
             return self.get_image(image_time_to_pull - dt.timedelta(minutes=5))
@@ -165,12 +312,13 @@ class SnowbasinImage(BackgroundImageFetcher):
 
     def check_for_non_round_image_times(
         self, image_time_to_pull: dt.date, request_limit: int = 0
-    ) -> tuple[requests.Response | None, dt.date | None]:
+    ) -> tuple["requests.Response | None", dt.date | None]:
         """
         Step 3 helper
 
         check for non round image times
-        if we don't find an image it will look for the previous 4 minute intervals before it
+        all of the candidate minutes are requested at the same time and the newest one found is returned
+        if we don't find an image at the round time, we use the previous 4 minute intervals before it
         for example:
         if we are looking for
         2021-09-10 10:15:00
@@ -182,37 +330,116 @@ class SnowbasinImage(BackgroundImageFetcher):
         then 2021-09-10 10:13:00
         then 2021-09-10 10:12:00
         then 2021-09-10 10:11:00
+        (these were already requested alongside 10:15, so there is no extra wait)
+
+        once the cadence predictor has seen enough images for the hour, the minute it thinks is most likely
+        is requested on its own first, and the rest are only probed if that one misses
 
         if we don't find any of those, it will just return the resp object which will be a 404
         log the result, and don't save a picture
         """
-        if (
-            image_time_to_pull
-            and self.current_image_date
-            and image_time_to_pull.replace(second=0, microsecond=0)
-            == self.current_image_date.replace(second=0, microsecond=0)
-        ):
-            logger.info(f"[yellow]Stopping image search, image already exists: {self.current_image_date}")
+        candidates = self.make_candidate_times(image_time_to_pull, request_limit)
+        if not candidates:
+            logger.info(f"[yellow]Stopping image search, image already exists: {self.seen_image_date}")
             return None, None
-        # set the URL from the image time
-        url = self.make_url_string(image_time_to_pull)
-        logger.info(f"[blue]Checking for image at: {url}")
-        # make the request for the image
-        resp = self.pull_image_from_web(url)
-        # if we get a good response, we will return it
-        if resp.ok:
-            logger.info(f"[green]Image found at: {url}")
-            return resp, image_time_to_pull
-        # if we get a 404, we will try again with the previous minute
-        else:
-            logger.info(f"[yellow]Image not found at [/]{url}")
-            # if we have tried 5 times, we will return the response
-            if request_limit == 4:
-                logger.warn("[red]No image found in 5 tries")
-                return resp, None
-            request_limit += 1
-            image_time_to_pull = image_time_to_pull - dt.timedelta(minutes=1)
-            return self.check_for_non_round_image_times(image_time_to_pull, request_limit)
+        logger.info(f"[blue]Checking for image at: {', '.join(c.strftime('%H:%M') for c in candidates)}")
+        # with a bucket listing we only request the minutes that exist
+        if self.listing:
+            candidates = self.listing.filter_existing(candidates)
+            if not candidates:
+                logger.info("[yellow]No image listed in the bucket for this slot")
+                return None, None
+        # the probe cache answers the minutes we already asked about, a known image is requested on its own
+        if self.probe_cache:
+            known = {c: self.known_probe(c) for c in candidates}
+            found = [c for c in candidates if known[c] and known[c][0]]
+            candidates = found[:1] or [c for c in candidates if not known[c]]
+            if not candidates:
+                logger.info("[yellow]The probe cache already knows there is no image for this slot")
+                return None, None
+
+        resp, image_time = None, None
+        # ask for the minute the camera most likely used first, most cycles end here
+        predicted = self.cadence.most_likely(candidates, image_time_to_pull)
+        if predicted:
+            resp = self.pull_image_from_web(self.make_url_string(predicted))
+            self.probes += 1
+            self.metrics.inc("probes_total", source=self.metrics_label)
+            self.remember_response(predicted, resp)
+            if resp.ok:
+                logger.info(f"[green]Image found at predicted time: {resp.url}")
+                image_time = predicted
+            else:
+                logger.info(f"[yellow]Image not found at predicted time [/]{resp.url}")
+                self.metrics.inc("probe_misses_total", source=self.metrics_label)
+                resp.close()
+                candidates = [c for c in candidates if c != predicted]
+        if not image_time and candidates:
+            resp, image_time = self.probe_in_parallel(candidates)
+
+        if image_time:
+            self.cadence.learn(image_time)
+            self.images_found += 1
+            logger.info(f"[blue]Probes per image: {self.probes / self.images_found:.2f}")
+            return resp, image_time
+        logger.warning(f"[red]No image found in {5 - request_limit} tries")
+        return resp, None
+
+    def probe_in_parallel(self, candidates: list[dt.datetime]) -> tuple["requests.Response", dt.datetime | None]:
+        """
+        Step 3 helper
+        probe every candidate minute at once, only the headers are read (stream=True)
+        the newest minute that exists wins, everything older is cancelled or closed
+        """
+        executor = ThreadPoolExecutor(max_workers=len(candidates))
+        futures = [executor.submit(self.pull_image_from_web, self.make_url_string(c), True) for c in candidates]
+        resp, image_time = None, None
+        try:
+            for candidate, future in zip(candidates, futures):
+                resp = future.result()
+                self.remember_response(candidate, resp)
+                if resp.ok:
+                    logger.info(f"[green]Image found at: {resp.url}")
+                    image_time = candidate
+                    break
+                logger.info(f"[yellow]Image not found at [/]{resp.url}")
+                resp.close()
+        finally:
+            # anything we couldn't cancel was sent, every probe but the winner was a miss
+            sent = sum(not future.cancel() for future in futures)
+            self.probes += sent
+            self.metrics.inc("probes_total", sent, source=self.metrics_label)
+            self.metrics.inc("probe_misses_total", sent - (image_time is not None), source=self.metrics_label)
+            for future in futures:
+                future.add_done_callback(lambda f, winner=resp: self.close_losing_response(f, winner))
+            executor.shutdown(wait=False)
+        return resp, image_time
+
+    def make_candidate_times(self, image_time_to_pull: dt.datetime, request_limit: int = 0) -> list[dt.datetime]:
+        """
+        helper function
+        list the minutes to probe for an image, newest first
+        we look at most at the 5 minutes up to image_time_to_pull (less if request_limit is set)
+        and at none of them if the image we already have is one of those 5,
+        the camera takes at most one picture in a window so there is nothing else to find
+        """
+        current = self.seen_image_date.replace(second=0, microsecond=0) if self.seen_image_date else None
+        if current and image_time_to_pull.replace(second=0, microsecond=0) - current < dt.timedelta(
+            minutes=WINDOW_MINUTES
+        ):
+            return []
+        return [image_time_to_pull - dt.timedelta(minutes=minutes_back) for minutes_back in range(5 - request_limit)]
+
+    @staticmethod
+    def close_losing_response(future: Future, winner: "requests.Response | None") -> None:
+        """
+        helper function
+        close responses from probes that lost the race so their connections are released
+        """
+        if future.cancelled() or future.exception():
+            return
+        if future.result() is not winner:
+            future.result().close()
 
     def make_url_string(self, date: dt.datetime) -> str:
         """
@@ -229,10 +456,13 @@ class SnowbasinImage(BackgroundImageFetcher):
             f"{self.image_size}.jpg"
         )
 
-    def pull_one_day_to_old_backgrounds(self, date: dt.datetime, poll_frequency: int) -> int:
+    def pull_one_day_to_old_backgrounds(self, date: dt.datetime, poll_frequency: int, workers: int = 1) -> int:
         """
         Given a date, pull all the images from that day (still adhering to the normal cadence
+        if workers is more than 1, the day is probed concurrently (see `pull_one_day_concurrently`)
         """
+        if workers > 1 or self.listing:
+            return self.pull_one_day_concurrently(date, poll_frequency, workers)
         # set the start time to 8am
         date = date.replace(hour=0, minute=1)
         # set the end time to 6pm
@@ -247,14 +477,19 @@ class SnowbasinImage(BackgroundImageFetcher):
             # if we find an image lets skip forward 5 minutes, if not just 1
             resp, returned_date = self.check_for_non_round_image_times(date, request_limit=4)
 
-            if resp.ok:
+            if resp is not None and resp.ok:
                 file_path = self.make_file_path_string(date)
                 # make the directory if it doesn't exist
                 os.makedirs(os.path.expanduser(self.background_file_path), exist_ok=True)
                 # save the image data to the .jpg file
-                self.write_image_to_file(resp, file_path)
-                logger.info(f"[green]Image downloaded and saved to: {file_path}")
-                image_found = True
+                try:
+                    self.save_image(resp, file_path)
+                    logger.info(f"[green]Image downloaded and saved to: {file_path}")
+                    self.remember_probe(date, True, file_path)
+                    image_found = True
+                except ValueError as e:
+                    logger.error(f"[red]{e}")
+                    image_found = False
 
             else:
                 image_found = False
@@ -264,3 +499,223 @@ class SnowbasinImage(BackgroundImageFetcher):
             # wait a second before requesting
             time.sleep(poll_frequency)
         return images_found
+
+    def pull_one_day_concurrently(self, date: dt.datetime, poll_frequency: float, workers: int) -> int:
+        """
+        Given a date, probe the day one 5 minute window at a time with a pool of `workers` threads
+        every window stops at its first image (see probe_window), the same engine the --from/--to backfill uses
+        with a bucket listing, only the images in the listing are requested (the day is probed if it can't be listed)
+        each worker waits `poll_frequency` seconds before every request so we can still throttle
+        images are written as soon as they arrive and the images per second are logged
+        """
+        start = date.replace(hour=0, minute=0, second=0, microsecond=0)
+        captures = self.listing.try_list_captures(start) if self.listing else None
+        if captures is not None:
+            windows = [[minute] for minute in captures]
+        else:
+            windows = probe_windows(start, start.replace(hour=23, minute=59))
+        os.makedirs(os.path.expanduser(self.background_file_path), exist_ok=True)
+        self.session.ensure_pool_size(workers)
+        logger.info(f"[blue]Probing {len(windows)} windows on {start.date()} with {workers} workers")
+
+        def throttle() -> None:
+            time.sleep(poll_frequency)
+
+        images_found = 0
+        started_at = time.monotonic()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(self.probe_window, minutes, self.store_in_background_directory, throttle)
+                for minutes in windows
+            ]
+            for future in as_completed(futures):
+                file_path = future.result()
+                if not file_path:
+                    continue
+                images_found += 1
+                elapsed = time.monotonic() - started_at
+                logger.info(
+                    f"[green]Image downloaded and saved to: {file_path} "
+                    f"({images_found} images, {images_found / elapsed:.2f} images/sec)"
+                )
+
+        elapsed = time.monotonic() - started_at
+        logger.info(
+            f"[blue]Finished {start.date()} in {elapsed:.1f}s: {images_found} images, "
+            f"{images_found / elapsed if elapsed else 0:.2f} images/sec"
+        )
+        self.session.log_pool_stats()
+        return images_found
+
+    def store_in_background_directory(self, image_time: dt.datetime, write: Callable[[str], str | None]) -> str:
+        """
+        helper function
+        where pull_one_day_concurrently puts every image (see probe_window)
+        """
+        file_path = self.make_file_path_string(image_time)
+        write(file_path)
+        return file_path
+
+    def probe_window(
+        self,
+        minutes: list[dt.datetime],
+        store: Callable[[dt.datetime, Callable[[str], str | None]], str],
+        before_request: Callable[[], None] | None = None,
+        on_missing: Callable[[dt.datetime], None] | None = None,
+        background: bool | None = None,
+    ) -> str | None:
+        """
+        request the minutes of a window (newest first) until one has an image, the likely minute goes first
+        every backfill (-d, --from/--to and the gap fill) probes through here, they only differ in where the image goes
+        the probe cache is asked first: its 404s aren't requested and an image it knows about is the only one we
+        try, copied from the file we already have if there is one
+        store(minute, write): puts the image of `minute` where the caller wants it, `write(file_path)` writes it
+         there (it returns the sha256, or None for a copy) and may raise ValueError for a bad download,
+         store returns where the image ended up
+        before_request: called before every request, to throttle or to wait for something
+        on_missing: called with every minute that returned a 404
+        background: passed on to pull_image_from_web
+        returns where the image was stored, or None if the window has none
+        """
+        # windows end on their slot, a window cut short still belongs to it
+        slot = minutes[0] + dt.timedelta(minutes=-minutes[0].minute % WINDOW_MINUTES)
+        known = {minute: self.known_probe(minute) for minute in minutes}
+        found = [minute for minute in minutes if known[minute] and known[minute][0]]
+        if found and known[found[0]][1]:
+            source_path = known[found[0]][1]
+            return store(found[0], lambda file_path: self.copy_known_image(source_path, file_path))
+        minutes = found or [minute for minute in minutes if not known[minute]]
+        likely = self.cadence.most_likely(minutes, slot)
+        if likely:
+            minutes = [likely] + [minute for minute in minutes if minute != likely]
+        for minute in minutes:
+            if before_request:
+                before_request()
+            resp = self.pull_image_from_web(self.make_url_string(minute), background=background)
+            self.metrics.inc("probes_total", source=self.metrics_label)
+            self.remember_response(minute, resp)
+            if resp.ok:
+                try:
+                    file_path = store(minute, lambda file_path, resp=resp: self.save_image(resp, file_path, background))
+                except ValueError as e:
+                    # not remembered, the next run asks for it again
+                    logger.error(f"[red]{e}")
+                    return None
+                self.remember_probe(minute, True, file_path)
+                self.cadence.learn(minute)
+                return file_path
+            resp.close()
+            self.metrics.inc("probe_misses_total", source=self.metrics_label)
+            if resp.status_code == 404 and on_missing:
+                on_missing(minute)
+        return None
+
+    def known_probe(self, image_time: dt.datetime) -> tuple[bool, str | None] | None:
+        """
+        helper function
+        what the probe cache knows about a minute (see ProbeCache.lookup), None without a cache
+        """
+        if self.probe_cache is None:
+            return None
+        known = self.probe_cache.lookup(self.probe_series, image_time, self.clock())
+        self.metrics.inc("probe_cache_lookups_total", source=self.metrics_label, result="hit" if known else "miss")
+        return known
+
+    def remember_probe(self, image_time: dt.datetime, found: bool, file_path: str | None = None) -> None:
+        """
+        helper function
+        record what we learned about a minute in the probe cache, if there is one
+        """
+        if self.probe_cache is not None:
+            self.probe_cache.record(self.probe_series, image_time, found, self.clock(), file_path)
+
+    def remember_response(self, image_time: dt.datetime, resp: "requests.Response") -> None:
+        """
+        helper function
+        record a probe in the probe cache, only a 200 or a 404 tells us something
+        """
+        if resp.ok or resp.status_code == 404:
+            self.remember_probe(image_time, resp.ok)
+
+    @property
+    def probe_series(self) -> str:
+        """
+        helper function
+        the key of this camera and image size in the probe cache
+        """
+        return f"{self.camera_id}/{self.image_size}"
+
+    @staticmethod
+    def copy_known_image(source_path: str, file_path: str) -> None:
+        """
+        helper function
+        put an image we already have at `file_path` instead of downloading it again
+        it is hardlinked if we can, otherwise copied into a temp file and renamed into place
+        """
+        file_path = os.path.expanduser(file_path)
+        if os.path.exists(file_path) and os.path.samefile(source_path, file_path):
+            return
+        with atomic_path(file_path) as temp_path:
+            try:
+                os.remove(temp_path)
+                os.link(source_path, temp_path)
+            except OSError:
+                shutil.copyfile(source_path, temp_path)
+        logger.info(f"[green]Copied {source_path} to {file_path} instead of downloading it")
+
+    def scrub_archive(self) -> tuple[int, int, int]:
+        """
+        check every image of the archive and download the bad ones again
+        an image is bad if it is gone, its size doesn't match the index or it fails jpeg_problem
+        the check only reads the size and the first and last few bytes of every file
+        returns how many images were checked, how many were bad and how many of those were replaced
+        """
+        if self.archive is None:
+            self.archive = self.make_archive()
+        # images replaced during the scrub get a new id, they are already checked
+        last_id = self.archive.max_id()
+        checked = bad = fixed = 0
+        for row in self.archive.iter_images_between(dt.datetime.min, dt.datetime.max, self.source_name):
+            if row["id"] > last_id:
+                continue
+            checked += 1
+            file_path = self.archive.full_path(row)
+            if not os.path.exists(file_path):
+                problem = "the file is gone"
+            elif os.path.getsize(file_path) != row["size"]:
+                problem = f"{os.path.getsize(file_path)} bytes but {row['size']} in the index"
+            else:
+                problem = jpeg_problem(file_path)
+            if not problem:
+                continue
+            bad += 1
+            logger.warning(f"[red]Bad archived image {file_path}: {problem}")
+            fixed += self.refetch_archived_image(row)
+        logger.info(f"[blue]Scrubbed {checked} archived images: {bad} bad, {fixed} downloaded again")
+        return checked, bad, fixed
+
+    def refetch_archived_image(self, row: "sqlite3.Row") -> bool:
+        """
+        helper function
+        download an archived image again and put it in place of the bad one
+        the new image is checked like every download before the old one is removed
+        returns True if the image was replaced
+        """
+        captured_at = dt.datetime.fromisoformat(row["captured_at"])
+        resp = self.pull_image_from_web(self.make_url_string(captured_at))
+        if not resp.ok:
+            resp.close()
+            logger.warning(f"[red]Could not download {resp.url} again (status {resp.status_code})")
+            return False
+        with tempfile.TemporaryDirectory(dir=self.archive.root, prefix=".scrub-") as directory:
+            file_path = os.path.join(directory, os.path.basename(row["path"]))
+            try:
+                sha256 = self.write_image_to_file(resp, file_path)
+            except ValueError as e:
+                logger.error(f"[red]{e}")
+                return False
+            self.archive.delete([row])
+            archived_path = self.archive.add(file_path, captured_at, self.source_name, sha256)
+        self.remember_probe(captured_at, True, archived_path)
+        logger.info(f"[green]Replaced {archived_path}")
+        return True
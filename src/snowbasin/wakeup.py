@@ -0,0 +1,95 @@
+import datetime as dt
+import statistics
+from collections import deque
+
+from src.core.logger import logger
+from src.snowbasin.cadence import CadencePredictor
+
+# how long we assume it takes the camera to publish an image before we have seen any
+DEFAULT_PUBLISH_DELAY = 60
+# retries after a miss start here and double every time
+MIN_RETRY_SECONDS = 15
+MAX_RETRY_SECONDS = 120
+# when the first wakeup already finds the image, we only know the delay was at most that long,
+# so we record a little less to try earlier next time
+EARLY_FACTOR = 0.8
+HISTORY = 50
+
+
+class WakeupScheduler:
+    def __init__(self, cadence: CadencePredictor) -> None:
+        """
+        decides how long constant mode sleeps between checks
+        we wake up when the next image should be published: the next slot of the camera schedule,
+        shifted by the capture offset the cadence predictor learned, plus the publish delay of recent images
+        on a miss we retry with a short exponential backoff
+        """
+        self.cadence: CadencePredictor = cadence
+        self.publish_delays: deque[float] = deque(maxlen=HISTORY)
+        self.latencies: deque[float] = deque(maxlen=HISTORY)
+        self.misses: int = 0
+        self.wakeups: int = 0
+        self.wasted_wakeups: int = 0
+        self.started_at: dt.datetime = dt.datetime.now()
+
+    def publish_delay(self) -> float:
+        """
+        seconds between a capture and the image showing up in the bucket
+        """
+        return statistics.median(self.publish_delays) if self.publish_delays else DEFAULT_PUBLISH_DELAY
+
+    def next_wakeup(self, last_capture: dt.datetime) -> dt.datetime:
+        """
+        when the image after `last_capture` should be available
+        that is its expected capture time plus the publish delay, but never before its slot
+        because SnowbasinImage.find_next_image_time only looks back from the slot
+        """
+        slot = self.cadence.slot_for(last_capture)
+        next_slot = slot + dt.timedelta(minutes=self.cadence.slot_period(slot.hour))
+        stats = self.cadence.offset_stats(next_slot.hour)
+        next_capture = next_slot - dt.timedelta(minutes=stats[0] if stats else 0)
+        return max(next_slot, next_capture + dt.timedelta(seconds=self.publish_delay()))
+
+    def record(self, new_capture: dt.datetime | None, last_capture: dt.datetime | None, now: dt.datetime) -> float:
+        """
+        record the result of a wakeup and return how many seconds to sleep until the next one
+        new_capture: capture time of the image this wakeup downloaded, None if there wasn't a new one
+        last_capture: capture time of the newest image we have
+        """
+        self.wakeups += 1
+        if new_capture:
+            seconds = (now - new_capture).total_seconds()
+            self.latencies.append(seconds)
+            self.publish_delays.append(seconds * EARLY_FACTOR if self.misses == 0 else seconds)
+            self.misses = 0
+        else:
+            self.wasted_wakeups += 1
+            self.misses += 1
+
+        if last_capture is None:
+            sleep_seconds = self.retry_seconds()
+        else:
+            sleep_seconds = (self.next_wakeup(last_capture) - now).total_seconds()
+            # the image is late, back off instead of hammering the bucket
+            if sleep_seconds <= 0:
+                sleep_seconds = self.retry_seconds()
+        self.log_stats(sleep_seconds)
+        return sleep_seconds
+
+    def retry_seconds(self) -> float:
+        """
+        helper function
+        exponential backoff after a miss
+        """
+        return min(MIN_RETRY_SECONDS * 2 ** max(self.misses - 1, 0), MAX_RETRY_SECONDS)
+
+    def log_stats(self, sleep_seconds: float) -> None:
+        """
+        log the median capture to disk latency and the wasted wakeups per hour
+        """
+        hours = max((dt.datetime.now() - self.started_at).total_seconds() / 3600, 1 / 60)
+        median_latency = statistics.median(self.latencies) if self.latencies else 0
+        logger.info(
+            f"[blue]Sleeping {sleep_seconds:.0f}s. Median capture to disk: {median_latency:.0f}s, "
+            f"wasted wakeups: {self.wasted_wakeups / hours:.1f}/hour ({self.wasted_wakeups}/{self.wakeups})"
+        )
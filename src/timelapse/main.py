@@ -0,0 +1,207 @@
+#!/venv/bin/python3
+import argparse
+import datetime as dt
+import glob
+import heapq
+import io
+import multiprocessing
+import os
+import shutil
+import subprocess
+import time
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from src.core.archive import ImageArchive
+from src.core.logger import logger
+from src.core.pack import PackedArchive, PackedFrame, read_packed_frame
+
+# Pillow is optional, it is only needed to build a timelapse
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
+
+
+def archived_frames(
+    background_directory: str, start: dt.datetime, end: dt.datetime, source: str | None = None
+) -> Iterator[str | PackedFrame]:
+    """
+    the archived images captured in [start, end), oldest first
+    loose images are read from the archive index (as their path) and packed days from the packs
+    (as their place in the pack), the two are merged by capture time
+    """
+    root = os.path.join(os.path.expanduser(background_directory), "old_backgrounds")
+    archive = ImageArchive(root)
+    loose = (
+        (dt.datetime.fromisoformat(row["captured_at"]), archive.full_path(row))
+        for row in archive.iter_images_between(start, end, source)
+    )
+    with PackedArchive(root) as packs:
+        packed = [packs.locations_between(start, end, s) for s in ([source] if source else packs.sources())]
+        for _, frame in heapq.merge(loose, *packed, key=lambda item: item[0]):
+            yield frame
+
+
+def directory_frames(directory: str, start: dt.datetime, end: dt.datetime) -> Iterator[str]:
+    """
+    paths of the YYYY-MM-DD-HH-MM.jpg images in a flat directory (e.g. from `snowbasin -d`) in [start, end)
+    """
+    for file_path in sorted(glob.glob(os.path.join(os.path.expanduser(directory), "*.jpg"))):
+        try:
+            captured_at = dt.datetime.strptime(os.path.basename(file_path), "%Y-%m-%d-%H-%M.jpg")
+        except ValueError:
+            continue
+        if start <= captured_at < end:
+            yield file_path
+
+
+def decode_frame(frame: str | PackedFrame, width: int, height: int) -> bytes | None:
+    """
+    decode a frame (a path, or an image in a pack) and crop it to width x height, this runs in a worker process
+    returns the raw RGB pixels, or None if the image can't be decoded
+    """
+    try:
+        with Image.open(frame if isinstance(frame, str) else io.BytesIO(read_packed_frame(frame))) as image:
+            # let the JPEG decoder scale down while decoding
+            image.draft("RGB", (width, height))
+            return ImageOps.fit(image.convert("RGB"), (width, height), Image.LANCZOS).tobytes()
+    except OSError:
+        return None
+
+
+def build_timelapse(
+    frames: Iterator[str | PackedFrame],
+    output_path: str,
+    width: int = 1920,
+    height: int = 1080,
+    fps: int = 30,
+    workers: int = 4,
+    queue_size: int = 16,
+) -> int:
+    """
+    stream the frames through a pool of decoder processes into ffmpeg
+    at most `queue_size` frames are decoded or waiting to be written at a time,
+    so memory stays the same whether the range holds 100 or 100,000 frames
+    the output format follows the file extension (.mp4, .webm, .gif, ...)
+    returns the number of frames written
+    """
+    if Image is None:
+        raise ImportError("Building a timelapse needs Pillow: pip install pillow")
+    if shutil.which("ffmpeg") is None:
+        raise FileNotFoundError("Building a timelapse needs ffmpeg on the PATH")
+    # mp4 players expect yuv420p, which needs an even width and height
+    width, height = width // 2 * 2, height // 2 * 2
+    # fmt: off
+    command = [
+        "ffmpeg", "-loglevel", "error", "-y",
+        "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{width}x{height}", "-r", str(fps), "-i", "-",
+    ]
+    # fmt: on
+    if not output_path.endswith(".gif"):
+        command += ["-pix_fmt", "yuv420p"]
+    ffmpeg = subprocess.Popen([*command, os.path.expanduser(output_path)], stdin=subprocess.PIPE)
+
+    frames_written = 0
+    started_at = time.monotonic()
+    # (file path, future) of the frames being decoded, oldest first
+    pending = deque()
+    # spawned workers don't inherit ffmpeg's stdin, with fork they would keep it open and ffmpeg would never finish
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        try:
+            for file_path in frames:
+                pending.append((file_path, executor.submit(decode_frame, file_path, width, height)))
+                # the oldest frame has to be written before we decode more, this keeps the queue bounded
+                if len(pending) >= queue_size:
+                    frames_written += write_frame(ffmpeg, *pending.popleft())
+                    if frames_written % 500 == 0:
+                        log_throughput(frames_written, started_at)
+            while pending:
+                frames_written += write_frame(ffmpeg, *pending.popleft())
+        finally:
+            for _, future in pending:
+                future.cancel()
+            ffmpeg.stdin.close()
+            ffmpeg.wait()
+    if ffmpeg.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed with exit code {ffmpeg.returncode}")
+    log_throughput(frames_written, started_at)
+    logger.info(f"[green]Timelapse saved to: {output_path}")
+    return frames_written
+
+
+def write_frame(ffmpeg: subprocess.Popen, file_path: str | PackedFrame, future: Future) -> int:
+    """
+    helper function
+    wait for a decoded frame and pipe it to ffmpeg, frames that couldn't be decoded are skipped
+    returns the number of frames written (0 or 1)
+    """
+    pixels = future.result()
+    if pixels is None:
+        logger.warning(f"[red]Skipping a frame that couldn't be decoded: {file_path}")
+        return 0
+    ffmpeg.stdin.write(pixels)
+    return 1
+
+
+def log_throughput(frames_written: int, started_at: float) -> None:
+    """
+    helper function
+    log the frames written so far and the frames per second
+    """
+    elapsed = time.monotonic() - started_at
+    logger.info(
+        f"[blue]{frames_written} frames in {elapsed:.1f}s ({frames_written / elapsed if elapsed else 0:.1f} fps)"
+    )
+
+
+def parse_date(value: str) -> dt.datetime:
+    """
+    helper function
+    parse YYYY-MM-DD or YYYY-MM-DDTHH:MM
+    """
+    return dt.datetime.fromisoformat(value)
+
+
+def main() -> None:
+    """
+    Main function to parse arguments and build a timelapse
+    command line accessible through `timelapse`
+    """
+    parser = argparse.ArgumentParser(description="Turn archived backgrounds into a timelapse.")
+    parser.add_argument("--from", dest="start", type=parse_date, required=True, help="first day, YYYY-MM-DD[THH:MM]")
+    parser.add_argument("--to", dest="end", type=parse_date, required=True, help="last day (inclusive), YYYY-MM-DD")
+    parser.add_argument("-o", "--output", type=str, default="timelapse.mp4", help="video or .gif file to write")
+    parser.add_argument(
+        "-f",
+        "--folder-path",
+        type=str,
+        default="~/Desktop/backgrounds/",
+        help="background folder, frames are read from its old_backgrounds archive",
+    )
+    parser.add_argument(
+        "--frames-dir",
+        type=str,
+        default=None,
+        help="read frames from a flat folder of YYYY-MM-DD-HH-MM.jpg files instead (e.g. from snowbasin -d)",
+    )
+    parser.add_argument("--source", type=str, default=None, help="only use archived images from this source")
+    parser.add_argument("--size", type=str, default="1920x1080", help="size of the video, WIDTHxHEIGHT")
+    parser.add_argument("--fps", type=int, default=30, help="frames per second of the video")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count() or 2, help="decoder processes")
+    parser.add_argument("--queue-size", type=int, default=16, help="frames decoded ahead of the writer")
+    args = parser.parse_args()
+
+    # a date without a time means the whole day
+    end = args.end + dt.timedelta(days=1) if args.end.time() == dt.time() else args.end
+    if args.frames_dir:
+        frames = directory_frames(args.frames_dir, args.start, end)
+    else:
+        frames = archived_frames(args.folder_path, args.start, end, args.source)
+    width, height = (int(v) for v in args.size.lower().split("x"))
+    build_timelapse(frames, args.output, width, height, args.fps, args.workers, args.queue_size)
+
+
+if __name__ == "__main__":
+    main()